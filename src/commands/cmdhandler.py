@@ -35,7 +35,7 @@ command line. The process is as follows:
 
 """
 
-from weakref import WeakValueDictionary
+from collections import OrderedDict
 from copy import copy
 from traceback import format_exc
 from twisted.internet.defer import inlineCallbacks, returnValue
@@ -43,13 +43,20 @@ from django.conf import settings
 from src.comms.channelhandler import CHANNELHANDLER
 from src.utils import logger, utils
 from src.commands.cmdparser import at_multimatch_cmd
-from src.utils.utils import string_suggestions, to_unicode
+from src.utils.utils import to_unicode
 
 from django.utils.translation import ugettext as _
 
 __all__ = ("cmdhandler",)
 _GA = object.__getattribute__
-_CMDSET_MERGE_CACHE = WeakValueDictionary()
+_FLUSH = None
+
+# Cache of merged cmdsets, keyed on the version stamps of the cmdsets
+# going into the merge. This is a LRU cache bounded to
+# settings.CMDSET_MERGE_CACHE_SIZE entries.
+_CMDSET_MERGE_CACHE = OrderedDict()
+_CMDSET_MERGE_CACHE_SIZE = settings.CMDSET_MERGE_CACHE_SIZE
+_CMDSET_MERGE_CACHE_STATS = {"hits": 0, "misses": 0, "evictions": 0}
 
 # This decides which command parser is to be used.
 # You have to restart the server for changes to take effect.
@@ -86,7 +93,26 @@ class ExecSystemCommand(Exception):
         self.syscmd = syscmd
         self.sysarg = sysarg
 
-# Helper function
+# Helper functions
+
+
+def get_merge_cache_stats():
+    """
+    Returns a dict with statistics for the cmdset merge cache, with
+    the keys size, maxsize, hits, misses and evictions.
+    """
+    stats = dict(_CMDSET_MERGE_CACHE_STATS)
+    stats["size"] = len(_CMDSET_MERGE_CACHE)
+    stats["maxsize"] = _CMDSET_MERGE_CACHE_SIZE
+    return stats
+
+
+def _flush_attributes():
+    "Save the in-place changes to Attributes made by a command"
+    global _FLUSH
+    if not _FLUSH:
+        from src.utils.dbserialize import flush as _FLUSH
+    _FLUSH()
 
 
 @inlineCallbacks
@@ -129,16 +155,12 @@ def get_and_merge_cmdsets(caller, session, player, obj,
             location = None
         if location and not obj_cmdset.no_objs:
             # Gather all cmdsets stored on objects in the room and
-            # also in the caller's inventory and the location itself
-            local_objlist = yield (location.contents_get(exclude=obj.dbobj) +
-                                   obj.contents +
-                                   [location])
-            for lobj in local_objlist:
-                try:
-                    # call hook in case we need to do dynamic changing to cmdset
-                    _GA(lobj, "at_cmdset_get")()
-                except Exception:
-                    logger.log_trace()
+            # also in the caller's inventory and the location itself.
+            # The object lists are cached on the location and the caller
+            # respectively, the at_cmdset_get hooks are called when
+            # those caches are rebuilt.
+            local_objlist = yield (location.cmdset_objs_get(exclude=obj.dbobj) +
+                                   obj.cmdset_objs_get(exclude=obj.dbobj))
             # the call-type lock is checked here, it makes sure a player
             # is not seeing e.g. the commands on a fellow player (which is why
             # the no_superuser_bypass must be True)
@@ -208,11 +230,15 @@ def get_and_merge_cmdsets(caller, session, player, obj,
 
     if cmdsets:
         # faster to do tuple on list than to build tuple directly
-        mergehash = tuple([id(cmdset) for cmdset in cmdsets])
-        if mergehash in _CMDSET_MERGE_CACHE:
-            # cached merge exist; use that
-            cmdset = _CMDSET_MERGE_CACHE[mergehash]
+        mergehash = tuple([cmdset.get_version_stamp() for cmdset in cmdsets])
+        cmdset = _CMDSET_MERGE_CACHE.pop(mergehash, None)
+        if cmdset is not None:
+            # cached merge exist; use that and re-insert it last (most
+            # recently used)
+            _CMDSET_MERGE_CACHE[mergehash] = cmdset
+            _CMDSET_MERGE_CACHE_STATS["hits"] += 1
         else:
+            _CMDSET_MERGE_CACHE_STATS["misses"] += 1
             # we group and merge all same-prio cmdsets separately (this avoids
             # order-dependent clashes in certain cases, such as
             # when duplicates=True)
@@ -237,8 +263,11 @@ def get_and_merge_cmdsets(caller, session, player, obj,
                 cmdset = yield merging_cmdset + cmdset
             # store the full sets for diagnosis
             cmdset.merged_from = cmdsets
-            # cache
+            # cache and crop the least recently used merge
             _CMDSET_MERGE_CACHE[mergehash] = cmdset
+            if len(_CMDSET_MERGE_CACHE) > _CMDSET_MERGE_CACHE_SIZE:
+                _CMDSET_MERGE_CACHE.popitem(last=False)
+                _CMDSET_MERGE_CACHE_STATS["evictions"] += 1
     else:
         cmdset = None
 
@@ -351,9 +380,8 @@ def cmdhandler(called_by, raw_string, _testing=False, callertype="session", sess
                 else:
                     # fallback to default error text
                     sysarg = _("Command '%s' is not available.") % raw_string
-                    suggestions = string_suggestions(raw_string,
-                                    cmdset.get_all_cmd_keys_and_aliases(caller),
-                                    cutoff=0.7, maxnum=3)
+                    suggestions = cmdset.get_cmd_suggestions(raw_string, caller,
+                                                             cutoff=0.7, maxnum=3)
                     if suggestions:
                         sysarg += _(" Maybe you meant %s?") % utils.list_to_string(suggestions, _('or'), addquote=True)
                     else:
@@ -390,7 +418,7 @@ def cmdhandler(called_by, raw_string, _testing=False, callertype="session", sess
             if hasattr(cmd, 'obj') and hasattr(cmd.obj, 'scripts'):
                 # cmd.obj is automatically made available by the cmdhandler.
                 # we make sure to validate its scripts.
-                yield cmd.obj.scripts.validate()
+                yield cmd.obj.scripts.validate(force=False)
 
             if _testing:
                 # only return the command instance
@@ -414,6 +442,9 @@ def cmdhandler(called_by, raw_string, _testing=False, callertype="session", sess
             # post-command hook
             yield cmd.at_post_cmd()
 
+            # save the Attribute changes made by the command
+            _flush_attributes()
+
             if cmd.save_for_next:
                 # store a reference to this command, possibly
                 # accessible by the next command.
@@ -441,7 +472,7 @@ def cmdhandler(called_by, raw_string, _testing=False, callertype="session", sess
                 if hasattr(syscmd, 'obj') and hasattr(syscmd.obj, 'scripts'):
                     # cmd.obj is automatically made available.
                     # we make sure to validate its scripts.
-                    yield syscmd.obj.scripts.validate()
+                    yield syscmd.obj.scripts.validate(force=False)
 
                 if _testing:
                     # only return the command instance
@@ -450,6 +481,7 @@ def cmdhandler(called_by, raw_string, _testing=False, callertype="session", sess
                 # parse and run the command
                 yield syscmd.parse()
                 yield syscmd.func()
+                _flush_attributes()
             elif sysarg:
                 # return system arg
                 caller.msg(exc.sysarg)
@@ -51,15 +51,15 @@ def cmdparser(raw_string, cmdset, caller, match_index=None):
 
     matches = []
 
-    # match everything that begins with a matching cmdname.
+    # match everything that begins with a matching cmdname. The cmdset's
+    # prefix index only returns candidates whose key/alias is a prefix
+    # of the input, so arg_regex is only checked on those.
     l_raw_string = raw_string.lower()
-    for cmd in cmdset:
+    for cmdname, cmd in cmdset.match_prefix(l_raw_string):
         try:
-            matches.extend([create_match(cmdname, raw_string, cmd)
-                      for cmdname in [cmd.key] + cmd.aliases
-                        if cmdname and l_raw_string.startswith(cmdname.lower())
-                           and (not cmd.arg_regex or
-                             cmd.arg_regex.match(l_raw_string[len(cmdname):]))])
+            if (not cmd.arg_regex or
+                    cmd.arg_regex.match(l_raw_string[len(cmdname):])):
+                matches.append(create_match(cmdname, raw_string, cmd))
         except Exception:
             log_trace("cmdhandler error. raw_input:%s" % raw_string)
 
@@ -16,10 +16,23 @@ together to create interesting in-game effects.
 
 from weakref import WeakKeyDictionary
 from django.utils.translation import ugettext as _
-from src.utils.utils import inherits_from, is_iter
+from src.utils.utils import inherits_from, is_iter, StringSimilarityIndex
 __all__ = ("CmdSet",)
 
 
+def _obj_stamp(obj):
+    """
+    Identify the object a command is defined on by its database model
+    and id, since the id() of an object may be reused once it is
+    garbage collected. Objects not in the database are used as-is.
+    """
+    dbobj = getattr(obj, "dbobj", None)
+    dbid = getattr(dbobj, "id", None)
+    if dbid is not None:
+        return (dbobj.__class__, dbid)
+    return obj
+
+
 class _CmdSetMeta(type):
     """
     This metaclass makes some minor on-the-fly convenience fixes to
@@ -139,6 +152,15 @@ class CmdSet(object):
     to_duplicate = ("key", "cmdsetobj", "no_exits", "no_objs",
                     "no_channels", "permanent", "mergetype",
                     "priority", "duplicates", "errmessage")
+    # prefix trie of command keys/aliases, built on demand by match_prefix
+    _match_index = None
+    # similarity index of command keys/aliases, built on demand by get_cmd_suggestions
+    _suggestion_index = None
+    # unique auto_help commands, cached by src.help.helpindex
+    _help_cache = None
+    # bumped by add/remove; part of the version stamp used for merge caching
+    _mutation_count = 0
+    _stamp_cache = None
 
     def __init__(self, cmdsetobj=None, key=None):
         """
@@ -365,6 +387,9 @@ class CmdSet(object):
             cmds = [self._instantiate(cmd)]
         commands = self.commands
         system_commands = self.system_commands
+        self._match_index = None
+        self._suggestion_index = None
+        self._mutation_count += 1
         for cmd in cmds:
             # add all commands
             if not hasattr(cmd, 'obj'):
@@ -393,6 +418,9 @@ class CmdSet(object):
         """
         cmd = self._instantiate(cmd)
         self.commands = [oldcmd for oldcmd in self.commands if oldcmd != cmd]
+        self._match_index = None
+        self._suggestion_index = None
+        self._mutation_count += 1
 
     def get(self, cmd):
         """
@@ -438,6 +466,84 @@ class CmdSet(object):
                 unique[cmd.key] = cmd
         self.commands = unique.values()
 
+    def _build_match_index(self):
+        """
+        Build a case-folded prefix trie of all command keys and aliases
+        in this cmdset. The trie is a tree of nested dicts keyed on
+        single characters; the None-key of a node holds a list of
+        (position, cmdname, cmd) for all names ending at that node.
+        The index is stored together with the commands list it was
+        built from, so that it is rebuilt if the list is replaced.
+        """
+        trie = {}
+        for icmd, cmd in enumerate(self.commands):
+            for iname, cmdname in enumerate([cmd.key] + cmd.aliases):
+                if not cmdname:
+                    continue
+                node = trie
+                for char in cmdname.lower():
+                    node = node.setdefault(char, {})
+                node.setdefault(None, []).append(((icmd, iname), cmdname, cmd))
+        self._match_index = (self.commands, trie)
+        return trie
+
+    def match_prefix(self, string):
+        """
+        Return a list of (cmdname, cmd) for all command keys and
+        aliases in this cmdset that are prefixes of string. This
+        makes use of a cached prefix trie, so the cost depends on the
+        length of string rather than on the number of commands in
+        the set. The matches are returned in the same order as they
+        appear in the cmdset.
+
+        string (str) - the string to match. Should be lower case.
+        """
+        index = self._match_index
+        if index and index[0] is self.commands:
+            trie = index[1]
+        else:
+            trie = self._build_match_index()
+        found = []
+        node = trie
+        for char in string:
+            node = node.get(char)
+            if node is None:
+                break
+            if None in node:
+                found.extend(node[None])
+        found.sort(key=lambda tup: tup[0])
+        return [(cmdname, cmd) for pos, cmdname, cmd in found]
+
+    def get_version_stamp(self):
+        """
+        Returns a hashable stamp describing the current content of this
+        cmdset. Two cmdsets with the same stamp merge the same way, which
+        allows the cmdhandler to cache merges on content rather than on
+        the identity of the cmdset instances.
+
+        The stamp holds the merge properties of the set, a frozenset
+        describing its commands (their class, key, aliases, locks and
+        the database object they are defined on) and a mutation counter
+        bumped by add() and remove(). The command set is only rebuilt if
+        the counter changed or if the commands list was replaced.
+        """
+        commands = self.commands
+        cache = self._stamp_cache
+        if cache and cache[0] == self._mutation_count and cache[1] is commands:
+            cmdstamp = cache[2]
+        else:
+            # order-independent, since add() does not preserve order
+            cmdstamp = frozenset((cmd.__class__, cmd.key,
+                                  frozenset(cmd._matchset),
+                                  cmd.lock_storage,
+                                  _obj_stamp(getattr(cmd, "obj", None)))
+                                 for cmd in commands)
+            self._stamp_cache = (self._mutation_count, commands, cmdstamp)
+        return (self.key, self.priority, self.mergetype, self.duplicates,
+                self.no_exits, self.no_objs, self.no_channels,
+                tuple(sorted(self.key_mergetypes.items())),
+                len(commands), cmdstamp, self._mutation_count)
+
     def get_all_cmd_keys_and_aliases(self, caller=None):
         """
         Returns a list of all command keys and aliases
@@ -453,6 +559,41 @@ class CmdSet(object):
             [names.extend(cmd._keyaliases) for cmd in self.commands]
         return names
 
+    def get_cmd_suggestions(self, string, caller=None, cutoff=0.6, maxnum=3):
+        """
+        Returns the command keys and aliases in this cmdset most
+        similar to string. This gives the same result as
+
+            string_suggestions(string, self.get_all_cmd_keys_and_aliases(caller),
+                               cutoff=cutoff, maxnum=maxnum)
+
+        but makes use of a cached StringSimilarityIndex of the keys and
+        aliases, rebuilt only when the commands change. If caller is
+        given, access is only checked for the commands suggested.
+        """
+        index = self._suggestion_index
+        if not index or index[0] is not self.commands:
+            cmds, names = [], []
+            for cmd in self.commands:
+                cmds.extend([cmd] * len(cmd._keyaliases))
+                names.extend(cmd._keyaliases)
+            index = (self.commands, cmds, StringSimilarityIndex(names))
+            self._suggestion_index = index
+        cmds, simindex = index[1], index[2]
+        access = {}
+        suggestions = []
+        for ipos in simindex.match(string, cutoff):
+            if maxnum is not None and len(suggestions) >= maxnum:
+                break
+            if caller:
+                cmd = cmds[ipos]
+                if id(cmd) not in access:
+                    access[id(cmd)] = cmd.access(caller)
+                if not access[id(cmd)]:
+                    continue
+            suggestions.append(simindex.vocabulary[ipos])
+        return suggestions
+
     def at_cmdset_creation(self):
         """
         Hook method - this should be overloaded in the inheriting
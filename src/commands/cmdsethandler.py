@@ -72,6 +72,8 @@ from django.utils.translation import ugettext as _
 __all__ = ("import_cmdset", "CmdSetHandler")
 
 _CACHED_CMDSETS = {}
+_GA = object.__getattribute__
+_SA = object.__setattr__
 _CMDSET_PATHS = utils.make_iter(settings.CMDSET_PATHS)
 
 class _ErrorCmdSet(CmdSet):
@@ -277,6 +279,16 @@ class CmdSetHandler(object):
             self.mergetype_stack.append(new_current.actual_mergetype)
         self.current = new_current
 
+        # flag the cached cmdset-objects of this object and its location
+        # as dirty (this only applies to in-game objects).
+        try:
+            location = _GA(self.obj, "db_location")
+        except AttributeError:
+            return
+        _SA(self.obj, "cmdset_objs_dirty", True)
+        if location:
+            _SA(location, "cmdset_objs_dirty", True)
+
     def add(self, cmdset, emit_to_obj=None, permanent=False):
         """
         Add a cmdset to the handler, on top of the old ones.
@@ -11,7 +11,7 @@ from src.utils.utils import fill, dedent
 from src.commands.command import Command
 from src.help.models import HelpEntry
 from src.utils import create
-from src.utils.utils import string_suggestions
+from src.help.helpindex import HELP_INDEX
 from src.commands.default.muxcommand import MuxCommand
 
 # limit symbol import for API
@@ -99,32 +99,31 @@ class CmdHelp(Command):
         if not query:
             query = "all"
 
-        # removing doublets in cmdset, caused by cmdhandler
-        # having to allow doublet commands to manage exits etc.
-        cmdset.make_unique(caller)
-
-        # retrieve all available commands and database topics
-        all_cmds = [cmd for cmd in cmdset if cmd.auto_help and cmd.access(caller)]
-        all_topics = [topic for topic in HelpEntry.objects.all() if topic.access(caller, 'view', default=True)]
-        all_categories = list(set([cmd.help_category.lower() for cmd in all_cmds] + [topic.help_category.lower() for topic in all_topics]))
+        # retrieve all available commands and database topics. This
+        # weeds out the doublet commands in cmdset (caused by the
+        # cmdhandler having to allow doublet commands to manage exits
+        # etc) and is cached per cmdset, help database and permissions.
+        view = HELP_INDEX.get_view(caller, cmdset)
+        all_cmds, all_topics, all_categories = view.cmds, view.topics, view.categories
 
         if query in ("list", "all"):
             # we want to list all available help entries, grouped by category
-            hdict_cmd = defaultdict(list)
-            hdict_topic = defaultdict(list)
-            # create the dictionaries {category:[topic, topic ...]} required by format_help_list
-            [hdict_cmd[cmd.help_category].append(cmd.key) for cmd in all_cmds]
-            [hdict_topic[topic.help_category].append(topic.key) for topic in all_topics]
+            if view.list_text is None:
+                hdict_cmd = defaultdict(list)
+                hdict_topic = defaultdict(list)
+                # create the dictionaries {category:[topic, topic ...]} required by format_help_list
+                [hdict_cmd[cmd.help_category].append(cmd.key) for cmd in all_cmds]
+                [hdict_topic[topic.help_category].append(topic.key) for topic in all_topics]
+                view.list_text = format_help_list(hdict_cmd, hdict_topic)
             # report back
-            self.msg(format_help_list(hdict_cmd, hdict_topic))
+            self.msg(view.list_text)
             return
 
         # Try to access a particular command
 
-        # build vocabulary of suggestions and rate them by string similarity.
-        vocabulary = [cmd.key for cmd in all_cmds if cmd] + [topic.key for topic in all_topics] + all_categories
-        [vocabulary.extend(cmd.aliases) for cmd in all_cmds]
-        suggestions = [sugg for sugg in string_suggestions(query, set(vocabulary), cutoff=suggestion_cutoff, maxnum=suggestion_maxnum)
+        # rate the vocabulary of suggestions by string similarity.
+        vocabulary = view.vocabulary
+        suggestions = [sugg for sugg in view.suggestion_index.suggestions(query, cutoff=suggestion_cutoff, maxnum=suggestion_maxnum)
                        if sugg != query]
         if not suggestions:
             suggestions = [sugg for sugg in vocabulary if sugg != query and sugg.startswith(query)]
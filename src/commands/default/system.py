@@ -16,6 +16,7 @@ from django.conf import settings
 #from src.server.caches import get_cache_sizes
 from src.server.sessionhandler import SESSIONS
 from src.scripts.models import ScriptDB
+from src.scripts.timerwheel import TIMER_WHEEL
 from src.objects.models import ObjectDB
 from src.players.models import PlayerDB
 from src.utils import logger, utils, gametime, create, is_pypy, prettytable
@@ -698,6 +699,8 @@ class CmdServerLoad(MuxCommand):
         loadtable.add_row(["Disk I/O", "%g reads, %g writes" % (rusage.ru_inblock, rusage.ru_oublock)])
         loadtable.add_row(["Network I/O", "%g in, %g out" % (rusage.ru_msgrcv, rusage.ru_msgsnd)])
         loadtable.add_row(["Context switching", "%g vol, %g forced, %g signals" % (rusage.ru_nvcsw, rusage.ru_nivcsw, rusage.ru_nsignals)])
+        wheel = TIMER_WHEEL.stats()
+        loadtable.add_row(["Timers (scripts/tickers)", "%i scheduled, %i callbacks last tick (max %i), %i overruns" % (wheel["tasks"], wheel["callbacks_last_tick"], wheel["max_callbacks_per_tick"], wheel["overruns"])])
 
         string = "{wServer CPU and Memory load:{n\n%s" % loadtable
 
@@ -706,17 +709,23 @@ class CmdServerLoad(MuxCommand):
             # because it lacks sys.getsizeof
 
             # object cache size
-            total_num, cachedict = _idmapper.cache_size()
-            sorted_cache = sorted([(key, num) for key, num in cachedict.items() if num > 0],
-                                    key=lambda tup: tup[1], reverse=True)
+            total_num, cachedict = _idmapper.cache_size(stats=True)
+            sorted_cache = sorted([(key, tup) for key, tup in cachedict.items() if tup[0] > 0],
+                                    key=lambda tup: tup[1][0], reverse=True)
             memtable = prettytable.PrettyTable(["entity name",
                                                 "number",
-                                                "idmapper %%"])
+                                                "idmapper %%",
+                                                "hits",
+                                                "misses",
+                                                "evictions"])
             memtable.align = 'l'
-            for tup in sorted_cache:
-                memtable.add_row([tup[0],
+            for key, tup in sorted_cache:
+                memtable.add_row([key,
+                                 "%i" % tup[0],
+                                 "%.2f" % (float(tup[0]) / total_num * 100),
                                  "%i" % tup[1],
-                                 "%.2f" % (float(tup[1]) / total_num * 100)])
+                                 "%i" % tup[2],
+                                 "%i" % tup[3]])
 
             # get sizes of other caches
             string += "\n{w Entity idmapper cache:{n %i items\n%s" % (total_num, memtable)
@@ -14,12 +14,18 @@ main test suite started with
 
 import re
 from django.conf import settings
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.utils.unittest import TestCase
 from src.server.serversession import ServerSession
 from src.objects.objects import Object, Character
+from src.objects.models import ObjectDB
 from src.players.player import Player
 from src.utils import create, ansi
 from src.server.sessionhandler import SESSIONS
+from src.help.helpindex import HELP_INDEX
+from src.commands import cmdhandler as cmdhandler_module
+from src.commands.cmdhandler import cmdhandler, get_merge_cache_stats
 
 from django.db.models.signals import post_save
 from src.server.caches import field_post_save
@@ -182,6 +188,31 @@ class TestHelp(CommandTest):
         self.call(help.CmdHelp(), "testhelp", "Help topic for testhelp", cmdset=CharacterCmdSet())
 
 
+class TestHelpIndex(CommandTest):
+    CID = 13
+    def test_help_index(self):
+        cmdset = CharacterCmdSet()
+        self.call(help.CmdHelp(), "all", "Command help entries", cmdset=cmdset)
+        self.call(help.CmdHelp(), "lok", "No help entry found for 'lok'\n\nSuggested: look",
+                  cmdset=cmdset)
+        view = HELP_INDEX.get_view(self.char1, cmdset)
+        self.char2.permissions.add("Immortals")
+        self.char2.player.permissions.add("Immortals")
+        with CaptureQueriesContext(connection) as queries:
+            self.call(help.CmdHelp(), "all", "Command help entries", cmdset=cmdset)
+            # callers with the same permissions share the view
+            self.assertTrue(view is HELP_INDEX.get_view(self.char2, CharacterCmdSet()))
+        self.assertEqual(0, len(queries), [q["sql"] for q in queries.captured_queries])
+        self.call(help.CmdSetHelp(), "secret, General, view:perm(Wizards) = Hush",
+                  "Topic 'secret' was successfully created.")
+        self.assertTrue("secret" in [topic.key for topic in HELP_INDEX.get_view(self.char1, cmdset).topics])
+        self.char2.permissions.remove("Immortals")
+        self.char2.player.permissions.remove("Immortals")
+        view = HELP_INDEX.get_view(self.char2, cmdset)
+        self.assertFalse("secret" in [topic.key for topic in view.topics])
+        self.assertFalse("@dig" in [cmd.key for cmd in view.cmds])
+
+
 from src.commands.default import system
 class TestSystem(CommandTest):
     CID = 3
@@ -284,3 +315,238 @@ class TestBatchProcess(CommandTest):
         # cannot test batchcode here, it must run inside the server process
         self.call(batchprocess.CmdBatchCommands(), "examples.batch_cmds", "Running Batchcommand processor  Automatic mode for examples.batch_cmds")
         #self.call(batchprocess.CmdBatchCode(), "examples.batch_code", "")
+
+
+class TestScriptValidation(CommandTest):
+    CID = 9
+    def _count_queries(self, raw_string, invalidate=False):
+        "count the db queries needed to get a command ready for execution"
+        if invalidate:
+            self.char1.scripts.invalidate()
+        with CaptureQueriesContext(connection) as context:
+            cmdhandler(self.char1, raw_string, _testing=True, callertype="object")
+        return len(context.captured_queries)
+
+    def test_validation(self):
+        self._count_queries("look")
+        # old behaviour - validate the scripts for every command
+        before = self._count_queries("look", invalidate=True)
+        after = self._count_queries("look")
+        self.assertTrue(after < before, "%i queries, expected less than %i" % (after, before))
+        # adding a script makes the next command validate again
+        script = create.create_script("src.scripts.scripts.Script", key="TestScript9", obj=self.char1, autostart=False)
+        self.assertTrue(self._count_queries("look") >= before)
+        self.assertTrue(script.is_active)
+        self.assertEqual(self._count_queries("look"), after)
+        # as does moving (bypassing move hooks, which would run look)
+        self.char1.location = self.room2
+        self.assertTrue(self._count_queries("look") >= before)
+        self.assertEqual(self._count_queries("look"), after)
+        script.stop()
+        self.assertFalse(self.char1.scripts.all())
+        self.assertTrue(self._count_queries("look") >= before)
+
+
+class TestReceiverClass(Character):
+    def at_msg_receive(self, text=None, **kwargs):
+        "count received messages"
+        self.ndb.received = (self.ndb.received or 0) + 1
+        return True
+
+
+class _AMPRecorder(object):
+    "fake amp connection storing the messages sent to the Portal"
+    def __init__(self):
+        self.amp_protocol = self
+        self.sent = []
+
+    def call_remote_MsgServer2Portal(self, sessid, msg, data=""):
+        self.sent.append((sessid, msg, data))
+
+
+class TestMsgContents(CommandTest):
+    CID = 10
+    def setUp(self):
+        super(TestMsgContents, self).setUp()
+        self.receivers = []
+        for sessid, encoding in ((101, "utf-8"), (102, "utf-8"), (103, "latin-1")):
+            session = ServerSession()
+            session.init_session("telnet", ("localhost", "testmode"), SESSIONS)
+            session.sessid = sessid
+            SESSIONS.portal_connect(session.get_sync_data())
+            SESSIONS.session_from_sessid(sessid).encoding = encoding
+            receiver = create.create_object(TestReceiverClass, key="Receiver%i" % sessid,
+                                            location=self.room1, home=self.room1)
+            receiver.sessid.add(sessid)
+            self.receivers.append(receiver)
+        self.player.ndb.stored_msg = []
+        self.server, SESSIONS.server = SESSIONS.server, _AMPRecorder()
+
+    def tearDown(self):
+        SESSIONS.server = self.server
+
+    def test_msg_contents(self):
+        for receiver in self.receivers:
+            receiver.ndb.received = None
+        self.room1.msg_contents(u"Hello {rw\xf6rld{n!", exclude=self.receivers[1], custom=1)
+        self.assertEqual([1, None, 1], [receiver.ndb.received for receiver in self.receivers])
+        # the characters with a custom msg() are still sent to separately
+        self.assertIn(u"Hello {rw\xf6rld{n!", self.player.ndb.stored_msg)
+        sent = SESSIONS.server.sent
+        self.assertEqual([101, 103], sorted(rec[0] for rec in sent))
+        texts = dict((rec[0], rec[1]) for rec in sent)
+        self.assertEqual(u"Hello {rw\xf6rld{n!".encode("utf-8"), texts[101])
+        self.assertEqual(u"Hello {rw\xf6rld{n!".encode("latin-1"), texts[103])
+        self.assertEqual({"custom": 1}, sent[0][2])
+        SESSIONS.server.sent = []
+        self.room1.msg_contents("Hello world!")
+        sent = dict((rec[0], rec) for rec in SESSIONS.server.sent)
+        # sessions with the same encoding share the same objects
+        self.assertTrue(sent[101][1] is sent[102][1])
+        self.assertTrue(sent[101][2] is sent[102][2])
+
+
+class TestObjectSearch(CommandTest):
+    CID = 11
+    def test_local_search(self):
+        sword1 = create.create_object(TestObjectClass, key="Big shiny sword", aliases=["blade"],
+                                      location=self.room1, home=self.room1)
+        sword2 = create.create_object(TestObjectClass, key="Small sword", aliases=["dagger", "Knife"],
+                                      location=self.room1, home=self.room1)
+        candidates = [obj.dbobj for obj in self.room1.contents]
+        search = lambda searchdata, exact=True: ObjectDB.objects.object_search(
+                            searchdata, candidates=candidates, exact=exact)
+        self.assertEqual([sword2], search("dagger"))
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual([self.obj1], search("obj11"))
+            self.assertEqual([sword1], search("BLADE"))
+            self.assertEqual([sword2], search("knife"))
+            self.assertEqual([], search("sword"))
+            # partial matching of keys, then of aliases
+            self.assertEqual([sword1], search("bi sw", exact=False))
+            self.assertEqual([sword1, sword2], search("sword", exact=False))
+            self.assertEqual([sword2], search("dag", exact=False))
+            self.assertEqual([sword2], search("2-sword", exact=False))
+        # the candidates and their aliases are already cached
+        self.assertEqual(0, len(queries), [q["sql"] for q in queries.captured_queries])
+        self.assertEqual(self.obj1, self.char1.search("Obj11"))
+        self.assertEqual(sword1, self.char1.search("blade"))
+
+
+class TestContentsIndex(CommandTest):
+    CID = 12
+    def test_contents_index(self):
+        ObjectDB.objects.preload_contents([self.room1, self.room2])
+        def contents(location):
+            "get contents and exits without querying the database"
+            with CaptureQueriesContext(connection) as queries:
+                result = (location.contents, location.exits)
+            self.assertEqual(0, len(queries), [q["sql"] for q in queries.captured_queries])
+            return result
+        self.assertEqual((ObjectDB.objects.get_contents(self.room1.dbobj), []), contents(self.room1))
+        self.assertEqual(([], []), contents(self.room2))
+        self.obj1.move_to(self.room2, quiet=True)
+        self.assertEqual(([self.obj1], []), contents(self.room2))
+        self.assertFalse(self.obj1 in contents(self.room1)[0])
+        exit = create.create_object("src.objects.objects.Exit", key="out", location=self.room1,
+                                    destination=self.room2)
+        self.assertEqual([exit], contents(self.room1)[1])
+        self.assertEqual(exit, contents(self.room1)[0][-1])
+        exit.destination = None
+        self.assertEqual([], contents(self.room1)[1])
+        exit.delete()
+        del self.obj1.dbobj.location
+        self.assertEqual(ObjectDB.objects.get_contents(self.room1.dbobj), contents(self.room1)[0])
+        self.assertEqual(([], []), contents(self.room2))
+
+
+class TestBatchCreate(CommandTest):
+    CID = 14
+    def test_batch_create(self):
+        deleted = create.create_object(TestObjectClass, key="Deleted14", location=self.room1)
+        deleted_id = deleted.dbid
+        deleted.delete()
+        dbobjs = ObjectDB.batch_create(ObjectDB(db_key="Batch14-%i" % i) for i in range(3))
+        ids = [dbobj.id for dbobj in dbobjs]
+        # the dbref of the deleted object is never handed out again
+        self.assertTrue(min(ids) > deleted_id, "%s reuses %i" % (ids, deleted_id))
+        self.assertEqual(3, len(set(ids)))
+        self.assertEqual(ids, [dbobj.id for dbobj in ObjectDB.objects.filter(db_key__startswith="Batch14")])
+        self.assertTrue(all(ObjectDB.get_cached_instance(dbid) is dbobj for dbid, dbobj in zip(ids, dbobjs)))
+        # nor do normal saves reuse the reserved pks
+        self.assertTrue(create.create_object(TestObjectClass, key="Saved14").dbid > max(ids))
+        # backends without reservable pks save one by one
+        ObjectDB._reserve_pks = classmethod(lambda cls, using, num: None)
+        try:
+            dbobjs = ObjectDB.batch_create(ObjectDB(db_key="Fallback14-%i" % i) for i in range(2))
+        finally:
+            del ObjectDB._reserve_pks
+        self.assertTrue(all(dbobj.id for dbobj in dbobjs))
+        self.assertEqual(2, ObjectDB.objects.filter(db_key__startswith="Fallback14").count())
+
+
+class TestIdmapperEviction(CommandTest):
+    CID = 15
+    def test_eviction(self):
+        # caching new instances never evicts anything
+        maxnum = ObjectDB._idmapper_cache_max_entries
+        ObjectDB._idmapper_cache_max_entries = 1
+        try:
+            obj = create.create_object(TestObjectClass, key="Obj15c", location=self.room2)
+        finally:
+            ObjectDB._idmapper_cache_max_entries = maxnum
+        self.assertTrue(ObjectDB.get_cached_instance(obj.dbid) is obj.dbobj)
+        self.assertTrue(self.obj1.dbid in ObjectDB.__instance_cache__)
+        # evict everything that can be evicted (two passes for the second chance)
+        self.char1.dbobj.set_recache_protection()
+        try:
+            for _ in range(2):
+                ObjectDB.evict_instances(len(ObjectDB.__instance_cache__))
+            cache = ObjectDB.__instance_cache__
+            self.assertTrue(self.char1.dbid in cache)
+            # the location of a protected object is protected too
+            self.assertTrue(self.room1.dbid in cache)
+            self.assertFalse(self.obj2.dbid in cache)
+            self.assertFalse(self.room2.dbid in cache)
+        finally:
+            self.char1.dbobj.set_recache_protection(False)
+        # evicted instances still in use are not loaded a second time
+        self.assertTrue(ObjectDB.objects.get(id=self.room2.dbid) is self.room2.dbobj)
+        obj2 = ObjectDB.objects.get(id=self.obj2.dbid)
+        self.assertTrue(obj2 is self.obj2.dbobj)
+        self.assertTrue(self.obj2.dbid in ObjectDB.__instance_cache__)
+        obj2.location = self.room2
+        self.assertFalse(self.obj2 in self.room1.contents)
+        self.assertTrue(self.obj2 in self.room2.contents)
+        self.assertEqual(ObjectDB.objects.get_contents(self.room1.dbobj), self.room1.contents)
+
+
+class TestCmdsetMergeCache(CommandTest):
+    CID = 16
+    def _merge(self, obj):
+        "merge the cmdsets of obj, returning the merged cmdset"
+        merged = []
+        cmdhandler_module.get_and_merge_cmdsets(obj, None, None, obj, "object").addCallback(merged.append)
+        return merged[0]
+
+    def test_merge_cache(self):
+        self.assertEqual(settings.CMDSET_MERGE_CACHE_SIZE, get_merge_cache_stats()["maxsize"])
+        cmdhandler_module._CMDSET_MERGE_CACHE.clear()
+        stats = get_merge_cache_stats()
+        cmdset = self._merge(self.char1)
+        self.assertEqual(cmdset, self._merge(self.char1))
+        after = get_merge_cache_stats()
+        self.assertEqual(stats["misses"] + 1, after["misses"])
+        self.assertEqual(stats["hits"] + 1, after["hits"])
+        self.assertEqual(1, after["size"])
+        # the least recently used merge is evicted when the cache is full
+        maxsize = cmdhandler_module._CMDSET_MERGE_CACHE_SIZE
+        cmdhandler_module._CMDSET_MERGE_CACHE_SIZE = 1
+        try:
+            self._merge(self.char2)
+            self.assertEqual(1, get_merge_cache_stats()["size"])
+            self.assertEqual(after["evictions"] + 1, get_merge_cache_stats()["evictions"])
+            self._merge(self.char1)
+            self.assertEqual(after["misses"] + 2, get_merge_cache_stats()["misses"])
+        finally:
+            cmdhandler_module._CMDSET_MERGE_CACHE_SIZE = maxsize
@@ -6,7 +6,10 @@ See objects.objects for more information on Typeclassing.
 from src.comms import Msg, TempMsg
 from src.typeclasses.typeclass import TypeClass
 from src.utils import logger
-from src.utils.utils import make_iter
+from src.utils.utils import make_iter, to_str
+
+_SESSIONS = None
+_PLAYER_MSG = None
 
 
 class Channel(TypeClass):
@@ -164,16 +167,35 @@ class Channel(TypeClass):
         """
         Method for grabbing all listeners that a message should be sent to on
         this channel, and sending them a message.
-        """
+
+        Players that don't overload msg() on their typeclass get the
+        message sent to all their sessions in one go, so it is only
+        converted once per encoding and shared in the batch sent to
+        the Portal.
+        """
+        global _SESSIONS, _PLAYER_MSG
+        if not _SESSIONS:
+            from src.server.sessionhandler import SESSIONS as _SESSIONS
+        if not _PLAYER_MSG:
+            from src.players.player import Player
+            _PLAYER_MSG = Player.msg.im_func
+        text = to_str(msg.message, force_string=True) if msg.message else ""
+        # note our addition of the from_channel keyword here. This could be checked
+        # by a custom player.msg() to treat channel-receives differently.
+        kwargs = {"from_channel": self.id}
+        sessions = []
         # get all players connected to this channel and send to them
         for player in self.dbobj.db_subscriptions.all():
             player = player.typeclass
             try:
-                # note our addition of the from_channel keyword here. This could be checked
-                # by a custom player.msg() to treat channel-receives differently.
-                player.msg(msg.message, from_obj=msg.senders, from_channel=self.id)
+                if getattr(type(player).msg, "im_func", None) is _PLAYER_MSG:
+                    sessions.extend(player.dbobj._msg_sessions(text, msg.senders, None, kwargs))
+                else:
+                    player.msg(msg.message, from_obj=msg.senders, **kwargs)
             except AttributeError, e:
                 logger.log_trace("%s\nCannot send msg to player '%s'." % (e, player))
+        if sessions:
+            _SESSIONS.data_out_multi(sessions, text=text, **kwargs)
 
     def msg(self, msgobj, header=None, senders=None, sender_strings=None,
             persistent=False, online=False, emit=False, external=False):
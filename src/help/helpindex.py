@@ -0,0 +1,204 @@
+"""
+Help index
+
+The help command needs the commands and help entries a caller has
+access to, which means lock-checking every command of the caller's
+cmdset and every help entry in the database. The HelpIndex caches
+what goes into this:
+
+ - The unique commands of a merged cmdset are collected once per
+   version of the cmdset (see CmdSet.get_version_stamp).
+ - The help entries are loaded once per version of the help
+   database, which is bumped whenever a HelpEntry is saved or deleted.
+ - Most help locks only use lock functions marked as permission_only
+   (like all() and perm()), which give the same result for everyone
+   with the same permissions. Their results are memoized per
+   permission profile (see get_permission_profile).
+ - If all locks involved are like that, the HelpView of a caller (the
+   commands, entries and categories available, the suggestion index
+   and the rendered "help all" list) is shared with all callers having
+   the same permissions.
+
+The index is used through the instantiated HELP_INDEX:
+
+    from src.help.helpindex import HELP_INDEX
+
+    view = HELP_INDEX.get_view(caller, cmdset)
+
+"""
+from django.db.models.signals import post_save, post_delete
+from src.commands.command import Command
+from src.help.models import HelpEntry
+from src.utils.utils import inherits_from, StringSimilarityIndex
+
+__all__ = ("HELP_INDEX", "HelpView", "get_permission_profile")
+
+_COMMAND_ACCESS = Command.access.im_func
+_ACCESS_CACHE_SIZE = 5000
+_VIEW_CACHE_SIZE = 100
+
+
+def get_permission_profile(caller):
+    """
+    Returns a hashable summary of what lock functions marked as
+    permission_only look at on caller: its superuser bypass, its
+    permissions and, for Objects, the permissions of its Player and
+    whether these are quelled. Returns None for callers without
+    permissions.
+    """
+    try:
+        profile = (bool(caller.locks.lock_bypass),
+                   frozenset(perm.lower() for perm in caller.permissions.all()))
+    except AttributeError:
+        return None
+    if inherits_from(caller, "src.objects.objects.Object"):
+        player = caller.player
+        if player:
+            return profile + (True, frozenset(perm.lower() for perm in player.permissions.all()),
+                              bool(player.attributes.get("_quell")))
+        return profile + (True, None, None)
+    return profile + (False, None, None)
+
+
+def _lock_signature(lockhandler, access_type):
+    """
+    Returns the lock definition of access_type ("" if there is none),
+    or None if it uses lock functions not marked as permission_only.
+    """
+    lock = lockhandler.locks.get(access_type)
+    if lock is None:
+        return ""
+    if all(getattr(tup[0], "permission_only", False) for tup in lock[1]):
+        return lock[2]
+    return None
+
+
+class HelpView(object):
+    """
+    The commands and help entries available to a caller, with the
+    help categories and the vocabulary of help suggestions. The
+    "help all" list is stored on it as list_text when first rendered.
+    """
+    def __init__(self, cmds, topics):
+        self.cmds = cmds
+        self.topics = topics
+        self.categories = list(set([cmd.help_category.lower() for cmd in cmds] +
+                                   [topic.help_category.lower() for topic in topics]))
+        vocabulary = [cmd.key for cmd in cmds] + [topic.key for topic in topics] + self.categories
+        [vocabulary.extend(cmd.aliases) for cmd in cmds]
+        self.vocabulary = vocabulary
+        self.suggestion_index = StringSimilarityIndex(set(vocabulary))
+        self.list_text = None
+
+
+class HelpIndex(object):
+    """
+    Caches the commands and help entries available to callers of the
+    help command. See the module docstring.
+    """
+    def __init__(self):
+        self.db_version = 0
+        self._topics = (None, [], False)
+        self._access = {}
+        self._views = {}
+
+    def at_helpentry_change(self, *args, **kwargs):
+        "Called when a HelpEntry is saved or deleted"
+        self.db_version += 1
+        self._topics = (None, [], False)
+
+    def get_topics(self):
+        """
+        Returns a list of (helpentry, locksignature) for all help
+        entries in the database, and if all their view locks are
+        permission_only.
+        """
+        version, topics, permission_only = self._topics
+        if version != self.db_version:
+            topics = [(topic, _lock_signature(topic.locks, "view"))
+                      for topic in HelpEntry.objects.all()]
+            permission_only = all(locksig is not None for topic, locksig in topics)
+            self._topics = (self.db_version, topics, permission_only)
+        return topics, permission_only
+
+    def get_commands(self, cmdset, caller):
+        """
+        Returns the unique auto_help commands of a merged cmdset as a
+        list of (cmd, locksignature), along with a key describing their
+        help (None if any of them have locks that are not
+        permission_only).
+
+        Where a command key appears more than once in cmdset, the
+        command defined on caller is preferred, otherwise the first.
+        The result is cached on the cmdset.
+        """
+        stamp = (cmdset.get_version_stamp(), id(caller))
+        cached = cmdset._help_cache
+        if cached and cached[0] == stamp:
+            return cached[1], cached[2]
+        unique = {}
+        for cmd in cmdset.commands:
+            if cmd.key in unique:
+                ocmd = unique[cmd.key]
+                if (hasattr(cmd, 'obj') and cmd.obj == caller) and not \
+                        (hasattr(ocmd, 'obj') and ocmd.obj == caller):
+                    unique[cmd.key] = cmd
+            else:
+                unique[cmd.key] = cmd
+        cmds = []
+        for cmd in unique.values():
+            if cmd.auto_help:
+                # a custom access() can't be memoized
+                custom = type(cmd).access.im_func is not _COMMAND_ACCESS
+                cmds.append((cmd, None if custom else _lock_signature(cmd.lockhandler, "cmd")))
+        key = None
+        if all(locksig is not None for cmd, locksig in cmds):
+            key = frozenset((cmd.__class__, cmd.key, tuple(cmd.aliases), cmd.help_category, locksig)
+                            for cmd, locksig in cmds)
+        cmdset._help_cache = (stamp, cmds, key)
+        return cmds, key
+
+    def check_access(self, caller, profile, obj, locksig, access_type, default):
+        """
+        Check access to a command or help entry, memoizing the result
+        per permission profile if the lock signature allows it.
+        """
+        if profile is None or locksig is None:
+            return obj.access(caller, access_type, default=default)
+        key = (profile, locksig, access_type, default)
+        result = self._access.get(key)
+        if result is None:
+            result = bool(obj.access(caller, access_type, default=default))
+            if len(self._access) >= _ACCESS_CACHE_SIZE:
+                self._access = {}
+            self._access[key] = result
+        return result
+
+    def get_view(self, caller, cmdset):
+        """
+        Returns the HelpView of caller with the given merged cmdset.
+        """
+        profile = get_permission_profile(caller)
+        cmds, cmdkey = self.get_commands(cmdset, caller)
+        topics, permission_only = self.get_topics()
+        viewkey = None
+        if profile is not None and cmdkey is not None and permission_only:
+            viewkey = (cmdkey, self.db_version, profile)
+            view = self._views.get(viewkey)
+            if view:
+                return view
+        check_access = self.check_access
+        view = HelpView([cmd for cmd, locksig in cmds
+                         if check_access(caller, profile, cmd, locksig, "cmd", False)],
+                        [topic for topic, locksig in topics
+                         if check_access(caller, profile, topic, locksig, "view", True)])
+        if viewkey:
+            if len(self._views) >= _VIEW_CACHE_SIZE:
+                self._views = {}
+            self._views[viewkey] = view
+        return view
+
+
+HELP_INDEX = HelpIndex()
+post_save.connect(HELP_INDEX.at_helpentry_change, sender=HelpEntry, dispatch_uid="helpindex")
+post_delete.connect(HELP_INDEX.at_helpentry_change, sender=HelpEntry, dispatch_uid="helpindex")
@@ -524,3 +524,28 @@ def serversetting(accessing_obj, accessed_obj, *args, **kwargs):
     if setting in settings._wrapped.__dict__:
         return settings._wrapped.__dict__[setting] == val
     return False
+
+
+# Lock functions whose result only depends on the identity,
+# permissions, tags and Attributes of accessing_obj (and its Player)
+# and accessed_obj are marked as cacheable. Custom lock functions are
+# never cached unless they also set cacheable = True. Functions
+# checking other entities, such as the location or contents, must not
+# be marked. Note that attr() also checks normal properties on
+# accessing_obj; changes to those are not tracked by the cache.
+for _lockfunc in (true, all, false, none, self, perm, perm_above, pperm,
+                  pperm_above, dbref, pdbref, id, pid, attr, attr_eq,
+                  attr_gt, attr_ge, attr_lt, attr_le, attr_ne, superuser,
+                  serversetting):
+    _lockfunc.cacheable = True
+del _lockfunc
+
+# Lock functions whose result only depends on the permissions of
+# accessing_obj (and of its Player, and whether that is quelled) are
+# also marked as permission_only. Locks using only these give the same
+# result for all accessing objects with the same permissions, which
+# the help index (src.help.helpindex) makes use of.
+for _lockfunc in (true, all, false, none, perm, perm_above, pperm,
+                  pperm_above, superuser, serversetting):
+    _lockfunc.permission_only = True
+del _lockfunc
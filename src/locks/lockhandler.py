@@ -107,6 +107,8 @@ to any other identifier you can use.
 
 import re
 import inspect
+from collections import OrderedDict
+from itertools import count
 from django.conf import settings
 from src.utils import logger, utils
 from django.utils.translation import ugettext as _
@@ -115,6 +117,13 @@ __all__ = ("LockHandler", "LockException")
 
 WARNING_LOG = "lockwarnings.log"
 
+_GA = object.__getattribute__
+_SA = object.__setattr__
+
+_LOCK_DECISION_CACHE = settings.LOCK_DECISION_CACHE
+_LOCK_DECISION_CACHE_SIZE = 1000
+_LOCKSTATE_COUNTER = count(1)
+
 #
 # Exception class. This will be raised
 # by errors in lock definitions.
@@ -143,6 +152,55 @@ def _cache_lockfuncs():
         else:
             logger.log_errmsg("Couldn't load %s from PERMISSION_FUNC_MODULES." % modulepath)
 
+#
+# Lock state tracking, used by the lock decision cache
+#
+
+def touch_lockstate(obj):
+    """
+    Flag that the permissions, tags or Attributes of obj have changed.
+    This invalidates all cached lock decisions where obj is either the
+    accessing or the accessed object. It is called by the Tag- and
+    AttributeHandlers whenever they write to the database.
+
+    The lock state is taken from a global counter rather than
+    increased per object, so an object re-loaded from the database
+    can never end up with the same state as a stale cache entry.
+    """
+    _SA(obj, "_lockstate", next(_LOCKSTATE_COUNTER))
+
+
+def _get_lockstate(obj):
+    "Get the current lock state of obj (0 if it was never touched)"
+    try:
+        return _GA(_GA(obj, "dbobj"), "_lockstate")
+    except AttributeError:
+        return 0
+
+
+def _get_accessing_stamp(accessing_obj):
+    """
+    Get the (cachekey, state) of accessing_obj for the lock decision
+    cache. Since lock functions like perm() also check the Player of
+    a puppeted Object, the state includes that Player as well.
+    Returns (None, None) for entities not stored in the database.
+    """
+    try:
+        dbobj = _GA(accessing_obj, "dbobj")
+        dbid = _GA(dbobj, "id")
+    except AttributeError:
+        return None, None
+    if dbid is None:
+        return None, None
+    state = _GA(dbobj, "_lockstate")
+    try:
+        player = _GA(dbobj, "db_player")
+    except AttributeError:
+        player = None
+    if player:
+        return (dbobj.__class__, dbid), (state, player.id, _GA(player, "_lockstate"))
+    return (dbobj.__class__, dbid), (state, None, None)
+
 #
 # pre-compiled regular expressions
 #
@@ -151,6 +209,93 @@ _RE_FUNCS = re.compile(r"\w+\([^)]*\)")
 _RE_SEPS = re.compile(r"(?<=[ )])AND(?=\s)|(?<=[ )])OR(?=\s)|(?<=[ )])NOT(?=\s)")
 _RE_OK = re.compile(r"%s|and|or|not")
 
+# cache of parsed lockstrings used by check_lockstring
+_LOCKSTRING_CACHE = OrderedDict()
+_LOCKSTRING_CACHE_SIZE = 1000
+
+
+#
+# Lock compiler
+#
+
+def _compile_lockfuncs(tokens, lock_funcs):
+    """
+    Compiles a lock definition into a callable taking
+    (accessing_obj, accessed_obj) and returning True/False.
+
+    tokens - list of the tokens "%s", "and", "or" and "not", as found
+             in the lock definition. Each "%s" is a placeholder for a
+             lock function call.
+    lock_funcs - list of (func, args, kwargs), one for each "%s" in
+             tokens, in the same order.
+
+    The tokens are combined with normal Python precedence (not binds
+    harder than and, which binds harder than or). The resulting callable
+    short-circuits, so lock functions are only called until the result
+    is known. A ValueError is raised if the tokens do not form a valid
+    expression.
+    """
+    tokens = list(tokens)
+    lock_funcs = list(lock_funcs)
+    pos = [0, 0]  # current token, current lock function
+
+    def _peek():
+        return tokens[pos[0]] if pos[0] < len(tokens) else None
+
+    def _leaf(func, args, kwargs):
+        return lambda accessing_obj, accessed_obj: \
+                bool(func(accessing_obj, accessed_obj, *args, **kwargs))
+
+    def _parse_not():
+        token = _peek()
+        pos[0] += 1
+        if token == "not":
+            operand = _parse_not()
+            return lambda accessing_obj, accessed_obj: \
+                    not operand(accessing_obj, accessed_obj)
+        elif token == "%s":
+            if pos[1] >= len(lock_funcs):
+                raise ValueError("too few lock functions")
+            func, args, kwargs = lock_funcs[pos[1]]
+            pos[1] += 1
+            return _leaf(func, args, kwargs)
+        raise ValueError("unexpected token '%s'" % token)
+
+    def _parse_and():
+        operands = [_parse_not()]
+        while _peek() == "and":
+            pos[0] += 1
+            operands.append(_parse_not())
+        if len(operands) == 1:
+            return operands[0]
+        def _and(accessing_obj, accessed_obj):
+            for operand in operands:
+                if not operand(accessing_obj, accessed_obj):
+                    return False
+            return True
+        return _and
+
+    def _parse_or():
+        operands = [_parse_and()]
+        while _peek() == "or":
+            pos[0] += 1
+            operands.append(_parse_and())
+        if len(operands) == 1:
+            return operands[0]
+        def _or(accessing_obj, accessed_obj):
+            for operand in operands:
+                if operand(accessing_obj, accessed_obj):
+                    return True
+            return False
+        return _or
+
+    evalfunc = _parse_or()
+    if pos[0] != len(tokens):
+        raise ValueError("unexpected token '%s'" % tokens[pos[0]])
+    if pos[1] != len(lock_funcs):
+        raise ValueError("too many lock functions")
+    return evalfunc
+
 
 #
 #
@@ -173,6 +318,10 @@ class LockHandler(object):
             _cache_lockfuncs()
         self.obj = obj
         self.locks = {}
+        # the lock decision cache is turned on by settings.LOCK_DECISION_CACHE
+        # but can also be turned on/off per handler
+        self.cache_decisions = _LOCK_DECISION_CACHE
+        self._decision_cache = {}
         self.reset()
 
     def __str__(self):
@@ -225,17 +374,19 @@ class LockHandler(object):
             if len(lock_funcs) < nfuncs:
                 continue
             try:
-                # purge the eval string of any superfluous items, then test it
-                evalstring = " ".join(_RE_OK.findall(evalstring))
-                eval(evalstring % tuple(True for func in funclist), {}, {})
-            except Exception:
+                # purge the eval string of any superfluous items, then
+                # compile it into a callable
+                evalfunc = _compile_lockfuncs(_RE_OK.findall(evalstring), lock_funcs)
+            except ValueError:
                 elist.append(_("Lock: definition '%s' has syntax errors.") % raw_lockstring)
                 continue
             if access_type in locks:
                 duplicates += 1
                 wlist.append(_("LockHandler on %(obj)s: access type '%(access_type)s' changed from '%(source)s' to '%(goal)s' " % \
                         {"obj":self.obj, "access_type":access_type, "source":locks[access_type][2], "goal":raw_lockstring}))
-            locks[access_type] = (evalstring, tuple(lock_funcs), raw_lockstring)
+            # only cache decisions if all lock funcs declare themselves cacheable
+            cacheable = all(getattr(tup[0], "cacheable", False) for tup in lock_funcs)
+            locks[access_type] = (evalfunc, tuple(lock_funcs), raw_lockstring, cacheable)
         if wlist:
             # a warning text was set, it's not an error, so only report
             logger.log_file("\n".join(wlist), WARNING_LOG)
@@ -248,6 +399,7 @@ class LockHandler(object):
     def _cache_locks(self, storage_lockstring):
         """Store data"""
         self.locks = self._parse_lockstring(storage_lockstring)
+        self._decision_cache = {}
 
     def _save_locks(self):
         "Store locks to obj"
@@ -316,6 +468,7 @@ class LockHandler(object):
         "Remove a lock from the handler"
         if access_type in self.locks:
             del self.locks[access_type]
+            self._decision_cache = {}
             self._save_locks()
             return True
         return False
@@ -323,6 +476,7 @@ class LockHandler(object):
     def clear(self):
         "Remove all locks"
         self.locks = {}
+        self._decision_cache = {}
         self.lock_storage = ""
         self._save_locks()
 
@@ -349,18 +503,24 @@ class LockHandler(object):
 
         Parsing the lockstring, we (during cache) extract the valid
         lock functions and store their function objects in the right
-        order along with their args/kwargs. These are now executed in
-        sequence, creating a list of True/False values. This is put
-        into the evalstring, which is a string of AND/OR/NOT entries
-        separated by placeholders where each function result should
-        go. We just put those results in and evaluate the string to
-        get a final, combined True/False value for the lockstring.
+        order along with their args/kwargs. The AND/OR/NOT entries
+        combining them are compiled into a single callable that calls
+        the lock functions in order, stopping as soon as the combined
+        True/False result is known (so in 'perm(Wizards) OR id(#2)',
+        id() is never called for Wizards).
 
         The important bit with this solution is that the full
-        lockstring is never blindly evaluated, and thus there (should
+        lockstring is never evaluated, and thus there (should
         be) no way to sneak in malign code in it. Only "safe" lock
         functions (as defined by your settings) are executed.
 
+        If the decision cache is active and all lock functions of the
+        lock are marked as cacheable, the result is stored per
+        accessing object. It is re-used until the permissions, tags or
+        Attributes of the accessing object (or its Player) or of the
+        accessed object change, or until the locks of this handler
+        change.
+
         """
         try:
             # check if the lock should be bypassed (e.g. superuser status)
@@ -376,12 +536,21 @@ class LockHandler(object):
         # no superuser or bypass -> normal lock operation
         if access_type in self.locks:
             # we have a lock, test it.
-            evalstring, func_tup, raw_string = self.locks[access_type]
-            # execute all lock funcs in the correct order, producing a tuple of True/False results.
-            true_false = tuple(bool(tup[0](accessing_obj, self.obj, *tup[1], **tup[2])) for tup in func_tup)
-            # the True/False tuple goes into evalstring, which combines them
-            # with AND/OR/NOT in order to get the final result.
-            return eval(evalstring % true_false)
+            evalfunc, func_tup, raw_string, cacheable = self.locks[access_type]
+            if cacheable and self.cache_decisions:
+                cachekey, state = _get_accessing_stamp(accessing_obj)
+                if cachekey:
+                    cachekey = (cachekey, access_type)
+                    state = (state, _get_lockstate(self.obj))
+                    cached = self._decision_cache.get(cachekey)
+                    if cached and cached[0] == state:
+                        return cached[1]
+                    result = evalfunc(accessing_obj, self.obj)
+                    if len(self._decision_cache) >= _LOCK_DECISION_CACHE_SIZE:
+                        self._decision_cache = {}
+                    self._decision_cache[cachekey] = (state, result)
+                    return result
+            return evalfunc(accessing_obj, self.obj)
         else:
             return default
 
@@ -401,12 +570,15 @@ class LockHandler(object):
              or (hasattr(accessing_obj, 'get_player') and (not accessing_obj.get_player() or accessing_obj.get_player().is_superuser))):
                 return True
 
-        locks = self._parse_lockstring(lockstring)
+        locks = _LOCKSTRING_CACHE.pop(lockstring, None)
+        if locks is None:
+            locks = self._parse_lockstring(lockstring)
+        # (re-)insert as most recently used and crop the cache
+        _LOCKSTRING_CACHE[lockstring] = locks
+        if len(_LOCKSTRING_CACHE) > _LOCKSTRING_CACHE_SIZE:
+            _LOCKSTRING_CACHE.popitem(last=False)
         for access_type in locks:
-            evalstring, func_tup, raw_string = locks[access_type]
-            true_false = tuple(tup[0](accessing_obj, self.obj, *tup[1],**tup[2])
-                                      for tup in func_tup)
-            return eval(evalstring % true_false)
+            return locks[access_type][0](accessing_obj, self.obj)
 
 
 def _test():
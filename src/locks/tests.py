@@ -61,3 +61,28 @@ class TestLockfuncs(LockTest):
         self.assertEquals(False, lockfuncs.attr_lt(self.obj2, self.obj1, 'testattr', '45'))
         self.assertEquals(True, lockfuncs.attr_le(self.obj2, self.obj1, 'testattr', '45'))
         self.assertEquals(False, lockfuncs.attr_ne(self.obj2, self.obj1, 'testattr', '45'))
+
+class TestLockEval(LockTest):
+    def testrun(self):
+        self.obj1.locks.add("a:false() OR NOT false() AND true();b:NOT true() OR false();c:true() AND NOT NOT false()")
+        self.assertEquals(True, self.obj1.locks.check(self.obj2, 'a'))
+        self.assertEquals(False, self.obj1.locks.check(self.obj2, 'b'))
+        self.assertEquals(False, self.obj1.locks.check(self.obj2, 'c'))
+        self.assertEquals(True, self.obj1.locks.check_lockstring(self.obj2, "dummy:NOT false()"))
+        self.assertRaises(Exception, self.obj1.locks.add, "e:true() NOT false()")
+
+
+class TestLockDecisionCache(LockTest):
+    def testrun(self):
+        self.obj1.locks.cache_decisions = True
+        self.obj1.locks.add("edit:perm(Wizards);get:attr(testattr)")
+        self.assertEquals(False, self.obj1.locks.check(self.obj2, 'edit'))
+        self.obj2.permissions.add('Wizards')
+        self.assertEquals(True, self.obj1.locks.check(self.obj2, 'edit'))
+        self.obj2.permissions.remove('Wizards')
+        self.assertEquals(False, self.obj1.locks.check(self.obj2, 'edit'))
+        self.assertEquals(False, self.obj1.locks.check(self.obj2, 'get'))
+        self.obj2.db.testattr = True
+        self.assertEquals(True, self.obj1.locks.check(self.obj2, 'get'))
+        self.obj1.locks.add("get:false()")
+        self.assertEquals(False, self.obj1.locks.check(self.obj2, 'get'))
@@ -15,6 +15,7 @@ _GA = object.__getattribute__
 
 # delayed import
 _ATTR = None
+_ALIASHANDLER = None
 
 
 # Try to use a custom way to parse id-tagged multimatches.
@@ -181,6 +182,24 @@ class ObjectManager(TypedObjectManager):
         exclude_restriction = Q(pk__in=[_GA(obj, "id") for obj in make_iter(excludeobj)]) if excludeobj else Q()
         return self.filter(db_location=location).exclude(exclude_restriction)
 
+    def preload_contents(self, locations=None):
+        """
+        Load the contents index (see ObjectDB.contents) of many
+        locations using one database query per 500 locations. This is
+        done for all objects in the idmapper cache at server start.
+
+        locations - the objects to load, defaults to all cached objects
+        """
+        if locations is None:
+            locations = self.model.get_all_cached_instances()
+        locations = [_GA(loc, "dbobj") for loc in make_iter(locations) if loc]
+        for i in range(0, len(locations), 500):
+            batch = dict((_GA(loc, "id"), []) for loc in locations[i:i + 500])
+            for obj in self.filter(db_location__in=batch.keys()):
+                batch[_GA(obj, "db_location_id")].append(obj)
+            for loc in locations[i:i + 500]:
+                _GA(loc, "_load_contents_index")(batch[_GA(loc, "id")])
+
     @returns_typeclass_list
     def get_objs_with_key_or_alias(self, ostring, exact=True,
                                          candidates=None, typeclasses=None):
@@ -199,22 +218,20 @@ class ObjectManager(TypedObjectManager):
             # if candidates is an empty iterable there can be no matches
             # Exit early.
             return []
+        if candidates is not None:
+            # the candidates are already loaded - match them in memory
+            return self._match_key_or_alias(ostring, make_iter(candidates),
+                                            exact=exact, typeclasses=typeclasses)
 
-        # build query objects
-        candidates_id = [_GA(obj, "id") for obj in make_iter(candidates) if obj]
-        cand_restriction = candidates != None and Q(pk__in=make_iter(candidates_id)) or Q()
+        # global search - build query objects
         type_restriction = typeclasses and Q(db_typeclass_path__in=make_iter(typeclasses)) or Q()
         if exact:
             # exact match - do direct search
-            return self.filter(cand_restriction & type_restriction & (Q(db_key__iexact=ostring) |
+            return self.filter(type_restriction & (Q(db_key__iexact=ostring) |
                                Q(db_tags__db_key__iexact=ostring) & Q(db_tags__db_tagtype__iexact="alias"))).distinct()
-        elif candidates:
-            # fuzzy with candidates
-            key_candidates = self.filter(cand_restriction & type_restriction)
-        else:
-            # fuzzy without supplied candidates - we select our own candidates
-            key_candidates = self.filter(type_restriction & (Q(db_key__istartswith=ostring) | Q(db_tags__db_key__istartswith=ostring))).distinct()
-            candidates_id = [_GA(obj, "id") for obj in key_candidates]
+        # fuzzy - we select our own candidates
+        key_candidates = self.filter(type_restriction & (Q(db_key__istartswith=ostring) | Q(db_tags__db_key__istartswith=ostring))).distinct()
+        candidates_id = [_GA(obj, "id") for obj in key_candidates]
         # fuzzy matching
         key_strings = key_candidates.values_list("db_key", flat=True).order_by("id")
 
@@ -229,6 +246,45 @@ class ObjectManager(TypedObjectManager):
                 return [alias.db_obj for ind, alias in enumerate(alias_candidates) if ind in index_matches]
             return []
 
+    def _match_key_or_alias(self, ostring, candidates, exact=True, typeclasses=None):
+        """
+        In-memory version of get_objs_with_key_or_alias for a list of
+        candidates. The matches are ordered like the database query
+        would order them. Only the aliases of candidates not cached
+        yet are loaded from the database (in one query).
+        """
+        global _ALIASHANDLER
+        if not _ALIASHANDLER:
+            from src.typeclasses.models import AliasHandler as _ALIASHANDLER
+        candidates = [obj for obj in candidates if obj]
+        if typeclasses:
+            typeclasses = make_iter(typeclasses)
+            candidates = [obj for obj in candidates
+                          if _GA(obj, "db_typeclass_path") in typeclasses]
+        # same order as the database query would give
+        candidates = sorted(candidates, key=lambda obj: _GA(obj, "id"))
+        ostring = to_unicode(ostring)
+        if exact:
+            ostring = ostring.lower()
+            keymatches = [_GA(obj, "db_key").lower() == ostring for obj in candidates]
+            _ALIASHANDLER.preload([obj for obj, match in zip(candidates, keymatches) if not match])
+            return [obj for obj, match in zip(candidates, keymatches) if match or
+                    any(to_unicode(alias) == ostring for alias in _GA(obj, "aliases").all())]
+        # fuzzy matching
+        index_matches = string_partial_matching([_GA(obj, "db_key") for obj in candidates],
+                                                ostring, ret_index=True)
+        if index_matches:
+            return [candidates[ind] for ind in index_matches]
+        _ALIASHANDLER.preload(candidates)
+        alias_objs, alias_strings = [], []
+        for obj in candidates:
+            for alias in _GA(obj, "aliases").all():
+                alias_objs.append(obj)
+                alias_strings.append(to_unicode(alias))
+        index_matches = string_partial_matching(alias_strings, ostring, ret_index=True)
+        matches = set(_GA(alias_objs[ind], "id") for ind in index_matches)
+        return [obj for obj in candidates if _GA(obj, "id") in matches]
+
     # main search methods and helper functions
 
     @returns_typeclass_list
@@ -304,7 +360,7 @@ class ObjectManager(TypedObjectManager):
                 candidates = [cand for cand in candidates
                                 if _GA(cand, "db_typeclass_path") in typeclass]
 
-        dbref = not attribute_name and exact and self.dbref(searchdata)
+        dbref = None if attribute_name or not exact else self.dbref(searchdata)
         if dbref is not None:
             # Easiest case - dbref matching (always exact)
             dbref_match = self.dbref_search(dbref)
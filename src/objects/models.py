@@ -16,6 +16,7 @@ transparently through the decorating TypeClass.
 
 import traceback
 from django.db import models
+from django.db.models.signals import post_save
 from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
 
@@ -37,6 +38,7 @@ from django.utils.translation import ugettext as _
 _ScriptDB = None
 _AT_SEARCH_RESULT = variable_from_module(*settings.SEARCH_AT_RESULT.rsplit('.', 1))
 _SESSIONS = None
+_OBJECT_MSG = None
 
 _GA = object.__getattribute__
 _SA = object.__setattr__
@@ -182,9 +184,8 @@ class ObjectDB(TypedObject):
     def __init__(self, *args, **kwargs):
         "We must initialize the parent first - important!"
         super(ObjectDB, self).__init__(*args, **kwargs)
-        location = kwargs.get("db_location", None)
-        if location:
-            _SA(location, "contents_dirty", True)
+        # the location whose contents index we are in (see contents_get)
+        _SA(self, "_location_index_id", _GA(self, "db_location_id") if _GA(self, "id") else None)
 
     # lazy-load handlers
     @lazy_property
@@ -203,6 +204,19 @@ class ObjectDB(TypedObject):
     def sessid(self):
         return SessidHandler(self)
 
+    def at_idmapper_flush(self):
+        "Puppeted objects are never evicted from the idmapper cache."
+        return not _GA(self, "db_sessid") and super(ObjectDB, self).at_idmapper_flush()
+
+    def get_protected_pks(cls):
+        """
+        The locations of objects that may not be evicted from the
+        idmapper cache are kept too, since the objects refer to them.
+        """
+        return set(_GA(obj, "db_location_id") for obj in cls.get_all_cached_instances()
+                   if not obj.at_idmapper_flush())
+    get_protected_pks = classmethod(get_protected_pks)
+
     def _at_db_player_postsave(self):
         """
         This hook is called automatically after the player field is saved.
@@ -269,20 +283,11 @@ class ObjectDB(TypedObject):
             except RuntimeWarning:
                 pass
 
-            # set contents_dirty flag
-            location_src = _GA(self, "location")
-            if location_src:
-                location_src = _GA(location_src, "dbobj")
-                _SA(location_src, "contents_dirty", True)
-
-            location_trg = location
-            if location_trg:
-                location_trg = _GA(location_trg, "dbobj")
-                _SA(location_trg, "contents_dirty", True)
-
-            # actually set the field
+            # actually set the field (saving updates the contents indexes)
             _SA(_GA(self, "dbobj"), "db_location", _GA(location, "dbobj") if location else location)
             _GA(_GA(self, "dbobj"), "save")(update_fields=["db_location"])
+            # scripts may depend on where we are
+            _GA(_GA(self, "dbobj"), "scripts").invalidate()
         except RuntimeError:
             errmsg = "Error: %s.location = %s creates a location loop." % (self.key, location)
             logger.log_errmsg(errmsg)
@@ -294,14 +299,8 @@ class ObjectDB(TypedObject):
 
     def __location_del(self):
         "Cleanly delete the location reference"
-        # set contents_dirty flag
-        location_src = _GA(self, "location")
-        if location_src:
-            location_src = _GA(location_src, "dbobj")
-            _SA(location_src, "contents_dirty", True)
-    
         _SA(_GA(self, "dbobj"), "db_location", None)
-        _GA(_GA(self, "dbobj"), "save")(upate_fields=["db_location"])
+        _GA(_GA(self, "dbobj"), "save")(update_fields=["db_location"])
     location = property(__location_get, __location_set, __location_del)
 
     class Meta:
@@ -341,9 +340,76 @@ class ObjectDB(TypedObject):
                 and not _GA(_GA(self, "db_player"), "attributes").get("_quell"))
     is_superuser = property(__is_superuser_get)
 
-    # contents
-    contents_cache = []
-    contents_dirty = True
+    # contents. Each location keeps an index {id: dbobj} of the objects
+    # located in it. It is loaded from the database on first use (or by
+    # ObjectDB.objects.preload_contents) and is then kept up to date as
+    # objects are created, moved and deleted, so the database is not
+    # queried again. Setting contents_dirty forces a reload, for example
+    # after changing db_location of objects with a queryset update().
+    _contents_index = None
+    contents_cache = None
+    contents_dirty = False
+
+    def _load_contents_index(self, objs=None):
+        """
+        Load the contents index from the database, or from objs, which
+        must be all the dbobjs located here.
+        """
+        if objs is None:
+            objs = ObjectDB.objects.filter(db_location=self)
+        index = {}
+        for obj in objs:
+            index[_GA(obj, "id")] = obj
+            _SA(obj, "_location_index_id", _GA(self, "id"))
+        _SA(self, "_contents_index", index)
+        _SA(self, "contents_cache", None)
+        _SA(self, "contents_dirty", False)
+
+    def _add_to_contents_index(self, obj):
+        "Add dbobj to the contents index, if it is loaded"
+        index = _GA(self, "_contents_index")
+        if index is not None:
+            index[_GA(obj, "id")] = obj
+            _SA(self, "contents_cache", None)
+
+    def _discard_from_contents_index(self, obj):
+        "Remove dbobj from the contents index, if it is loaded"
+        index = _GA(self, "_contents_index")
+        if index is not None and index.pop(_GA(obj, "id"), None) is not None:
+            _SA(self, "contents_cache", None)
+
+    def _remove_from_contents_index(self):
+        "Remove this object from the contents index of its indexed location"
+        location_id = _GA(self, "_location_index_id")
+        if location_id is not None:
+            location = ObjectDB.get_cached_instance(location_id)
+            if location:
+                _GA(location, "_discard_from_contents_index")(self)
+            _SA(self, "_location_index_id", None)
+
+    def update_contents_index(self, update_fields=None):
+        """
+        Update the contents indexes after this object was saved. This is
+        called automatically on save and only needs to be called
+        explicitly for objects saved without signals, such as by
+        ObjectDB.batch_create.
+
+        update_fields - the fields that were saved (None for all)
+        """
+        location_id = _GA(self, "db_location_id")
+        if location_id != _GA(self, "_location_index_id"):
+            _GA(self, "_remove_from_contents_index")()
+            if location_id is not None:
+                location = ObjectDB.get_cached_instance(location_id)
+                if location:
+                    _GA(location, "_add_to_contents_index")(self)
+                _SA(self, "_location_index_id", location_id)
+        elif location_id is not None and (update_fields is None or "db_destination" in update_fields):
+            # we may have become an exit or stopped being one
+            location = ObjectDB.get_cached_instance(location_id)
+            if location:
+                _SA(location, "contents_cache", None)
+
     def contents_get(self, exclude=None):
         """
         Returns the contents of this object, i.e. all
@@ -352,24 +418,77 @@ class ObjectDB(TypedObject):
 
         exclude is one or more objects to not return
         """
-        if _GA(self, "contents_dirty"):
-            _SA(self, "contents_cache", ObjectDB.objects.get_contents(self))
-            _SA(self, "contents_dirty", False)
-            
+        contents = _GA(self, "contents_cache")
+        if contents is None or _GA(self, "contents_dirty"):
+            if _GA(self, "contents_dirty") or _GA(self, "_contents_index") is None:
+                _GA(self, "_load_contents_index")()
+            # same order as the database query would give
+            contents = [_GA(obj, "typeclass") for obj in
+                        sorted(_GA(self, "_contents_index").values(), key=lambda obj: _GA(obj, "id"))]
+            _SA(self, "contents_cache", contents)
+
         if exclude:
             exclude = make_iter(exclude)
-            return [obj for obj in _GA(self, "contents_cache") if obj not in exclude]
-        return _GA(self, "contents_cache")
+            return [obj for obj in contents if obj not in exclude]
+        return contents
     contents = property(contents_get)
 
+    # objects with cmdsets among contents (used by the cmdhandler)
+    cmdset_objs_cache = None
+    cmdset_objs_dirty = True
+    def cmdset_objs_get(self, exclude=None):
+        """
+        Returns all objects in this object's contents, as well as
+        this object itself, that have a non-empty current cmdset. This
+        is used by the cmdhandler to gather the cmdsets available to
+        objects in a location.
+
+        The result is cached, and the at_cmdset_get hook of each object
+        is only called when the cache is rebuilt. This happens when the
+        contents of this object change or when cmdsets are added to or
+        deleted from this object or any of its contents (the
+        cmdsethandler sets the cmdset_objs_dirty flag). Lock checks
+        are not cached and must be done by the caller.
+
+        exclude is one or more objects to not return
+        """
+        contents = _GA(self, "contents_get")()
+        cache = _GA(self, "cmdset_objs_cache")
+        if _GA(self, "cmdset_objs_dirty") or not cache or cache[0] is not contents:
+            objlist = contents + [_GA(self, "typeclass")]
+            for lobj in objlist:
+                try:
+                    # call hook in case we need to do dynamic changing to cmdset
+                    _GA(lobj, "at_cmdset_get")()
+                except Exception:
+                    logger.log_trace()
+            # the hooks may have changed the cmdsets, so we only
+            # clear the dirty flag after having checked them.
+            cache = (contents, [lobj for lobj in objlist
+                                if lobj.cmdset.current and
+                                   lobj.cmdset.current.key != "_EMPTY_CMDSET"])
+            _SA(self, "cmdset_objs_cache", cache)
+            _SA(self, "cmdset_objs_dirty", False)
+        if exclude:
+            exclude = make_iter(exclude)
+            return [obj for obj in cache[1] if obj not in exclude]
+        return cache[1]
+
+    exits_cache = None
     #@property
     def __exits_get(self):
         """
         Returns all exits from this object, i.e. all objects
         at this location having the property destination != None.
+        This is cached along with the contents.
         """
-        return [exi for exi in _GA(self, "contents")
-                if exi.destination]
+        contents = _GA(self, "contents_get")()
+        cache = _GA(self, "exits_cache")
+        if not cache or cache[0] is not contents:
+            cache = (contents, [exi for exi in contents
+                                if _GA(_GA(exi, "dbobj"), "db_destination_id")])
+            _SA(self, "exits_cache", cache)
+        return cache[1]
     exits = property(__exits_get)
 
     #
@@ -563,10 +682,6 @@ class ObjectDB(TypedObject):
         When this message is called, from_obj.at_msg_send and self.at_msg_receive are called.
 
         """
-        global _SESSIONS
-        if not _SESSIONS:
-            from src.server.sessionhandler import SESSIONS as _SESSIONS
-
         text = to_str(text, force_string=True) if text else ""
 
         if "data" in kwargs:
@@ -576,6 +691,24 @@ class ObjectDB(TypedObject):
             if isinstance(data, dict):
                 kwargs.update(data)
 
+        for session in _GA(self, "_msg_sessions")(text, from_obj, sessid, kwargs):
+            session.msg(text=text, **kwargs)
+
+    def _msg_sessions(self, text, from_obj, sessid, kwargs):
+        """
+        Call the hooks for sending text to this object and return the
+        sessions to send it to. This is used by msg() and
+        msg_contents().
+
+        text (str) - the (already converted) text to send
+        from_obj, sessid - as for msg()
+        kwargs (dict) - the extra keywords given to msg()
+
+        Returns a list of sessions, empty if at_msg_receive aborted.
+        """
+        global _SESSIONS
+        if not _SESSIONS:
+            from src.server.sessionhandler import SESSIONS as _SESSIONS
         if from_obj:
             # call hook
             try:
@@ -585,13 +718,10 @@ class ObjectDB(TypedObject):
         try:
             if not _GA(_GA(self, "typeclass"), "at_msg_receive")(text=text, **kwargs):
                 # if at_msg_receive returns false, we abort message to this object
-                return
+                return []
         except Exception:
             logger.log_trace()
-
-        sessions = _SESSIONS.session_from_sessid([sessid] if sessid else make_iter(_GA(self, "sessid").get()))
-        for session in sessions:
-            session.msg(text=text, **kwargs)
+        return _SESSIONS.session_from_sessid([sessid] if sessid else make_iter(_GA(self, "sessid").get()))
 
     def msg_contents(self, message, exclude=None, from_obj=None, **kwargs):
         """
@@ -599,13 +729,41 @@ class ObjectDB(TypedObject):
 
         exclude is a list of objects not to send to. See self.msg() for
                 more info.
+
+        The hooks are called for every object just like with msg(),
+        but objects that don't overload msg() on their typeclass have
+        their sessions sent to in one go, so the message is only
+        converted once per encoding and is shared by all of them in
+        the batch sent to the Portal.
         """
+        global _SESSIONS, _OBJECT_MSG
+        if not _SESSIONS:
+            from src.server.sessionhandler import SESSIONS as _SESSIONS
+        if not _OBJECT_MSG:
+            from src.objects.objects import Object
+            _OBJECT_MSG = Object.msg.im_func
         contents = _GA(self, "contents")
         if exclude:
             exclude = make_iter(exclude)
             contents = [obj for obj in contents if obj not in exclude]
+
+        if "data" in kwargs:
+            # deprecation warning
+            logger.log_depmsg("ObjectDB.msg_contents(): 'data'-dict keyword is deprecated. Use **kwargs instead.")
+            data = kwargs.pop("data")
+            if isinstance(data, dict):
+                kwargs.update(data)
+        text = to_str(message, force_string=True) if message else ""
+
+        sessions = []
         for obj in contents:
-            obj.msg(message, from_obj=from_obj, **kwargs)
+            if getattr(type(obj).msg, "im_func", None) is _OBJECT_MSG:
+                sessions.extend(obj.dbobj._msg_sessions(text, from_obj, 0, kwargs))
+            else:
+                # custom msg(); this must be called separately
+                obj.msg(message, from_obj=from_obj, **kwargs)
+        if sessions:
+            _SESSIONS.data_out_multi(sessions, text=text, **kwargs)
 
     def move_to(self, destination, quiet=False,
                 emit_to_obj=None, use_destination=True, to_none=False):
@@ -702,7 +860,6 @@ class ObjectDB(TypedObject):
         # Perform move
         try:
             #print "move_to location:", destination
-            _SA(self, "contents_dirty", True)
             _SA(self, "location", destination)
         except Exception:
             emit_to_obj.msg(errtxt % "location change")
@@ -879,13 +1036,17 @@ class ObjectDB(TypedObject):
         _GA(self, "attributes").clear()
         _GA(self, "nicks").clear()
         _GA(self, "aliases").clear()
-        
-        # set contents_dirty flag
-        location_src = _GA(self, "location")
-        if location_src:
-            location_src = _GA(location_src, "dbobj")
-            _SA(location_src, "contents_dirty", True)
+
+        # remove us from the contents index of our location
+        _GA(self, "_remove_from_contents_index")()
 
         # Perform the deletion of the object
         super(ObjectDB, self).delete()
         return True
+
+
+def _update_contents_index(sender, instance, raw=False, update_fields=None, **kwargs):
+    "Keep the contents indexes up to date when objects are saved"
+    if not raw:
+        instance.update_contents_index(update_fields=update_fields)
+post_save.connect(_update_contents_index, sender=ObjectDB, dispatch_uid="contentsindex")
@@ -585,6 +585,11 @@ class Object(TypeClass):
         have no cmdsets.  **kwargs are usually not set but could be
         used e.g. to force rebuilding of a dynamically created cmdset
         or similar.
+
+        Note that for objects sitting in the caller's location or
+        inventory, this is only called when the location's cached
+        list of cmdset-objects is rebuilt (see
+        ObjectDB.cmdset_objs_get), not on every command.
         """
         pass
 
@@ -123,6 +123,10 @@ class PlayerDB(TypedObject, AbstractUser):
     def nicks(self):
         return NickHandler(self)
 
+    def at_idmapper_flush(self):
+        "Connected players are never evicted from the idmapper cache."
+        return not _GA(self, "db_is_connected") and super(PlayerDB, self).at_idmapper_flush()
+
 
     # alias to the objs property
     def __characters_get(self):
@@ -241,6 +245,19 @@ class PlayerDB(TypedObject, AbstractUser):
                 kwargs.update(data)
 
         text = to_str(text, force_string=True) if text else ""
+        for session in _GA(self, "_msg_sessions")(text, from_obj, sessid, kwargs):
+            session.msg(text=text, **kwargs)
+
+    def _msg_sessions(self, text, from_obj, sessid, kwargs):
+        """
+        Call the hooks for sending text to this player and return the
+        sessions to send it to. This is used by msg() and by channels
+        sending to many players at once.
+
+        text (str) - the (already converted) text to send
+        from_obj, sessid - as for msg()
+        kwargs (dict) - the extra keywords given to msg()
+        """
         if from_obj:
             # call hook
             try:
@@ -249,16 +266,11 @@ class PlayerDB(TypedObject, AbstractUser):
                 pass
         sessions = _MULTISESSION_MODE > 1 and sessid and _GA(self, "get_session")(sessid) or None
         if sessions:
-            for session in make_iter(sessions):
-                obj = session.puppet
-                if obj and not obj.at_msg_receive(text=text, **kwargs):
-                    # if hook returns false, cancel send
-                    continue
-                session.msg(text=text, **kwargs)
-        else:
-            # if no session was specified, send to them all
-            for sess in _GA(self, 'get_all_sessions')():
-                sess.msg(text=text, **kwargs)
+            # if hook returns false, cancel send
+            return [session for session in make_iter(sessions)
+                    if not session.puppet or session.puppet.at_msg_receive(text=text, **kwargs)]
+        # if no session was specified, send to them all
+        return _GA(self, 'get_all_sessions')()
 
     # session-related methods
 
@@ -25,6 +25,8 @@ class ScriptHandler(object):
         cruft left over from a server shutdown.
         """
         self.obj = obj
+        # if the scripts need to be re-validated
+        self._invalid = True
 
     def __str__(self):
         "List the scripts tied to this object"
@@ -117,10 +119,25 @@ class ScriptHandler(object):
         """
         return ScriptDB.objects.get_all_scripts_on_obj(self.obj, key=scriptid)
 
-    def validate(self, init_mode=False):
+    def invalidate(self):
+        """
+        Mark the scripts on this object as needing validation. This
+        is done automatically when scripts are added or stopped and
+        when the object moves. Call this if a script's is_valid()
+        depends on some other state that has changed.
+        """
+        self._invalid = True
+
+    def validate(self, init_mode=False, force=True):
         """
         Runs a validation on this object's scripts only.
         This should be called regularly to crank the wheels.
+
+        force - if False, only validate if the scripts were
+                invalidated since the last validation. This avoids
+                database lookups and is used before every command.
         """
-        ScriptDB.objects.validate(obj=self.obj, init_mode=init_mode)
+        if force or init_mode or self._invalid:
+            self._invalid = False
+            ScriptDB.objects.validate(obj=self.obj, init_mode=init_mode)
 
@@ -7,10 +7,10 @@ It also defines a few common scripts.
 
 from twisted.internet.defer import Deferred, maybeDeferred
 from twisted.internet.task import LoopingCall
-from django.conf import settings
 from django.utils.translation import ugettext as _
 from src.typeclasses.typeclass import TypeClass
 from src.scripts.models import ScriptDB
+from src.scripts.timerwheel import TimerTask
 from src.comms import channelhandler
 from src.utils import logger
 
@@ -23,7 +23,9 @@ _SESSIONS = None
 class ExtendedLoopingCall(LoopingCall):
     """
     LoopingCall that can start at a delay different
-    than self.interval.
+    than self.interval. Scripts and Tickers use the
+    TimerTask from src.scripts.timerwheel instead, which
+    has the same api.
     """
     start_delay = None
     callcount = 0
@@ -128,7 +130,7 @@ class ScriptBase(TypeClass):
     def _start_task(self):
         "start task runner"
 
-        self.ndb._task = ExtendedLoopingCall(self._step_task)
+        self.ndb._task = TimerTask(self._step_task)
 
         if self.db._paused_time:
             # the script was paused; restarting
@@ -274,11 +276,14 @@ class ScriptBase(TypeClass):
             except Exception:
                 logger.log_trace()
         self._stop_task()
+        holder = self.dbobj.db_obj or self.dbobj.db_player
         try:
             self.dbobj.delete()
         except AssertionError:
             logger.log_trace()
             return 0
+        if holder:
+            holder.scripts.invalidate()
         return 1
 
     def pause(self):
@@ -539,11 +544,10 @@ class CheckSessions(Script):
         #print "ValidateSessions run"
         _SESSIONS.validate_sessions()
 
-_FLUSH_CACHE = None
-_IDMAPPER_CACHE_MAX_MEMORY = settings.IDMAPPER_CACHE_MAXSIZE
+_TRIM_CACHE = None
 class ValidateIdmapperCache(Script):
     """
-    Check memory use of idmapper cache
+    Check size of idmapper cache
     """
     def at_script_creation(self):
         self.key = "sys_cache_validate"
@@ -553,10 +557,10 @@ class ValidateIdmapperCache(Script):
 
     def at_repeat(self):
         "Called every ~5 mins"
-        global _FLUSH_CACHE
-        if not _FLUSH_CACHE:
-            from src.utils.idmapper.base import conditional_flush as _FLUSH_CACHE
-        _FLUSH_CACHE(_IDMAPPER_CACHE_MAX_MEMORY)
+        global _TRIM_CACHE
+        if not _TRIM_CACHE:
+            from src.utils.idmapper.base import trim_cache as _TRIM_CACHE
+        _TRIM_CACHE()
 
 class ValidateScripts(Script):
     "Check script validation regularly"
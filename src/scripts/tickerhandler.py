@@ -30,6 +30,13 @@ To remove:
 The interval must be given since a single object can be subcribed
 to many different tickers at the same time.
 
+Subscribers are spread out over the interval so they are not all
+called at the same moment, and the calls yield to the server if they
+take too long (see the TICKER_SLOTS and TICKER_SLICE_BUDGET settings).
+To see how late the subscribers are called:
+
+    TICKER_HANDLER.stats(15)
+
 
 The TickerHandler's functionality can be overloaded by modifying the
 Ticker class and then changing TickerPool and TickerHandler to use the
@@ -48,46 +55,112 @@ a  custom handler one can make a custom AT_STARTSTOP_MODULE entry to
 call the handler's save() and restore() methods when the server reboots.
 
 """
-from twisted.internet.defer import inlineCallbacks
-from src.scripts.scripts import ExtendedLoopingCall
+from itertools import chain
+from time import time
+from zlib import crc32
+from twisted.internet.defer import Deferred
+from twisted.internet.task import cooperate
+from django.conf import settings
+from src.scripts.timerwheel import TimerTask
 from src.server.models import ServerConfig
-from src.utils.logger import log_trace
+from src.utils.logger import log_trace, log_err
 from src.utils.dbserialize import dbserialize, dbunserialize, pack_dbobj, unpack_dbobj
 
 _GA = object.__getattribute__
 _SA = object.__setattr__
 
+_TICKER_SLOTS = settings.TICKER_SLOTS
+_TICKER_SLICE_BUDGET = settings.TICKER_SLICE_BUDGET
+_TIMER_WHEEL_RESOLUTION = settings.TIMER_WHEEL_RESOLUTION
+
 
 class Ticker(object):
     """
     Represents a repeatedly running task that calls
     hooks repeatedly. Overload _callback to change the
-    way it operates.
+    way it operates, or _tick_subscriber to only change
+    what is done with each subscriber.
+
+    To avoid all subscribers of an interval being called in the
+    same moment, the interval is split into up to TICKER_SLOTS
+    steps and each subscriber is placed in one of them based on its
+    store_key. Each subscriber is still called once per interval.
+    If calling the subscribers takes more than TICKER_SLICE_BUDGET
+    seconds, the rest are called cooperatively, giving the server
+    time to handle other things (like player input) in between.
     """
 
-    @inlineCallbacks
+    def _tick_subscriber(self, obj, args, kwargs):
+        """
+        Call the hook on one subscriber. If this returns a
+        Deferred, the next subscriber waits for it to fire.
+        """
+        hook_key = kwargs.get("hook_key", "at_tick")
+        return _GA(obj, hook_key)(*args, **kwargs)
+
+    def _dispatch(self, calls):
+        """
+        Generator calling the subscribers for the given steps.
+        calls is a list of (scheduled_time, store_keys). This yields
+        when the slice budget is used up or to wait for a Deferred.
+        """
+        clock, stats = self.task.clock, self.stats
+        t0 = time()
+        for scheduled, store_keys in calls:
+            for store_key in store_keys:
+                try:
+                    obj, args, kwargs = self.subscriptions[store_key]
+                except KeyError:
+                    # unsubscribed since the step started
+                    continue
+                if not obj:
+                    # object was deleted between calls
+                    self.validate()
+                    continue
+                lag = max(0.0, clock.seconds() - scheduled)
+                stats["calls"] += 1
+                stats["last_lag"] = lag
+                stats["max_lag"] = max(stats["max_lag"], lag)
+                stats["total_lag"] += lag
+                try:
+                    result = self._tick_subscriber(obj, args, kwargs)
+                except Exception:
+                    log_trace()
+                    continue
+                if isinstance(result, Deferred):
+                    result.addErrback(lambda f: log_err(f.getTraceback()))
+                    if not result.called:
+                        yield result
+                        t0 = time()
+                        continue
+                if time() - t0 > self.budget:
+                    stats["yields"] += 1
+                    yield None
+                    t0 = time()
+
     def _callback(self):
         """
-        This will be called repeatedly every self.interval seconds.
-        self.subscriptions contain tuples of (obj, args, kwargs) for
-        each subscribing object.
+        This will be called repeatedly every self.interval / self.nslots
+        seconds. self.subscriptions contain tuples of (obj, args, kwargs)
+        for each subscribing object.
 
         If overloading, this callback is expected to handle all
         subscriptions when it is triggered. It should not return
-        anything and should not traceback on poorly designed hooks.
-        The callback should ideally work under @inlineCallbacks so it can yield
-        appropriately.
-        """
-        for key, (obj, args, kwargs) in self.subscriptions.items():
-            hook_key = yield kwargs.get("hook_key", "at_tick")
-            if not obj:
-                # object was deleted between calls
-                self.validate()
-                continue
-            try:
-                yield _GA(obj, hook_key)(*args, **kwargs)
-            except Exception:
-                log_trace()
+        anything but an eventual Deferred and should not traceback
+        on poorly designed hooks.
+        """
+        now = self.task.clock.seconds()
+        # catch up on steps that were skipped if we fell behind
+        target = max(self._nextstep, int((now - self._start) / self.step + 1e-6))
+        first = max(self._nextstep, target + 1 - self.nslots)
+        self._nextstep = target + 1
+        calls = [(self._start + istep * self.step, list(self.slots[istep % self.nslots]))
+                 for istep in range(first, target + 1)]
+        iterator = self._dispatch(calls)
+        for result in iterator:
+            # continue the rest cooperatively, so the server can do
+            # other things between the calls
+            return cooperate(chain([result], iterator)).whenDone()
 
     def __init__(self, interval):
         """
@@ -95,8 +168,34 @@ class Ticker(object):
         """
         self.interval = interval
         self.subscriptions = {}
-        # set up a twisted asynchronous repeat call
-        self.task = ExtendedLoopingCall(self._callback)
+        # split the interval in steps, each calling one slot
+        self.nslots = max(1, min(_TICKER_SLOTS, int(interval / _TIMER_WHEEL_RESOLUTION)))
+        self.step = float(interval) / self.nslots
+        self.slots = [set() for _ in range(self.nslots)]
+        self.budget = _TICKER_SLICE_BUDGET
+        # the time of the first step and the next step to call
+        self._start = 0.0
+        self._nextstep = 0
+        self.stats = {}
+        self.reset_stats()
+        # set up a repeat call on the timer wheel
+        self.task = TimerTask(self._callback)
+
+    def reset_stats(self):
+        """
+        Reset the tick statistics. The statistics are
+            calls - number of subscriber hooks called
+            yields - times the slice budget was used up
+            last_lag, max_lag, total_lag - how many seconds
+                the subscriber hooks were called after their
+                slot's scheduled time
+        """
+        self.stats.update({"calls": 0, "yields": 0, "last_lag": 0.0,
+                           "max_lag": 0.0, "total_lag": 0.0})
+
+    def _slot(self, store_key):
+        "Get the slot a store_key belongs to; always the same one."
+        return (crc32(repr(store_key)) & 0xffffffff) % self.nslots
 
     def validate(self, start_delay=None):
         """
@@ -113,7 +212,11 @@ class Ticker(object):
                 self.task.stop()
         elif subs:
             #print "starting with start_delay=", start_delay
-            self.task.start(self.interval, now=False, start_delay=start_delay)
+            # remember when the first step is due, to be able to
+            # catch up if we fall behind
+            delay = start_delay if start_delay is not None and start_delay >= 0 else self.step
+            self._start, self._nextstep = self.task.clock.seconds() + delay, 0
+            self.task.start(self.step, now=False, start_delay=start_delay)
 
     def add(self, store_key, obj, *args, **kwargs):
         """
@@ -123,6 +226,7 @@ class Ticker(object):
         """
         start_delay = kwargs.pop("_start_delay", None)
         self.subscriptions[store_key] = (obj, args, kwargs)
+        self.slots[self._slot(store_key)].add(store_key)
         self.validate(start_delay=start_delay)
 
     def remove(self, store_key):
@@ -130,6 +234,7 @@ class Ticker(object):
         Unsubscribe object from this ticker
         """
         self.subscriptions.pop(store_key, False)
+        self.slots[self._slot(store_key)].discard(store_key)
         self.validate()
 
     def stop(self):
@@ -137,12 +242,13 @@ class Ticker(object):
         Kill the Task, regardless of subscriptions
         """
         self.subscriptions = {}
+        self.slots = [set() for _ in range(self.nslots)]
         self.validate()
 
 
 class TickerPool(object):
     """
-    This maintains a pool of Twisted LoopingCall tasks
+    This maintains a pool of TimerTasks
     for calling subscribed objects at given times.
     """
     ticker_class = Ticker
@@ -186,6 +292,8 @@ class TickerHandler(object):
     instructions and and re-applies them at a server restart.
     """
     ticker_pool_class = TickerPool
+    # always allow this many stored changes before re-saving
+    journal_min_compact = 100
 
     def __init__(self, save_name="ticker_storage"):
         """
@@ -194,6 +302,9 @@ class TickerHandler(object):
         self.ticker_storage = {}
         self.save_name = save_name
         self.ticker_pool = self.ticker_pool_class()
+        # number of changes stored since the last save, None
+        # until we know (after restore or save)
+        self.journal_size = None
 
     def _store_key(self, obj, interval, idstring=""):
         """
@@ -226,12 +337,36 @@ class TickerHandler(object):
         # return sidb and store_key
         return isdb, (objkey, interval, idstring)
 
+    def _journal(self, store_key, data=None):
+        """
+        Store a change to ticker_storage in the database. Rather than
+        re-saving all of ticker_storage, every change is stored in a
+        separate ServerConfig entry. data=None means store_key was
+        removed. The changes are merged into the main storage by
+        save(), which is done when they outnumber the stored tickers.
+        """
+        if self.journal_size is None:
+            # not restored; stored changes are from another run
+            self.save()
+        self.journal_size += 1
+        conf = ServerConfig(db_key="%s__%i" % (self.save_name, self.journal_size))
+        conf.value = dbserialize((store_key, data))
+        if self.journal_size > max(self.journal_min_compact, len(self.ticker_storage)):
+            self.save()
+
+    def _journal_entries(self):
+        "Get the stored changes, in order"
+        entries = ServerConfig.objects.filter(db_key__startswith="%s__" % self.save_name)
+        entries = [(int(conf.db_key.rsplit("__", 1)[1]), conf) for conf in entries]
+        return [conf for _, conf in sorted(entries)]
+
     def save(self):
         """
         Save ticker_storage as a serialized string into a temporary
-        ServerConf field. Whereas saving is done on the fly, if called by
-        server when it shuts down, the current timer of each ticker will be
-        saved so it can start over from that point.
+        ServerConf field, replacing the stored changes. Whereas saving
+        is done on the fly, if called by server when it shuts down, the
+        current timer of each ticker will be saved so it can start over
+        from that point.
         """
         if self.ticker_storage:
             start_delays = dict((interval, ticker.task.next_call_time())
@@ -246,6 +381,9 @@ class TickerHandler(object):
                                     value=dbserialize(self.ticker_storage))
         else:
             ServerConfig.objects.conf(key=self.save_name, delete=True)
+        if self.journal_size != 0:
+            ServerConfig.objects.filter(db_key__startswith="%s__" % self.save_name).delete()
+            self.journal_size = 0
 
     def restore(self):
         """
@@ -253,8 +391,18 @@ class TickerHandler(object):
         """
         # load stored command instructions and use them to re-initialize handler
         ticker_storage = ServerConfig.objects.conf(key=self.save_name)
+        ticker_storage = dbunserialize(ticker_storage) if ticker_storage else {}
+        # apply changes stored since the last save
+        journal = self._journal_entries()
+        for conf in journal:
+            store_key, data = dbunserialize(conf.value)
+            if data is None:
+                ticker_storage.pop(store_key, None)
+            else:
+                ticker_storage[store_key] = data
+        self.journal_size = len(journal)
         if ticker_storage:
-            self.ticker_storage = dbunserialize(ticker_storage)
+            self.ticker_storage = ticker_storage
             #print "restore:", self.ticker_storage
             for store_key, (args, kwargs) in self.ticker_storage.items():
                 if len(store_key) == 2:
@@ -264,6 +412,9 @@ class TickerHandler(object):
                 obj = unpack_dbobj(obj)
                 _, store_key = self._store_key(obj, interval, idstring)
                 self.ticker_pool.add(store_key, obj, interval, *args, **kwargs)
+        if self.journal_size:
+            # merge the changes into the main storage
+            self.save()
 
     def add(self, obj, interval, idstring="", *args, **kwargs):
         """
@@ -274,7 +425,7 @@ class TickerHandler(object):
         isdb, store_key = self._store_key(obj, interval, idstring)
         if isdb:
             self.ticker_storage[store_key] = (args, kwargs)
-            self.save()
+            self._journal(store_key, (args, kwargs))
         self.ticker_pool.add(store_key, obj, interval, *args, **kwargs)
 
     def remove(self, obj, interval=None, idstring=""):
@@ -286,22 +437,17 @@ class TickerHandler(object):
             isdb, store_key = self._store_key(obj, interval, idstring)
             if isdb:
                 self.ticker_storage.pop(store_key, None)
-                self.save()
+                self._journal(store_key)
             self.ticker_pool.remove(store_key, interval)
         else:
             # remove all objects with any intervals
             intervals = self.ticker_pool.tickers.keys()
-            should_save = False
             for interval in intervals:
                 isdb, store_key = self._store_key(obj, interval, idstring)
-                if isdb:
-                    self.ticker_storage.pop(store_key, None)
-                    should_save = True
+                if isdb and store_key in self.ticker_storage:
+                    self.ticker_storage.pop(store_key)
+                    self._journal(store_key)
                 self.ticker_pool.remove(store_key, interval)
-            if should_save:
-                self.save()
-
-
 
     def clear(self, interval=None):
         """
@@ -312,7 +458,7 @@ class TickerHandler(object):
         """
         self.ticker_pool.stop(interval)
         if interval:
-            self.ticker_storage = dict((store_key, store_key) for store_key in self.ticker_storage if store_key[1] != interval)
+            self.ticker_storage = dict((store_key, data) for store_key, data in self.ticker_storage.items() if store_key[1] != interval)
         else:
             self.ticker_storage = {}
         self.save()
@@ -333,6 +479,36 @@ class TickerHandler(object):
             if ticker:
                 return ticker.subscriptions.values()
 
+    def stats(self, interval=None, reset=False):
+        """
+        Get tick statistics for the tickers. Returns a dictionary
+        {interval: stats}, or only the stats if interval is given.
+        The stats is a dictionary with keys
+            subscribers - number of subscriptions
+            slots - number of steps the interval is split into
+            calls - number of subscriber hooks called
+            yields - times the slice budget was used up, letting the
+                     server do other things before continuing
+            last_lag, max_lag, mean_lag - how many seconds late the
+                     subscriber hooks were called
+        If reset is set, the statistics are reset after reading.
+        """
+        stats = {}
+        for tinterval, ticker in self.ticker_pool.tickers.items():
+            if interval is not None and tinterval != interval:
+                continue
+            tstats = dict(ticker.stats)
+            total_lag = tstats.pop("total_lag")
+            tstats["mean_lag"] = total_lag / tstats["calls"] if tstats["calls"] else 0.0
+            tstats["subscribers"] = len(ticker.subscriptions)
+            tstats["slots"] = ticker.nslots
+            stats[tinterval] = tstats
+            if reset:
+                ticker.reset_stats()
+        if interval is not None:
+            return stats.get(interval)
+        return stats
+
 
 # main tickerhandler
 TICKER_HANDLER = TickerHandler()
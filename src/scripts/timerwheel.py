@@ -0,0 +1,319 @@
+"""
+Timer wheel
+
+This implements a shared scheduler for repeating tasks. Rather than
+every Script and Ticker keeping its own reactor DelayedCall (which
+with many thousands of timed scripts makes the reactor's heap
+operations dominate), all tasks register with a single TimerWheel.
+
+The wheel sorts its timers into buckets ("slots") of
+settings.TIMER_WHEEL_RESOLUTION seconds. Only the slots are kept in
+a heap and only the earliest slot has a reactor DelayedCall, so
+thousands of scripts with the same interval cost one heap operation
+and one reactor call per firing rather than one each.
+
+The TimerTask class has the same api as the ExtendedLoopingCall it
+replaces:
+
+    from src.scripts.timerwheel import TimerTask
+
+    task = TimerTask(myfunc)
+    task.start(10, now=False, start_delay=2)
+    task.next_call_time()
+    task.force_repeat()
+    task.callcount
+    task.stop()
+
+Load metrics of the wheel are available from TIMER_WHEEL.stats().
+"""
+
+from heapq import heappush, heappop
+from math import ceil
+from time import time
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, maybeDeferred
+from django.conf import settings
+
+__all__ = ("TimerWheel", "TimerTask", "TIMER_WHEEL")
+
+_RESOLUTION = settings.TIMER_WHEEL_RESOLUTION
+
+
+class TimerWheel(object):
+    """
+    Bucketed scheduler for TimerTasks. A task is placed in the first
+    slot at or after its due time, so it fires at most one resolution
+    step late but never early.
+    """
+    def __init__(self, resolution=_RESOLUTION, clock=reactor):
+        """
+        resolution - the size of each slot, in seconds
+        clock - the reactor (or a task.Clock when testing)
+        """
+        self.resolution = float(resolution)
+        self.clock = clock
+        # {slot: [task, ...]} and a heap of the slots in use
+        self.slots = {}
+        self.slotheap = []
+        self.ntasks = 0
+        # the DelayedCall for the earliest slot, and its slot
+        self.call = None
+        self.callslot = None
+        # load metrics
+        self.nticks = 0
+        self.ncallbacks = 0
+        self.last_callbacks = 0
+        self.max_callbacks = 0
+        self.last_duration = 0.0
+        self.max_duration = 0.0
+        self.noverruns = 0
+        self.max_lag = 0.0
+
+    def schedule(self, task, when):
+        """
+        Schedule task to fire at absolute clock time when.
+        A task can only be scheduled once at a time.
+        """
+        if task._slot is not None:
+            self.unschedule(task)
+        slot = int(ceil(when / self.resolution))
+        bucket = self.slots.get(slot)
+        if bucket is None:
+            bucket = self.slots[slot] = []
+            heappush(self.slotheap, slot)
+        bucket.append(task)
+        task._slot = slot
+        self.ntasks += 1
+        if self.callslot is None or slot < self.callslot:
+            self._reschedule()
+
+    def unschedule(self, task):
+        """
+        Remove task from the wheel. The slot entry is left in
+        place and skipped when the slot fires.
+        """
+        if task._slot is not None:
+            task._slot = None
+            self.ntasks -= 1
+
+    def _reschedule(self):
+        "Make sure the DelayedCall is set for the earliest slot."
+        if self.call and self.call.active():
+            self.call.cancel()
+        self.call, self.callslot = None, None
+        if self.slotheap:
+            slot = self.slotheap[0]
+            delay = max(0, slot * self.resolution - self.clock.seconds())
+            self.call = self.clock.callLater(delay, self._tick)
+            self.callslot = slot
+
+    def _tick(self):
+        """
+        Fire all tasks in the slots that are due.
+        """
+        self.call, self.callslot = None, None
+        t0 = time()
+        now = self.clock.seconds()
+        # allow for float rounding of the slot times
+        current = int(now / self.resolution + 1e-6)
+        slots, slotheap = self.slots, self.slotheap
+        # collect the due slots first; tasks rescheduled while
+        # firing (such as those with interval 0) wait for next tick
+        due = []
+        while slotheap and slotheap[0] <= current:
+            slot = heappop(slotheap)
+            due.append((slot, slots.pop(slot, ())))
+        ncallbacks = 0
+        lag = 0.0
+        for slot, bucket in due:
+            lag = max(lag, now - slot * self.resolution)
+            for task in bucket:
+                if task._slot == slot:
+                    task._slot = None
+                    self.ntasks -= 1
+                    ncallbacks += 1
+                    task()
+        # update the metrics
+        duration = time() - t0
+        self.nticks += 1
+        self.ncallbacks += ncallbacks
+        self.last_callbacks = ncallbacks
+        self.max_callbacks = max(self.max_callbacks, ncallbacks)
+        self.last_duration = duration
+        self.max_duration = max(self.max_duration, duration)
+        self.max_lag = max(self.max_lag, lag)
+        if duration > self.resolution:
+            self.noverruns += 1
+        if self.callslot is None:
+            self._reschedule()
+
+    def stats(self):
+        """
+        Return a dictionary of load metrics for the wheel:
+            tasks - number of currently scheduled tasks
+            slots - number of slots waiting to fire
+            ticks - number of times the wheel has fired
+            callbacks - total number of tasks fired
+            callbacks_last_tick/max_callbacks_per_tick - tasks per firing
+            last_duration/max_duration - time spent firing, in seconds
+            overruns - firings that took longer than the resolution
+            max_lag - the latest a slot has fired, in seconds
+        """
+        return {"tasks": self.ntasks,
+                "slots": len(self.slotheap),
+                "ticks": self.nticks,
+                "callbacks": self.ncallbacks,
+                "callbacks_last_tick": self.last_callbacks,
+                "max_callbacks_per_tick": self.max_callbacks,
+                "last_duration": self.last_duration,
+                "max_duration": self.max_duration,
+                "overruns": self.noverruns,
+                "max_lag": self.max_lag}
+
+    def reset_stats(self):
+        "Reset the max values of the load metrics"
+        self.max_callbacks = 0
+        self.max_duration = 0.0
+        self.max_lag = 0.0
+        self.noverruns = 0
+
+
+# the main timer wheel
+TIMER_WHEEL = TimerWheel()
+
+
+class TimerTask(object):
+    """
+    Repeating task driven by a TimerWheel. This has the same api
+    as ExtendedLoopingCall; it can start at a delay different from
+    the interval, counts its calls and can be forced to repeat.
+
+    Like a LoopingCall, the next call is not scheduled until a
+    Deferred returned by the function has fired, and calls missed
+    due to a busy server are skipped rather than bunched up.
+    """
+    def __init__(self, f, *args, **kwargs):
+        """
+        f - function to call repeatedly with args and kwargs. If
+            kwargs contains _wheel, this is used as the TimerWheel
+            instead of the default one.
+        """
+        self.wheel = kwargs.pop("_wheel", TIMER_WHEEL)
+        self.clock = self.wheel.clock
+        self.f, self.a, self.kw = f, args, kwargs
+        self.running = False
+        self.interval = None
+        self.start_delay = None
+        self.starttime = None
+        self.callcount = 0
+        self.deferred = None
+        self._expectNextCallAt = 0.0
+        self._slot = None
+        # increased on every start to ignore results from earlier runs
+        self._generation = 0
+        self._busy = False
+
+    def start(self, interval, now=True, start_delay=None, count_start=0):
+        """
+        Start running function every interval seconds.
+
+        start_delay: The number of seconds before starting.
+                     If None, wait interval seconds. Only
+                     valid is now is False.
+        count_start: the task will track how many times it has run.
+                     this will change where it starts counting from.
+                     This will count also if force_repeat() was called.
+        """
+        assert not self.running, ("Tried to start an already running "
+                                  "TimerTask.")
+        if interval < 0:
+            raise ValueError, "interval must be >= 0"
+        self.running = True
+        self._generation += 1
+        self._busy = False
+        d = self.deferred = Deferred()
+        self.starttime = self.clock.seconds()
+        self.interval = interval
+        self.callcount = max(0, count_start)
+
+        if now:
+            self._expectNextCallAt = self.starttime
+            self()
+        else:
+            if start_delay is not None and start_delay >= 0:
+                self.start_delay = start_delay
+                self._expectNextCallAt = self.starttime + start_delay
+            else:
+                self._expectNextCallAt = self.starttime + interval
+            self.wheel.schedule(self, self._expectNextCallAt)
+        return d
+
+    def stop(self):
+        "Stop running the function."
+        assert self.running, ("Tried to stop a TimerTask that was "
+                              "not running.")
+        self.running = False
+        self.wheel.unschedule(self)
+        d, self.deferred = self.deferred, None
+        d.callback(self)
+
+    def __call__(self):
+        "Tick one step"
+        self.callcount += 1
+        self.start_delay = None
+        self._busy = True
+        generation = self._generation
+
+        def cb(result):
+            if self.running and self._generation == generation:
+                self._busy = False
+                self._reschedule()
+            elif self._generation == generation:
+                self._busy = False
+
+        def eb(failure):
+            if self._generation == generation:
+                self._busy = False
+                self.running = False
+                self.wheel.unschedule(self)
+                d, self.deferred = self.deferred, None
+                if d is not None:
+                    # not if we were stopped while running
+                    d.errback(failure)
+
+        maybeDeferred(self.f, *self.a, **self.kw).addCallback(cb).addErrback(eb)
+
+    def _reschedule(self):
+        """
+        Schedule the next call, skipping intervals that have
+        already passed.
+        """
+        now = self.clock.seconds()
+        if self.interval == 0:
+            self._expectNextCallAt = now
+        else:
+            nextcall = self._expectNextCallAt + self.interval
+            if nextcall <= now:
+                # we fell behind; skip the missed calls
+                skipped = int((now - self._expectNextCallAt) / self.interval)
+                nextcall = self._expectNextCallAt + (skipped + 1) * self.interval
+            self._expectNextCallAt = nextcall
+        self.wheel.schedule(self, self._expectNextCallAt)
+
+    def force_repeat(self):
+        "Force-fire the callback"
+        assert self.running, ("Tried to fire a TimerTask "
+                              "that was not running.")
+        if not self._busy:
+            self.wheel.unschedule(self)
+            self._expectNextCallAt = self.clock.seconds()
+            self()
+
+    def next_call_time(self):
+        """
+        Return the time in seconds until the next call. This takes
+        start_delay into account.
+        """
+        if self.running:
+            return self._expectNextCallAt - self.clock.seconds()
+        return None
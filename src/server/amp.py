@@ -18,15 +18,18 @@ Server - (AMP server) Handles all mud operations. The server holds its own list
 
 # imports needed on both server and portal side
 import os
+import zlib
 from collections import defaultdict
 try:
     import cPickle as pickle
 except ImportError:
     import pickle
+from django.conf import settings
 from twisted.protocols import amp
-from twisted.internet import protocol
+from twisted.internet import protocol, reactor
 from twisted.internet.defer import Deferred
 from src.utils.utils import to_str, variable_from_module
+from src.utils import logger
 
 # communication bits
 
@@ -44,6 +47,12 @@ PCONNSYNC = chr(10)   # portal post-syncing a session
 MAXLEN = 65535  # max allowed data length in AMP protocol
 _MSGBUFFER = defaultdict(list)
 
+_AMP_BATCH_MESSAGES = settings.AMP_BATCH_MESSAGES
+_AMP_COMPRESS_MIN_SIZE = settings.AMP_COMPRESS_MIN_SIZE
+# prefixes marking the encoding of a batch of messages
+_BATCH_PICKLED = "p"
+_BATCH_ZLIB = "z"
+
 def get_restart_mode(restart_file):
     """
     Parse the server/portal restart status
@@ -162,6 +171,34 @@ class MsgServer2Portal(amp.Command):
     response = []
 
 
+class MsgPortal2ServerBatch(amp.Command):
+    """
+    Batch of messages portal -> server. The data is a
+    list of (sessid, msg, pickled kwargs) packed with pack_batch.
+    """
+    key = "MsgPortal2ServerBatch"
+    arguments = [('sessid', amp.Integer()),
+                 ('ipart', amp.Integer()),
+                 ('nparts', amp.Integer()),
+                 ('data', amp.String())]
+    errors = [(Exception, 'EXCEPTION')]
+    response = []
+
+
+class MsgServer2PortalBatch(amp.Command):
+    """
+    Batch of messages server -> portal. The data is a
+    list of (sessid, msg, pickled kwargs) packed with pack_batch.
+    """
+    key = "MsgServer2PortalBatch"
+    arguments = [('sessid', amp.Integer()),
+                 ('ipart', amp.Integer()),
+                 ('nparts', amp.Integer()),
+                 ('data', amp.String())]
+    errors = [(Exception, 'EXCEPTION')]
+    response = []
+
+
 class ServerAdmin(amp.Command):
     """
     Portal -> Server
@@ -218,6 +255,40 @@ class FunctionCall(amp.Command):
 dumps = lambda data: to_str(pickle.dumps(data, pickle.HIGHEST_PROTOCOL))
 loads = lambda data: pickle.loads(to_str(data))
 
+
+def pack_batch(records):
+    """
+    Pickle a list of (sessid, msg, pickled kwargs) records into one
+    string, compressing it if it is larger than
+    settings.AMP_COMPRESS_MIN_SIZE.
+    """
+    data = dumps(records)
+    if _AMP_COMPRESS_MIN_SIZE and len(data) >= _AMP_COMPRESS_MIN_SIZE:
+        return _BATCH_ZLIB + zlib.compress(data)
+    return _BATCH_PICKLED + data
+
+
+def unpack_batch(data):
+    """
+    Unpack a string created by pack_batch into a list of
+    (sessid, msg, kwargs). Records with the same pickled kwargs
+    share the same kwargs dict.
+    """
+    data = to_str(data)
+    if data[0] == _BATCH_ZLIB:
+        records = loads(zlib.decompress(data[1:]))
+    else:
+        records = loads(data[1:])
+    unpickled = {}
+    unpacked = []
+    for sessid, msg, pickled in records:
+        try:
+            kwargs = unpickled[pickled]
+        except KeyError:
+            kwargs = unpickled[pickled] = loads(pickled)
+        unpacked.append((sessid, msg, kwargs))
+    return unpacked
+
 # multipart message store
 
 
@@ -236,6 +307,15 @@ class AMPProtocol(amp.AMP):
     subclasses that specify the datatypes of the input/output of these methods.
     """
 
+    def __init__(self, *args, **kwargs):
+        "Set up the message batch"
+        amp.AMP.__init__(self, *args, **kwargs)
+        self.send_batch = []
+        # {id(data): (data, pickled data)} for the current batch
+        self.send_batch_pickles = {}
+        self.send_batch_command = None
+        self.send_batch_call = None
+
     # helper methods
 
     def connectionMade(self):
@@ -309,6 +389,41 @@ class AMPProtocol(amp.AMP):
                                  **part_kwargs).addErrback(self.errback, command.key))
             return deferreds
 
+    def batch_send(self, command, sessid, msg, data):
+        """
+        Add a message to the batch to send. All messages added during
+        the same reactor iteration are sent together by flush_batch
+        at the start of the next iteration. The data is pickled right
+        away, so later changes to it are not sent. The same data
+        object is only pickled once per batch, so it is also only
+        sent once (as when sending to many sessions).
+        """
+        try:
+            pickled = self.send_batch_pickles[id(data)][1]
+        except KeyError:
+            pickled = dumps(data)
+            # keep data alive so its id is not reused during this batch
+            self.send_batch_pickles[id(data)] = (data, pickled)
+        self.send_batch.append((sessid, msg, pickled))
+        self.send_batch_command = command
+        if not self.send_batch_call:
+            self.send_batch_call = reactor.callLater(0, self.flush_batch)
+
+    def flush_batch(self):
+        """
+        Send all batched messages in one go. This is also called
+        before any other command is sent, to keep the order of
+        messages and admin operations intact.
+        """
+        if self.send_batch_call:
+            if self.send_batch_call.active():
+                self.send_batch_call.cancel()
+            self.send_batch_call = None
+        if self.send_batch:
+            records, self.send_batch = self.send_batch, []
+            self.send_batch_pickles = {}
+            return self.safe_send(self.send_batch_command, 0, data=pack_batch(records))
+
     def safe_recv(self, command, sessid, ipart, nparts, **kwargs):
         """
         Safely decode potentially split data coming over the wire. No
@@ -363,10 +478,30 @@ class AMPProtocol(amp.AMP):
         Access method called by the Portal and executed on the Portal.
         """
         #print "msg portal->server (portal side):", sessid, msg, data
+        if _AMP_BATCH_MESSAGES:
+            return self.batch_send(MsgPortal2ServerBatch, sessid,
+                                   msg if msg is not None else "", data)
         return self.safe_send(MsgPortal2Server, sessid,
                               msg=msg if msg is not None else "",
                               data=dumps(data))
 
+    def amp_msg_portal2server_batch(self, sessid, ipart, nparts, data):
+        """
+        Relays a batch of messages to the server. This method is
+        executed on the Server.
+        """
+        ret = self.safe_recv(MsgPortal2ServerBatch, sessid, ipart, nparts, data=data)
+        if ret is not None:
+            data_in = self.factory.server.sessions.data_in
+            for sessid, msg, kwargs in unpack_batch(ret["data"]):
+                try:
+                    data_in(sessid, text=msg, **kwargs)
+                except Exception:
+                    # don't let one message stop the rest of the batch
+                    logger.log_trace()
+        return {}
+    MsgPortal2ServerBatch.responder(amp_msg_portal2server_batch)
+
     # Server -> Portal message
 
     def amp_msg_server2portal(self, sessid, ipart, nparts, msg, data):
@@ -388,10 +523,30 @@ class AMPProtocol(amp.AMP):
         Access method called by the Server and executed on the Server.
         """
         #print "msg server->portal (server side):", sessid, msg, data
+        if _AMP_BATCH_MESSAGES:
+            return self.batch_send(MsgServer2PortalBatch, sessid,
+                                   msg if msg is not None else "", data)
         return self.safe_send(MsgServer2Portal, sessid,
                               msg=msg if msg is not None else "",
                               data=dumps(data))
 
+    def amp_msg_server2portal_batch(self, sessid, ipart, nparts, data):
+        """
+        Relays a batch of messages to the Portal. This method is
+        executed on the Portal.
+        """
+        ret = self.safe_recv(MsgServer2PortalBatch, sessid, ipart, nparts, data=data)
+        if ret is not None:
+            data_out = self.factory.portal.sessions.data_out
+            for sessid, msg, kwargs in unpack_batch(ret["data"]):
+                try:
+                    data_out(sessid, text=msg, **kwargs)
+                except Exception:
+                    # don't let one message stop the rest of the batch
+                    logger.log_trace()
+        return {}
+    MsgServer2PortalBatch.responder(amp_msg_server2portal_batch)
+
     # Server administration from the Portal side
     def amp_server_admin(self, sessid, ipart, nparts, operation, data):
         """
@@ -437,6 +592,7 @@ class AMPProtocol(amp.AMP):
         Access method called by the Portal and Executed on the Portal.
         """
         #print "serveradmin (portal side):", sessid, ord(operation), data
+        self.flush_batch()
         data = dumps(data)
         return self.safe_send(ServerAdmin, sessid, operation=operation, data=data)
 
@@ -489,6 +645,7 @@ class AMPProtocol(amp.AMP):
         """
         Access method called by the server side.
         """
+        self.flush_batch()
         self.safe_send(PortalAdmin, sessid, operation=operation, data=dumps(data))
 
     # Extra functions
@@ -528,6 +685,7 @@ class AMPProtocol(amp.AMP):
             A deferred that fires with the return value of the remote
             function call
         """
+        self.flush_batch()
         return self.callRemote(FunctionCall,
                                module=modulepath,
                                function=functionname,
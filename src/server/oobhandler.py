@@ -35,7 +35,6 @@ messages.
 """
 
 from inspect import isfunction
-from twisted.internet.defer import inlineCallbacks
 from django.conf import settings
 from src.server.models import ServerConfig
 from src.server.sessionhandler import SESSIONS
@@ -211,17 +210,12 @@ class OOBTicker(Ticker):
     Version of Ticker that executes an executable rather than trying to call
     a hook method.
     """
-    @inlineCallbacks
-    def _callback(self):
+    def _tick_subscriber(self, obj, args, kwargs):
         "See original for more info"
-        for key, (_, args, kwargs) in self.subscriptions.items():
-            # args = (sessid, callback_function)
-            session = SESSIONS.session_from_sessid(args[0])
-            try:
-                # execute the oob callback
-                yield args[1](OOB_HANDLER, session, *args[2:], **kwargs)
-            except Exception:
-                logger.log_trace()
+        # args = (sessid, callback_function)
+        session = SESSIONS.session_from_sessid(args[0])
+        # execute the oob callback
+        return args[1](OOB_HANDLER, session, *args[2:], **kwargs)
 
 class OOBTickerPool(TickerPool):
     ticker_class = OOBTicker
@@ -54,6 +54,7 @@ SSH_INTERFACES = settings.SSH_INTERFACES
 WEBSERVER_INTERFACES = settings.WEBSERVER_INTERFACES
 WEBSOCKET_CLIENT_INTERFACE = settings.WEBSOCKET_CLIENT_INTERFACE
 WEBSOCKET_CLIENT_URL = settings.WEBSOCKET_CLIENT_URL
+WEBSOCKET_CLIENT_DEFLATE = settings.WEBSOCKET_CLIENT_DEFLATE
 
 TELNET_ENABLED = settings.TELNET_ENABLED and TELNET_PORTS and TELNET_INTERFACES
 SSL_ENABLED = settings.SSL_ENABLED and SSL_PORTS and SSL_INTERFACES
@@ -284,7 +285,8 @@ if WEBSERVER_ENABLED:
                     factory = protocol.ServerFactory()
                     factory.protocol = websocket_client.WebSocketClient
                     factory.sessionhandler = PORTAL_SESSIONS
-                    websocket_service = internet.TCPServer(port, WebSocketFactory(factory), interface=interface)
+                    wsfactory = WebSocketFactory(factory, deflate=WEBSOCKET_CLIENT_DEFLATE)
+                    websocket_service = internet.TCPServer(port, wsfactory, interface=interface)
                     websocket_service.setName('EvenniaWebSocket%s' % pstring)
                     PORTAL.services.addService(websocket_service)
                     websocket_started = True
@@ -15,12 +15,19 @@ found on http://localhost:8000/webclient.)
                  The WebClient resource in this module will
                  handle these requests and act as a gateway
                  to sessions connected over the webclient.
+
+Messages to a session are buffered and a waiting receive request is
+answered at the end of the reactor turn, so a burst of messages goes
+out in one response rather than one round-trip per message. Clients
+sending batch=1 with their receive requests get all buffered entries
+as a JSON list, others get one entry per request.
 """
 import time
 import json
 
 from hashlib import md5
 
+from twisted.internet import reactor
 from twisted.web import server, resource
 
 from django.utils.functional import Promise
@@ -61,9 +68,15 @@ class WebClient(resource.Resource):
     isLeaf = True
     allowedMethods = ('POST',)
 
-    def __init__(self):
+    def __init__(self, clock=reactor):
+        """
+        clock - the reactor (or a task.Clock when testing)
+        """
+        self.clock = clock
         self.requests = {}
         self.databuffer = {}
+        # {suid: DelayedCall} for answering waiting requests
+        self.sendcalls = {}
 
     #def getChild(self, path, request):
     #    """
@@ -80,28 +93,55 @@ class WebClient(resource.Resource):
 
     def lineSend(self, suid, string, data=None):
         """
-        This adds the data to the buffer and/or sends it to
-        the client as soon as possible.
+        This adds the data to the buffer. If a request is
+        waiting, it is answered at the end of this reactor
+        turn, with everything buffered until then.
+        """
+        self.databuffer.setdefault(suid, []).append({'msg': string, 'data': data})
+        if suid in self.requests and suid not in self.sendcalls:
+            self.sendcalls[suid] = self.clock.callLater(0, self.sendBuffer, suid)
+
+    def pop_entries(self, suid, request):
+        """
+        Remove buffered entries for suid and return them as the
+        response to request; as a list if the client handles
+        batches, otherwise only the first entry.
         """
+        dataentries = self.databuffer.get(suid)
+        if not dataentries:
+            return None
+        if request.args.get('batch', ['0'])[0] == '1':
+            self.databuffer[suid] = []
+            return jsonify(dataentries)
+        return jsonify(dataentries.pop(0))
+
+    def sendBuffer(self, suid):
+        """
+        Answer the waiting request for suid, if any.
+        """
+        self.sendcalls.pop(suid, None)
         request = self.requests.get(suid)
         if request:
-            # we have a request waiting. Return immediately.
-            request.write(jsonify({'msg': string, 'data': data}))
-            request.finish()
-            del self.requests[suid]
-        else:
-            # no waiting request. Store data in buffer
-            dataentries = self.databuffer.get(suid, [])
-            dataentries.append(jsonify({'msg': string, 'data': data}))
-            self.databuffer[suid] = dataentries
+            response = self.pop_entries(suid, request)
+            if response is not None:
+                del self.requests[suid]
+                request.write(response)
+                request.finish()
 
     def client_disconnect(self, suid):
         """
         Disconnect session with given suid.
         """
+        sendcall = self.sendcalls.pop(suid, None)
+        if sendcall and sendcall.active():
+            sendcall.cancel()
         if suid in self.requests:
-            self.requests[suid].finish()
-            del self.requests[suid]
+            # send any last messages, such as the reason for disconnecting
+            request = self.requests.pop(suid)
+            response = self.pop_entries(suid, request)
+            if response is not None:
+                request.write(response)
+            request.finish()
         if suid in self.databuffer:
             del self.databuffer[suid]
 
@@ -157,9 +197,9 @@ class WebClient(resource.Resource):
         if suid == '0':
             return ''
 
-        dataentries = self.databuffer.get(suid, [])
-        if dataentries:
-            return dataentries.pop(0)
+        response = self.pop_entries(suid, request)
+        if response is not None:
+            return response
         request.notifyFinish().addErrback(self._responseFailed, suid, request)
         if suid in self.requests:
             self.requests[suid].finish()  # Clear any stale request.
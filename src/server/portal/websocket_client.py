@@ -17,6 +17,13 @@ where the dict is JSON encoded. The initial OOB-prefix
 is used to identify this type of communication, all other data
 is considered plain text (command input).
 
+Data sent to the client is JSON encoded: a dict of the data_out
+keywords (text, prompt, oob ...). Messages sent in the same reactor
+turn (such as a burst of combat messages) are batched into a single
+websocket frame holding a JSON list of such dicts. If
+settings.WEBSOCKET_CLIENT_DEFLATE is set, the frames are also
+compressed for clients supporting the permessage-deflate extension.
+
 Example of call from a javascript client:
 
     websocket = new WeSocket("ws://localhost:8021")
@@ -28,6 +35,7 @@ Example of call from a javascript client:
 
 """
 import json
+from twisted.internet import reactor
 from twisted.internet.protocol import Protocol
 from src.server.session import Session
 from src.utils.logger import log_trace
@@ -39,6 +47,11 @@ class WebSocketClient(Protocol, Session):
     """
     Implements the server-side of the Websocket connection.
     """
+    # the reactor (or a task.Clock when testing)
+    clock = reactor
+    # messages waiting to be sent, and the DelayedCall sending them
+    outbuffer = None
+    sendcall = None
 
     def connectionMade(self):
         """
@@ -57,6 +70,7 @@ class WebSocketClient(Protocol, Session):
         """
         if reason:
             self.data_out(text=reason)
+        self.sendBuffer()
         self.connectionLost(reason)
 
     def connectionLost(self, reason):
@@ -65,6 +79,9 @@ class WebSocketClient(Protocol, Session):
         whatever reason. it can also be called directly, from
         the disconnect method
         """
+        if self.sendcall and self.sendcall.active():
+            self.sendcall.cancel()
+        self.outbuffer = None
         self.sessionhandler.disconnect(self)
         self.transport.close()
 
@@ -99,6 +116,20 @@ class WebSocketClient(Protocol, Session):
         "send data to client"
         return self.transport.write(line)
 
+    def sendBuffer(self):
+        """
+        Send all messages buffered this reactor turn as one frame.
+        A single message is sent as a JSON dict, several as a JSON
+        list of dicts.
+        """
+        self.sendcall = None
+        outbuffer, self.outbuffer = self.outbuffer, None
+        if outbuffer:
+            if len(outbuffer) == 1:
+                self.sendLine(json.dumps(outbuffer[0], sort_keys=True))
+            else:
+                self.sendLine(json.dumps(outbuffer, sort_keys=True))
+
     def data_in(self, text=None, **kwargs):
         """
         Data Websocket -> Server
@@ -132,6 +163,8 @@ class WebSocketClient(Protocol, Session):
             if "prompt" in kwargs:
                 kwargs["prompt"] = parse_html(kwargs["prompt"], strip_ansi=nomarkup)
 
-        data = json.dumps(kwargs, sort_keys=True)
-        self.sendLine(data)
+        if self.outbuffer is None:
+            self.outbuffer = []
+            self.sendcall = self.clock.callLater(0, self.sendBuffer)
+        self.outbuffer.append(kwargs)
 
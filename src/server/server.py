@@ -234,6 +234,8 @@ class Evennia(object):
         #print "run_init_hooks:", ObjectDB.get_all_cached_instances()
         [(o.typeclass, o.at_init()) for o in ObjectDB.get_all_cached_instances()]
         [(p.typeclass, p.at_init()) for p in PlayerDB.get_all_cached_instances()]
+        # load the contents of all cached locations in one go
+        ObjectDB.objects.preload_contents()
 
         with open(SERVER_RESTART, 'r') as f:
             mode = f.read()
@@ -348,6 +350,9 @@ class Evennia(object):
         gametime.save()
 
         self.at_server_stop()
+        # save in-place changes to Attributes not yet written
+        from src.utils.dbserialize import flush
+        flush()
         # if _reactor_stopping is true, reactor does not need to
         # be stopped again.
         if os.name == 'nt' and os.path.exists(SERVER_PIDFILE):
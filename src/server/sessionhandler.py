@@ -17,6 +17,7 @@ from django.conf import settings
 from src.commands.cmdhandler import CMD_LOGINSTART
 from src.utils.utils import variable_from_module, is_iter, \
                             to_str, to_unicode, strip_control_sequences
+from src.utils.inlinefunc import has_inlinefunc
 try:
     import cPickle as pickle
 except ImportError:
@@ -47,6 +48,7 @@ from django.utils.translation import ugettext as _
 SERVERNAME = settings.SERVERNAME
 MULTISESSION_MODE = settings.MULTISESSION_MODE
 IDLE_TIMEOUT = settings.IDLE_TIMEOUT
+INLINEFUNC_ENABLED = settings.INLINEFUNC_ENABLED
 
 
 def delayed_import():
@@ -480,6 +482,32 @@ class ServerSessionHandler(SessionHandler):
                                                               msg=text,
                                                               data=kwargs)
 
+    def data_out_multi(self, sessions, text="", **kwargs):
+        """
+        Sending the same data Server -> Portal to many sessions.
+
+        The text is only converted once per session encoding, and the
+        same text and keyword objects are queued for every session so
+        a batched AMP payload only pickles and carries them once (see
+        AMPProtocol.batch_send). Inlinefuncs may
+        depend on the session and are rendered per session, but only
+        if the text actually contains any.
+        """
+        text = text if text else ""
+        if INLINEFUNC_ENABLED and not "raw" in kwargs and has_inlinefunc(text):
+            for session in sessions:
+                session.data_out(text=text, **kwargs)
+            return
+        send = self.server.amp_protocol.call_remote_MsgServer2Portal
+        rendered = {}
+        for session in sessions:
+            encoding = session.encoding
+            try:
+                msg = rendered[encoding]
+            except KeyError:
+                msg = rendered[encoding] = text and to_str(to_unicode(text), encoding=encoding)
+            send(sessid=session.sessid, msg=msg, data=kwargs)
+
     def data_in(self, sessid, text="", **kwargs):
         """
         Data Portal -> Server
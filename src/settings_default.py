@@ -73,6 +73,10 @@ WEBSOCKET_CLIENT_INTERFACE = '0.0.0.0'
 # Actual URL for webclient component to reach the websocket. The first
 # port number in the WEBSOCKET_PORTS list will be automatically appended.
 WEBSOCKET_CLIENT_URL = "ws://localhost"
+# Compress websocket messages (the permessage-deflate extension) for browsers
+# supporting it. This trades some cpu for much less bandwidth when many
+# messages are sent, at a cost of some extra memory per connection.
+WEBSOCKET_CLIENT_DEFLATE = True
 # Activate SSH protocol communication (SecureShell)
 SSH_ENABLED = False
 # Ports to use for SSH
@@ -143,30 +147,43 @@ ENCODINGS = ["utf-8", "latin-1", "ISO-8859-1"]
 AMP_HOST = 'localhost'
 AMP_PORT = 5000
 AMP_INTERFACE = '127.0.0.1'
+# All messages sent between Server and Portal during one reactor
+# iteration are normally coalesced into a single AMP call. This greatly
+# reduces the overhead of sending to many sessions at once, such as
+# when broadcasting. Messages in such a batch that are larger than
+# AMP_COMPRESS_MIN_SIZE bytes will also be zlib-compressed (set to
+# None to turn off compression).
+AMP_BATCH_MESSAGES = True
+AMP_COMPRESS_MIN_SIZE = 4096
 # Database objects are cached in what is known as the idmapper. The idmapper
 # caching results in a massive speedup of the server (since it dramatically
 # limits the number of database accesses needed) and also allows for
 # storing temporary data on objects. It is however also the main memory
-# consumer of Evennia. With this setting the cache can be capped and
-# flushed when it reaches a certain size. Minimum is 50 MB but it is
-# not recommended to set this to less than 100 MB for a distribution
-# system.
-# Empirically, N_objects_in_cache ~ ((RMEM - 35) / 0.0157):
-#  mem(MB)   |  objs in cache   ||   mem(MB)   |   objs in cache
-#      50    |       ~1000      ||      800    |     ~49 000
-#     100    |       ~4000      ||     1200    |     ~75 000
-#     200    |      ~10 000     ||     1600    |    ~100 000
-#     500    |      ~30 000     ||     2000    |    ~125 000
-# Note that the estimated memory usage is not exact (and the cap is only
-# checked every 5 minutes), so err on the side of caution if
-# running on a server with limited memory. Also note that Python
-# will not necessarily return the memory to the OS when the idmapper
-# flashes (the memory will be freed and made available to the Python
-# process only). How many objects need to be in memory at any given
-# time depends very much on your game so some experimentation may
-# be necessary (use @server to see how many objects are in the idmapper
-# cache at any time). Setting this to None disables the cache cap.
-IDMAPPER_CACHE_MAXSIZE = 200      # (MB)
+# consumer of Evennia. With this setting the cache of each type of
+# entity (Objects, Players, Attributes etc) can be capped to a max
+# number of entries. Every few minutes, caches above their cap are
+# trimmed by evicting the entities not recently used (to be re-loaded
+# from the database when next needed). Entities with connected
+# sessions or with non-persistent (ndb) data stored on them are never
+# evicted, nor are the locations of such Objects.
+# How many objects need to be in memory at any given time depends very
+# much on your game so some experimentation may be necessary (use
+# @server to see how many objects are in the idmapper cache and how
+# often they are evicted). Setting this to None disables the cache cap.
+IDMAPPER_CACHE_MAX_ENTRIES = 100000
+# Timed Scripts, Tickers and OOB tickers all share one timer wheel that
+# groups their due times into slots of this many seconds. Each slot
+# costs only one reactor call no matter how many timers are due in
+# it. A timer may fire up to this many seconds late, but never early.
+TIMER_WHEEL_RESOLUTION = 0.1
+# The TickerHandler spreads the objects subscribing to the same interval
+# over up to this many evenly spaced slots, so they are not all ticked at
+# the same moment. Each object is always ticked once per interval. Set to
+# 1 to tick all objects at once.
+TICKER_SLOTS = 10
+# If ticking objects takes longer than this many seconds, the ticker lets
+# the server handle other things (like player input) before continuing.
+TICKER_SLICE_BUDGET = 0.05
 
 ######################################################################
 # Evennia Database config
@@ -239,6 +256,12 @@ MSSP_META_MODULE = ""
 # Tuple of modules implementing lock functions. All callable functions
 # inside these modules will be available as lock functions.
 LOCK_FUNC_MODULES = ("src.locks.lockfuncs",)
+# Cache the result of lock checks per accessing object. Only locks
+# made up entirely of lock functions marked as cacheable (see
+# src/locks/lockfuncs.py) are cached. The cache is invalidated when
+# the permissions, tags or Attributes of the accessing or accessed
+# object change, or when the locks themselves change.
+LOCK_DECISION_CACHE = False
 # Module holding OOB (Out of Band) hook objects. This allows for customization
 # and expansion of which hooks OOB protocols are allowed to call on the server
 # protocols for attaching tracker hooks for when various object field change
@@ -267,6 +290,10 @@ CMDSET_CHARACTER = "src.commands.default.cmdset_character.CharacterCmdSet"
 CMDSET_PLAYER = "src.commands.default.cmdset_player.PlayerCmdSet"
 # Location to search for cmdsets if full path not given
 CMDSET_PATHS = ["game.gamesrc.commands"]
+# The cmdsets merged for a command are cached on their content, so
+# callers with the same cmdsets share the merge. This is the max number
+# of merged cmdsets kept; least recently used merges are dropped first.
+CMDSET_MERGE_CACHE_SIZE = 1000
 
 ######################################################################
 # Typeclasses and other paths
@@ -318,6 +345,27 @@ START_LOCATION = "#2"
 # out of sync between the processes. Keep on unless you face such
 # issues.
 TYPECLASS_AGGRESSIVE_CACHE = True
+# The decoded values of Attributes are cached (if aggressive caching
+# is on) so they don't have to be unpickled on every access. This is
+# the max total size of the cache, in units of roughly one stored
+# element (or 64 characters of string data). Least recently used
+# values are evicted first. Set to 0 to turn off the value cache.
+ATTRIBUTE_VALUE_CACHE_SIZE = 200000
+# Attribute values are normally stored in the database as pickles. If
+# this is set, values made up only of standard python types (strings,
+# numbers, lists, dicts, database objects etc) are instead stored in a
+# binary format that is about twice as fast to load (but takes a
+# little more space). Existing pickled values are still read, but
+# note that searching for objects by Attribute value will not find
+# values stored in the other format.
+ATTRIBUTE_BINARY_FORMAT = False
+# Changing a list, dict or set stored in an Attribute in-place (like
+# obj.db.mylist.append(1)) saves the whole Attribute value. With
+# write-behind, such changes are instead saved only once, when the
+# current command (or reactor iteration) ends. Code that needs the
+# changes in the database right away can call
+# src.utils.dbserialize.flush().
+ATTRIBUTE_WRITE_BEHIND = True
 
 ######################################################################
 # Batch processors
@@ -1,4 +1,23 @@
 import unittest
+from src.commands.command import Command
+from src.commands.cmdset import CmdSet
+from src.utils.utils import string_suggestions
+
+class _DbObj(object):
+    "Stands in for a database object with an id"
+    def __init__(self, id):
+        self.id = id
+        self.dbobj = self
+
+class _CmdLook(Command):
+    key = "look"
+
+class _CmdInventory(Command):
+    key = "inventory"
+
+class _StampCmdSet(CmdSet):
+    def at_cmdset_creation(self):
+        self.add(_CmdLook)
 
 class test__CmdSetMeta(unittest.TestCase):
     def test___init__(self):
@@ -55,6 +74,40 @@ class TestCmdSet(unittest.TestCase):
         # self.assertEqual(expected, cmd_set.get_all_cmd_keys_and_aliases(caller))
         assert True # TODO: implement your test here
 
+    def test_get_cmd_suggestions(self):
+        class _CmdSet(CmdSet):
+            def at_cmdset_creation(self):
+                for key, aliases in (("look", ["l", "ls"]), ("inventory", ["inv", "i"]),
+                                     ("@teleport", ["@tel"]), ("home", [])):
+                    self.add(type(key, (Command,), {"key": key, "aliases": aliases}))
+        cmd_set = _CmdSet()
+        for string in ("lok", "invtory", "@telport", "hom", "xyz"):
+            self.assertEqual(string_suggestions(string, cmd_set.get_all_cmd_keys_and_aliases(),
+                                                cutoff=0.5, maxnum=2),
+                             cmd_set.get_cmd_suggestions(string, cutoff=0.5, maxnum=2))
+        index = cmd_set._suggestion_index
+        cmd_set.get_cmd_suggestions("lok")
+        self.assertTrue(index is cmd_set._suggestion_index)
+        cmd_set.remove("look")
+        self.assertEqual([], cmd_set.get_cmd_suggestions("look", cutoff=0.9))
+
+    def test_get_version_stamp(self):
+        # the stamp compares content rather than hashes or object ids
+        stamp = _StampCmdSet(_DbObj(1)).get_version_stamp()
+        self.assertEqual(stamp, _StampCmdSet(_DbObj(1)).get_version_stamp())
+        self.assertEqual(hash(stamp), hash(_StampCmdSet(_DbObj(1)).get_version_stamp()))
+        # commands defined on another object
+        self.assertNotEqual(stamp, _StampCmdSet(_DbObj(2)).get_version_stamp())
+        # adding and removing commands
+        cmd_set = _StampCmdSet(_DbObj(1))
+        cmd_set.add(_CmdInventory)
+        added = cmd_set.get_version_stamp()
+        self.assertNotEqual(stamp, added)
+        cmd_set.remove(_CmdInventory)
+        removed = cmd_set.get_version_stamp()
+        self.assertNotEqual(added, removed)
+        self.assertEqual(removed, cmd_set.get_version_stamp())
+
     def test_get_system_cmds(self):
         # cmd_set = CmdSet(cmdsetobj, key)
         # self.assertEqual(expected, cmd_set.get_system_cmds())
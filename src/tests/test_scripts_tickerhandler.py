@@ -1,4 +1,12 @@
 import unittest
+from django.test import TestCase
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from twisted.internet.task import Clock
+from src.server.models import ServerConfig
+from src.scripts.timerwheel import TimerWheel, TimerTask
+from src.scripts.tickerhandler import Ticker, TickerHandler
+from src.utils import create
 
 class TestTicker(unittest.TestCase):
     def test___init__(self):
@@ -80,5 +88,93 @@ class TestTickerHandler(unittest.TestCase):
         # self.assertEqual(expected, ticker_handler.save())
         assert True # TODO: implement your test here
 
+class _Ticking(object):
+    def __init__(self, key, ticks):
+        self.key, self.ticks = key, ticks
+    def at_tick(self, *args, **kwargs):
+        self.ticks.append(self.key)
+
+class TestTickerDispatch(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.ticker = Ticker(6)
+        self.ticker.task = TimerTask(self.ticker._callback, _wheel=TimerWheel(0.1, clock=self.clock))
+        self.ticks = []
+        for i in range(100):
+            self.ticker.add((i, 6, ""), _Ticking(i, self.ticks))
+
+    def test_spread(self):
+        self.assertEqual(10, self.ticker.nslots)
+        # the subscribers are spread over the interval ...
+        self.clock.advance(0.61)
+        self.assertTrue(0 < len(self.ticks) < 100)
+        for _ in range(9):
+            self.clock.advance(0.6)
+        # ... but all are called once per interval
+        self.assertEqual(range(100), sorted(self.ticks))
+        # and always in the same slot
+        first = list(self.ticks)
+        del self.ticks[:]
+        for _ in range(10):
+            self.clock.advance(0.6)
+        self.assertEqual(first, self.ticks)
+        self.assertEqual(200, self.ticker.stats["calls"])
+        self.assertTrue(self.ticker.stats["max_lag"] < 0.1)
+
+    def test_catch_up(self):
+        # a late call also calls the slots that were skipped
+        self.clock.advance(6)
+        self.assertEqual(range(100), sorted(self.ticks))
+        self.assertTrue(self.ticker.stats["max_lag"] > 5)
+
+    def test_remove(self):
+        for i in range(50):
+            self.ticker.remove((i, 6, ""))
+        self.clock.advance(6)
+        self.assertEqual(range(50, 100), sorted(self.ticks))
+        self.ticker.stop()
+        self.assertFalse(self.ticker.task.running)
+
+class TestTickerHandlerStorage(TestCase):
+    def setUp(self):
+        self.objs = [create.create_object("src.objects.objects.Object", key="TickObj%i" % i) for i in range(5)]
+        self.handler = TickerHandler("test_ticker_storage")
+        self.handler.journal_min_compact = 3
+
+    def tearDown(self):
+        self.handler.ticker_pool.stop()
+
+    def _restored(self):
+        handler = TickerHandler("test_ticker_storage")
+        handler.restore()
+        handler.ticker_pool.stop()
+        return handler
+
+    def test_journal(self):
+        self.handler.save()
+        with CaptureQueriesContext(connection) as context:
+            self.handler.add(self.objs[0], 10, "test")
+        # a single insert, regardless of the number of tickers
+        self.assertEqual(1, len(context.captured_queries))
+        self.handler.add(self.objs[1], 10)
+        self.handler.remove(self.objs[0], 10, "test")
+        self.assertEqual(3, ServerConfig.objects.filter(db_key__startswith="test_ticker_storage__").count())
+        self.assertEqual(self.handler.ticker_storage.keys(), self._restored().ticker_storage.keys())
+        # restoring merges the changes
+        self.assertFalse(ServerConfig.objects.filter(db_key__startswith="test_ticker_storage__").exists())
+
+    def test_compact(self):
+        self.handler.save()
+        for _ in range(10):
+            self.handler.add(self.objs[0], 10)
+            self.handler.remove(self.objs[0], 10)
+            # the changes never outnumber the tickers for long
+            self.assertTrue(self.handler.journal_size <= 3)
+        for obj in self.objs:
+            self.handler.add(obj, 10)
+        self.assertEqual(5, len(self._restored().ticker_storage))
+        self.handler.clear(10)
+        self.assertEqual({}, self._restored().ticker_storage)
+
 if __name__ == '__main__':
     unittest.main()
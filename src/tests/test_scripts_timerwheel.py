@@ -0,0 +1,139 @@
+import gc
+import unittest
+from twisted.internet.task import Clock
+from twisted.python import log
+from twisted.internet.defer import Deferred
+from src.scripts.timerwheel import TimerWheel, TimerTask
+
+
+class TestTimerTask(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.wheel = TimerWheel(resolution=0.1, clock=self.clock)
+        self.calls = []
+
+    def _task(self, func=None):
+        return TimerTask(func or (lambda: self.calls.append(self.clock.seconds())), _wheel=self.wheel)
+
+    def test_start(self):
+        task = self._task()
+        task.start(5, now=True)
+        self.assertEqual(1, task.callcount)
+        self.clock.advance(4.9)
+        self.assertEqual(1, task.callcount)
+        self.clock.advance(0.1)
+        self.assertEqual(2, task.callcount)
+        self.clock.advance(10)
+        # missed calls are skipped, not bunched up
+        self.assertEqual(3, task.callcount)
+        self.assertEqual(5, task.next_call_time())
+        task.stop()
+        self.clock.advance(10)
+        self.assertEqual(3, task.callcount)
+        self.assertEqual(None, task.next_call_time())
+
+    def test_start_delay(self):
+        task = self._task()
+        task.start(5, now=False, start_delay=2, count_start=3)
+        self.assertEqual(2, task.next_call_time())
+        self.clock.advance(2)
+        self.assertEqual(4, task.callcount)
+        self.assertEqual(5, task.next_call_time())
+
+    def test_force_repeat(self):
+        task = self._task()
+        task.start(5, now=False)
+        self.clock.advance(2)
+        task.force_repeat()
+        self.assertEqual(1, task.callcount)
+        self.assertEqual(5, task.next_call_time())
+        self.clock.advance(3)
+        self.assertEqual(1, task.callcount)
+        self.clock.advance(2)
+        self.assertEqual(2, task.callcount)
+
+    def test_deferred(self):
+        deferreds = []
+        def func():
+            deferreds.append(Deferred())
+            return deferreds[-1]
+        task = self._task(func)
+        task.start(1, now=True)
+        self.clock.advance(3)
+        # waiting for the first call to finish
+        self.assertEqual(1, task.callcount)
+        deferreds[0].callback(None)
+        self.clock.advance(1)
+        self.assertEqual(2, task.callcount)
+
+    def test_stop_in_callback(self):
+        def func():
+            if task.interval == 1:
+                task.stop()
+                task.start(2, now=False)
+        task = self._task(func)
+        task.start(1, now=False)
+        self.clock.advance(1)
+        # restarting resets the count
+        self.assertEqual(0, task.callcount)
+        self.assertEqual(2, task.next_call_time())
+        self.clock.advance(2)
+        self.assertEqual(1, task.callcount)
+
+    def test_error(self):
+        def func():
+            raise RuntimeError("test")
+        errors = []
+        task = self._task(func)
+        task.start(1, now=False).addErrback(errors.append)
+        self.clock.advance(1)
+        self.assertFalse(task.running)
+        self.assertEqual(1, len(errors))
+
+    def test_error_after_stop(self):
+        deferreds = []
+        def func():
+            deferreds.append(Deferred())
+            return deferreds[-1]
+        stopped = []
+        task = self._task(func)
+        task.start(1, now=True).addCallback(stopped.append)
+        task.stop()
+        self.assertEqual([task], stopped)
+        # the call running when the task was stopped fails
+        logged = []
+        log.addObserver(logged.append)
+        try:
+            deferreds.pop().errback(RuntimeError("test"))
+            # unhandled errors are logged when the deferred is collected
+            gc.collect()
+        finally:
+            log.removeObserver(logged.append)
+        self.assertEqual([], [event for event in logged if event.get("isError")])
+        self.assertFalse(task.running)
+        self.clock.advance(2)
+        self.assertEqual(1, task.callcount)
+
+
+class TestTimerWheel(unittest.TestCase):
+    def test_buckets(self):
+        clock = Clock()
+        wheel = TimerWheel(resolution=0.5, clock=clock)
+        tasks = [TimerTask(lambda: None, _wheel=wheel) for _ in range(1000)]
+        for i, task in enumerate(tasks):
+            task.start(6, now=False, start_delay=i % 2 * 0.5)
+        # all tasks fit in two slots and only one reactor call is used
+        self.assertEqual(2, len(wheel.slotheap))
+        self.assertEqual(1, len(clock.getDelayedCalls()))
+        clock.advance(0.2)
+        clock.advance(0.3)
+        stats = wheel.stats()
+        self.assertEqual(1000, stats["tasks"])
+        self.assertEqual(1000, stats["callbacks"])
+        self.assertEqual(2, stats["ticks"])
+        self.assertEqual(500, stats["max_callbacks_per_tick"])
+        for task in tasks[:500]:
+            task.stop()
+        self.assertEqual(500, wheel.stats()["tasks"])
+        clock.advance(6.5)
+        self.assertEqual(1500, wheel.stats()["callbacks"])
@@ -1,4 +1,20 @@
 import unittest
+from twisted.internet.defer import Deferred
+from src.server.amp import (AMPProtocol, MsgServer2PortalBatch, PortalAdmin, FunctionCall,
+                            SLOGIN, dumps, loads, pack_batch, unpack_batch)
+
+class _AMPRecorder(AMPProtocol):
+    "AMPProtocol storing what it sends instead of sending it"
+    def __init__(self):
+        AMPProtocol.__init__(self)
+        self.sent = []
+
+    def safe_send(self, command, sessid, **kwargs):
+        self.sent.append((command, sessid, kwargs))
+
+    def callRemote(self, command, **kwargs):
+        self.sent.append((command, None, kwargs))
+        return Deferred()
 
 class TestGetRestartMode(unittest.TestCase):
     def test_get_restart_mode(self):
@@ -50,6 +66,21 @@ class TestLoads(unittest.TestCase):
         # self.assertEqual(expected, loads(data))
         assert True # TODO: implement your test here
 
+class TestPackBatch(unittest.TestCase):
+    def test_round_trip(self):
+        records = [(1, "Hello", {"custom": [1, 2]}), (2, u"W\xf6rld", {})]
+        data = pack_batch([(sessid, msg, dumps(kwargs)) for sessid, msg, kwargs in records])
+        self.assertEqual("p", data[0])
+        self.assertEqual(records, unpack_batch(data))
+
+    def test_compression(self):
+        records = [(sessid, "x" * 1000, dumps({"prompt": "y" * 1000})) for sessid in range(10)]
+        data = pack_batch(records)
+        self.assertEqual("z", data[0])
+        self.assertTrue(len(data) < 1000)
+        self.assertEqual([(sessid, msg, loads(kwargs)) for sessid, msg, kwargs in records],
+                         unpack_batch(data))
+
 class TestAMPProtocol(unittest.TestCase):
     def test_amp_function_call(self):
         # a_mp_protocol = AMPProtocol()
@@ -77,9 +108,12 @@ class TestAMPProtocol(unittest.TestCase):
         assert True # TODO: implement your test here
 
     def test_call_remote_FunctionCall(self):
-        # a_mp_protocol = AMPProtocol()
-        # self.assertEqual(expected, a_mp_protocol.call_remote_FunctionCall(modulepath, functionname, *args, **kwargs))
-        assert True # TODO: implement your test here
+        amp = _AMPRecorder()
+        amp.batch_send(MsgServer2PortalBatch, 1, "Hello", {})
+        amp.call_remote_FunctionCall("src.utils.utils", "to_str", "test")
+        # the batch is sent before the function call
+        self.assertEqual([MsgServer2PortalBatch, FunctionCall], [rec[0] for rec in amp.sent])
+        self.assertEqual(None, amp.send_batch_call)
 
     def test_call_remote_MsgPortal2Server(self):
         # a_mp_protocol = AMPProtocol()
@@ -91,10 +125,51 @@ class TestAMPProtocol(unittest.TestCase):
         # self.assertEqual(expected, a_mp_protocol.call_remote_MsgServer2Portal(sessid, msg, data))
         assert True # TODO: implement your test here
 
+    def test_batch_send(self):
+        amp = _AMPRecorder()
+        kwargs = {"custom": [1]}
+        amp.batch_send(MsgServer2PortalBatch, 1, "Hello", kwargs)
+        amp.batch_send(MsgServer2PortalBatch, 2, "World", kwargs)
+        # changes after queueing are not sent
+        kwargs["custom"].append(2)
+        self.assertEqual([], amp.sent)
+        amp.flush_batch()
+        self.assertEqual(1, len(amp.sent))
+        command, sessid, sent = amp.sent[0]
+        self.assertEqual(MsgServer2PortalBatch, command)
+        self.assertEqual([(1, "Hello", {"custom": [1]}), (2, "World", {"custom": [1]})],
+                         unpack_batch(sent["data"]))
+        self.assertEqual(None, amp.send_batch_call)
+        amp.flush_batch()
+        self.assertEqual(1, len(amp.sent))
+
+    def test_batch_send_shared_data(self):
+        amp = _AMPRecorder()
+        kwargs = {"prompt": "> " * 100}
+        for sessid in range(10):
+            amp.batch_send(MsgServer2PortalBatch, sessid, "Hello", kwargs)
+        # the kwargs are pickled and sent only once
+        self.assertTrue(all(rec[2] is amp.send_batch[0][2] for rec in amp.send_batch))
+        amp.flush_batch()
+        self.assertEqual({}, amp.send_batch_pickles)
+        data = amp.sent[0][2]["data"]
+        self.assertTrue(len(data) < 2 * len(dumps(kwargs)))
+        records = unpack_batch(data)
+        self.assertEqual([(sessid, "Hello", kwargs) for sessid in range(10)], records)
+        self.assertTrue(all(rec[2] is records[0][2] for rec in records))
+
     def test_call_remote_PortalAdmin(self):
-        # a_mp_protocol = AMPProtocol()
-        # self.assertEqual(expected, a_mp_protocol.call_remote_PortalAdmin(sessid, operation, data))
-        assert True # TODO: implement your test here
+        amp = _AMPRecorder()
+        amp.batch_send(MsgServer2PortalBatch, 1, "Hello", {})
+        amp.call_remote_PortalAdmin(1, operation=SLOGIN, data={"uid": 1})
+        amp.batch_send(MsgServer2PortalBatch, 1, "Welcome", {})
+        amp.flush_batch()
+        # messages and admin operations are sent in order
+        self.assertEqual([MsgServer2PortalBatch, PortalAdmin, MsgServer2PortalBatch],
+                         [rec[0] for rec in amp.sent])
+        self.assertEqual([(1, "Hello", {})], unpack_batch(amp.sent[0][2]["data"]))
+        self.assertEqual({"uid": 1}, loads(amp.sent[1][2]["data"]))
+        self.assertEqual([(1, "Welcome", {})], unpack_batch(amp.sent[2][2]["data"]))
 
     def test_call_remote_ServerAdmin(self):
         # a_mp_protocol = AMPProtocol()
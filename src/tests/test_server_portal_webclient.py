@@ -0,0 +1,85 @@
+import json
+import unittest
+from twisted.internet.task import Clock
+from twisted.web.server import NOT_DONE_YET
+from twisted.web.test.requesthelper import DummyRequest
+from src.server.portal.webclient import WebClient
+from src.server.portal.websocket_client import WebSocketClient
+
+
+def _request(**args):
+    request = DummyRequest([])
+    request.args = dict((key, [val]) for key, val in args.items())
+    return request
+
+
+class TestWebClient(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.client = WebClient(clock=self.clock)
+
+    def test_batch(self):
+        client = self.client
+        request = _request(mode="receive", suid="abc", batch="1")
+        self.assertEqual(NOT_DONE_YET, client.mode_receive(request))
+        for i in range(3):
+            client.lineSend("abc", "msg%i" % i)
+        # the waiting request is answered once, at the end of the reactor turn
+        self.assertEqual(0, request.finished)
+        self.clock.advance(0)
+        self.assertEqual(1, request.finished)
+        self.assertEqual(["msg0", "msg1", "msg2"],
+                         [entry["msg"] for entry in json.loads("".join(request.written))])
+        # buffered entries are all returned by the next request
+        client.lineSend("abc", "msg3")
+        client.lineSend("abc", "msg4")
+        response = client.mode_receive(_request(mode="receive", suid="abc", batch="1"))
+        self.assertEqual(["msg3", "msg4"], [entry["msg"] for entry in json.loads(response)])
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+    def test_no_batch(self):
+        client = self.client
+        client.lineSend("abc", "msg0")
+        client.lineSend("abc", "msg1")
+        # clients not asking for batches get one entry at a time
+        response = client.mode_receive(_request(mode="receive", suid="abc"))
+        self.assertEqual({"msg": "msg0", "data": None}, json.loads(response))
+        response = client.mode_receive(_request(mode="receive", suid="abc"))
+        self.assertEqual({"msg": "msg1", "data": None}, json.loads(response))
+
+    def test_disconnect(self):
+        client = self.client
+        request = _request(mode="receive", suid="abc", batch="1")
+        client.mode_receive(request)
+        client.lineSend("abc", "Goodbye!")
+        client.client_disconnect("abc")
+        self.assertEqual(1, request.finished)
+        self.assertEqual("Goodbye!", json.loads("".join(request.written))[0]["msg"])
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+
+class _Transport(object):
+    def __init__(self):
+        self.frames = []
+
+    def write(self, data):
+        self.frames.append(data)
+
+
+class TestWebSocketClient(unittest.TestCase):
+    def test_batch(self):
+        client = WebSocketClient()
+        client.clock = Clock()
+        client.transport = _Transport()
+        client.encoding = "utf-8"
+        client.data_out("{rYou hit.{n", raw=True)
+        client.data_out("The goblin hits.", raw=True)
+        self.assertEqual([], client.transport.frames)
+        client.clock.advance(0)
+        # both messages are sent in one frame
+        self.assertEqual(1, len(client.transport.frames))
+        self.assertEqual([{"text": "{rYou hit.{n"}, {"text": "The goblin hits."}],
+                         json.loads(client.transport.frames[0]))
+        client.data_out("Ouch!", raw=True)
+        client.clock.advance(0)
+        self.assertEqual({"text": "Ouch!"}, json.loads(client.transport.frames[1]))
@@ -1,4 +1,7 @@
 import unittest
+from src.objects.models import ObjectDB
+from src.objects.objects import Object
+from src.typeclasses.typeclass import CLASS_ATTR_CACHE, clear_class_attr_cache
 
 class TestMetaTypeClass(unittest.TestCase):
     def test___init__(self):
@@ -45,5 +48,62 @@ class TestTypeClass(unittest.TestCase):
         # self.assertEqual(expected, type_class.__unicode__())
         assert True # TODO: implement your test here
 
+class _TestObject(Object):
+    "Typeclass with a property, to check the lookup order"
+    testvalue = "typeclass"
+
+    @property
+    def failing(self):
+        raise AttributeError("failing")
+
+
+class TestAttributeResolution(unittest.TestCase):
+    def setUp(self):
+        path = "%s.%s" % (_TestObject.__module__, _TestObject.__name__)
+        self.dbobj = ObjectDB(db_key="Tester", db_typeclass_path=path)
+        self.obj = self.dbobj.typeclass
+
+    def test_lookup(self):
+        obj, dbobj = self.obj, self.dbobj
+        self.assertEqual(_TestObject, type(obj))
+        # typeclass side, dbobj side and the typeclass instance
+        self.assertEqual("typeclass", obj.testvalue)
+        self.assertEqual("Tester", obj.key)
+        self.assertEqual(dbobj, obj.dbobj)
+        self.assertEqual(obj.at_msg_receive.im_func, dbobj.at_msg_receive.im_func)
+        self.assertEqual("typeclass", dbobj.testvalue)
+        self.assertTrue(CLASS_ATTR_CACHE[_TestObject]["testvalue"])
+        self.assertFalse(CLASS_ATTR_CACHE[_TestObject]["key"])
+        self.assertFalse(CLASS_ATTR_CACHE[ObjectDB]["testvalue"])
+        # properties failing on the typeclass are looked up on the dbobj
+        dbobj.failing = "dbobj"
+        self.assertEqual("dbobj", obj.failing)
+        self.assertRaises(AttributeError, getattr, obj, "nonexistent")
+        self.assertRaises(AttributeError, getattr, obj, "__nonexistent__")
+        self.assertRaises(AttributeError, getattr, dbobj, "_nonexistent")
+        # setting stores on the typeclass only if it has the attribute
+        obj.testvalue = "changed"
+        obj.newvalue = "new"
+        self.assertEqual("changed", obj.__dict__["testvalue"])
+        self.assertEqual("new", dbobj.__dict__["newvalue"])
+        self.assertEqual("new", obj.newvalue)
+        clear_class_attr_cache()
+        self.assertEqual({}, CLASS_ATTR_CACHE)
+        self.assertEqual("changed", obj.testvalue)
+
+    def test_class_change(self):
+        obj = self.obj
+        self.assertRaises(AttributeError, getattr, obj, "classvalue")
+        self.assertFalse(CLASS_ATTR_CACHE[_TestObject]["classvalue"])
+        # changing the typeclass in-place clears the cache
+        _TestObject.classvalue = "class"
+        try:
+            self.assertEqual("class", obj.classvalue)
+            self.assertEqual("class", self.dbobj.classvalue)
+        finally:
+            del _TestObject.classvalue
+        self.assertRaises(AttributeError, getattr, obj, "classvalue")
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,104 @@
+import unittest
+import zlib
+from twisted.internet.protocol import Protocol, ServerFactory
+from twisted.test.proto_helpers import StringTransport
+from src.utils.txws import (WebSocketFactory, WSException, make_hybi07_frame,
+                            parse_hybi07_frames, parse_deflate_offer, deflate,
+                            inflate, mask, NORMAL, MAX_INFLATED_LENGTH)
+
+REQUEST = ("GET / HTTP/1.1\r\n"
+           "Host: localhost\r\n"
+           "Upgrade: websocket\r\n"
+           "Connection: Upgrade\r\n"
+           "Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n"
+           "Sec-WebSocket-Version: 13\r\n"
+           "%s\r\n")
+
+
+class _Receiver(Protocol):
+    def connectionMade(self):
+        self.received = []
+
+    def dataReceived(self, data):
+        self.received.append(data)
+
+
+class TestDeflateFrames(unittest.TestCase):
+    def test_parse_deflate_offer(self):
+        self.assertEqual(None, parse_deflate_offer(""))
+        self.assertEqual({}, parse_deflate_offer("x-webkit-deflate-frame, permessage-deflate"))
+        self.assertEqual({"client_max_window_bits": None},
+                         parse_deflate_offer("permessage-deflate; client_max_window_bits"))
+        # an 8-bit window can't be honoured, so use the next offer
+        self.assertEqual({"server_max_window_bits": "10"},
+                         parse_deflate_offer("permessage-deflate; server_max_window_bits=8, "
+                                             "permessage-deflate; server_max_window_bits=10"))
+
+    def test_compressed_frames(self):
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        decompressor = zlib.decompressobj(-15)
+        msg = "You hit the goblin. " * 20
+        frames = "".join(make_hybi07_frame(deflate(compressor, msg), compressed=True)
+                         for _ in range(2))
+        # the second message reuses the context of the first
+        self.assertTrue(len(frames) < len(msg) / 2)
+        parsed, rest = parse_hybi07_frames(frames, inflater=lambda data: inflate(decompressor, data))
+        self.assertEqual([(NORMAL, msg), (NORMAL, msg)], parsed)
+        self.assertEqual("", rest)
+        # compressed frames are refused unless the extension is in use
+        self.assertRaises(WSException, parse_hybi07_frames, frames)
+
+    def test_inflate_max_length(self):
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        decompressor = zlib.decompressobj(-15)
+        msg = "x" * (MAX_INFLATED_LENGTH + 1)
+        frame = make_hybi07_frame(deflate(compressor, msg), compressed=True)
+        self.assertTrue(len(frame) < 2048)
+        self.assertRaises(WSException, parse_hybi07_frames, frame,
+                          inflater=lambda data: inflate(decompressor, data))
+        # messages of exactly max_length are fine
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        self.assertEqual("x" * 100, inflate(zlib.decompressobj(-15),
+                                            deflate(compressor, "x" * 100), max_length=100))
+
+
+class TestWebSocketDeflate(unittest.TestCase):
+    def _connect(self, extensions, deflate=True):
+        factory = ServerFactory()
+        factory.protocol = _Receiver
+        proto = WebSocketFactory(factory, deflate=deflate).buildProtocol(None)
+        transport = StringTransport()
+        proto.makeConnection(transport)
+        proto.dataReceived(REQUEST % extensions)
+        return proto, transport
+
+    def test_handshake(self):
+        proto, transport = self._connect("Sec-WebSocket-Extensions: permessage-deflate\r\n")
+        self.assertTrue("Sec-WebSocket-Extensions: permessage-deflate\r\n" in transport.value())
+        proto, transport = self._connect("Sec-WebSocket-Extensions: permessage-deflate\r\n",
+                                         deflate=False)
+        self.assertFalse("Sec-WebSocket-Extensions" in transport.value())
+        proto, transport = self._connect("")
+        self.assertFalse("Sec-WebSocket-Extensions" in transport.value())
+
+    def test_send_receive(self):
+        proto, transport = self._connect("Sec-WebSocket-Extensions: permessage-deflate; "
+                                         "server_no_context_takeover\r\n")
+        self.assertTrue("server_no_context_takeover" in transport.value())
+        transport.clear()
+        proto.write("Hello")
+        proto.write("Hello")
+        decompressor = zlib.decompressobj(-15)
+        frames, rest = parse_hybi07_frames(transport.value(),
+                                           inflater=lambda data: inflate(decompressor, data))
+        self.assertEqual([(NORMAL, "Hello"), (NORMAL, "Hello")], frames)
+        # without context takeover, each message is compressed alone
+        first = make_hybi07_frame(deflate(zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
+                                                           zlib.DEFLATED, -15), "Hello"),
+                                  compressed=True)
+        self.assertEqual(first * 2, transport.value())
+        # masked, compressed client frames are inflated
+        payload = deflate(zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15), "look")
+        key = "\x01\x02\x03\x04"
+        proto.dataReceived("\xc1" + chr(0x80 | len(payload)) + key + mask(payload, key))
+        self.assertEqual(["look"], proto.wrappedProtocol.received)
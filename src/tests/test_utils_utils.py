@@ -177,6 +177,18 @@ class TestStringSuggestions(unittest.TestCase):
         # self.assertEqual(expected, string_suggestions(string, vocabulary, cutoff, maxnum))
         assert True # TODO: implement your test here
 
+class TestStringSimilarityIndex(unittest.TestCase):
+    def test_suggestions(self):
+        vocabulary = ["look", "l", "get", "drop", "inventory", "i", "inv", "say", "'", "",
+                      "@teleport", "@tel", "pose", "emote", "look", "home", "@open", "@dig"]
+        index = utils.StringSimilarityIndex(vocabulary)
+        for string in ("lok", "invetnory", "teelport", "dorp", "xyz", "", "@", "oo"):
+            for cutoff in (0.0, 0.5, 0.7, 0.9):
+                for maxnum in (1, 3, None):
+                    self.assertEqual(utils.string_suggestions(string, vocabulary, cutoff, maxnum),
+                                     index.suggestions(string, cutoff, maxnum))
+        self.assertEqual(["look", "look"], index.suggestions("lokk", maxnum=2))
+
 class TestStringPartialMatching(unittest.TestCase):
     def test_string_partial_matching(self):
         # self.assertEqual(expected, string_partial_matching(alternatives, inp, ret_index))
@@ -30,8 +30,10 @@ import sys
 import re
 import traceback
 import weakref
+from collections import OrderedDict
 
 from django.db import models
+from django.db.models.signals import pre_delete, class_prepared
 from django.core.exceptions import ObjectDoesNotExist
 from django.conf import settings
 from django.utils.encoding import smart_str
@@ -43,11 +45,14 @@ from src.server.caches import get_prop_cache, set_prop_cache
 #from src.server.caches import call_ndb_hooks
 from src.server.models import ServerConfig
 from src.typeclasses import managers
-from src.locks.lockhandler import LockHandler
+from src.typeclasses.typeclass import (CLASS_ATTR_CACHE, resolve_class_attr,
+                                       clear_class_attr_cache)
+from src.locks.lockhandler import LockHandler, touch_lockstate
 from src.utils import logger
 from src.utils.utils import (
     make_iter, is_iter, to_str, inherits_from, lazy_property)
-from src.utils.dbserialize import to_pickle, from_pickle
+from src.utils.dbserialize import (to_pickle, from_pickle, measure_pickle,
+                                   get_pending, discard_pending)
 from src.utils.picklefield import PickledObjectField
 
 __all__ = ("Attribute", "TypeNick", "TypedObject")
@@ -56,6 +61,7 @@ TICKER_HANDLER = None
 
 _PERMISSION_HIERARCHY = [p.lower() for p in settings.PERMISSION_HIERARCHY]
 _TYPECLASS_AGGRESSIVE_CACHE = settings.TYPECLASS_AGGRESSIVE_CACHE
+_ATTRIBUTE_VALUE_CACHE_SIZE = settings.ATTRIBUTE_VALUE_CACHE_SIZE
 
 _GA = object.__getattribute__
 _SA = object.__setattr__
@@ -68,6 +74,60 @@ _DA = object.__delattr__
 #
 #------------------------------------------------------------
 
+# Cache of decoded Attribute values. This maps id(Attribute) ->
+# (Attribute, size) and is kept in least-recently-used order. The total size of all cached
+# values is kept below settings.ATTRIBUTE_VALUE_CACHE_SIZE.
+_ATTRIBUTE_VALUE_CACHE = OrderedDict()
+_ATTRIBUTE_VALUE_CACHE_USED = 0
+# this is increased whenever a database object is deleted or changes
+# typeclass, invalidating all cached values referencing a database
+# object.
+_DBOBJ_GENERATION = 0
+
+
+def _uncache_attribute_value(attr):
+    "Remove the cached decoded value of attr, if any"
+    global _ATTRIBUTE_VALUE_CACHE_USED
+    _SA(attr, "_value_cache", None)
+    entry = _ATTRIBUTE_VALUE_CACHE.pop(id(attr), None)
+    if entry:
+        _ATTRIBUTE_VALUE_CACHE_USED -= entry[1]
+
+
+def _cache_attribute_value(attr, value, size, has_dbobj):
+    "Cache the decoded value of attr, evicting old values as needed"
+    global _ATTRIBUTE_VALUE_CACHE_USED
+    _uncache_attribute_value(attr)
+    while _ATTRIBUTE_VALUE_CACHE and _ATTRIBUTE_VALUE_CACHE_USED + size > _ATTRIBUTE_VALUE_CACHE_SIZE:
+        old_attr, old_size = _ATTRIBUTE_VALUE_CACHE.popitem(last=False)[1]
+        _SA(old_attr, "_value_cache", None)
+        _ATTRIBUTE_VALUE_CACHE_USED -= old_size
+    _SA(attr, "_value_cache", (value, _DBOBJ_GENERATION if has_dbobj else None))
+    _ATTRIBUTE_VALUE_CACHE[id(attr)] = (attr, size)
+    _ATTRIBUTE_VALUE_CACHE_USED += size
+
+
+def _invalidate_dbobj_values():
+    "Invalidate all cached values containing database objects"
+    global _DBOBJ_GENERATION
+    _DBOBJ_GENERATION += 1
+
+
+def _uncache_on_delete(sender, instance, **kwargs):
+    "Signal handler called before a database object is deleted"
+    if isinstance(instance, Attribute):
+        _uncache_attribute_value(instance)
+    else:
+        _invalidate_dbobj_values()
+pre_delete.connect(_uncache_on_delete)
+
+
+def _uncache_class_attrs(sender, **kwargs):
+    "Signal handler called when a model class (and its relations) is set up"
+    clear_class_attr_cache()
+class_prepared.connect(_uncache_class_attrs)
+
+
 class Attribute(SharedMemoryModel):
     """
     Abstract django model.
@@ -98,7 +158,7 @@ class Attribute(SharedMemoryModel):
     # named same as the field, but withtout the db_* prefix.
     db_key = models.CharField('key', max_length=255, db_index=True)
     db_value = PickledObjectField(
-        'value', null=True,
+        'value', null=True, binary=settings.ATTRIBUTE_BINARY_FORMAT,
         help_text="The data returned when the attribute is accessed. Must be "
                   "written as a Python literal if editing through the admin "
                   "interface. Attribute values which are not Python literals "
@@ -129,6 +189,12 @@ class Attribute(SharedMemoryModel):
     # Database manager
     #objects = managers.AttributeManager()
 
+    # the object this Attribute is stored on, set by the AttributeHandler
+    # so that direct value changes can update its lock state.
+    _lockstate_owner = None
+    # (value, dbobj_generation) of the last decoded value
+    _value_cache = None
+
     @lazy_property
     def locks(self):
         return LockHandler(self)
@@ -168,24 +234,51 @@ class Attribute(SharedMemoryModel):
     def __value_get(self):
         """
         Getter. Allows for value = self.value.
-        We cannot cache here since it makes certain cases (such
-        as storing a dbobj which is then deleted elsewhere) out-of-sync.
-        The overhead of unpickling seems hard to avoid.
+        The decoded value is cached, so mutables are only re-built
+        when the value changes. Values containing database objects
+        are re-decoded whenever a database object was deleted (or
+        changed typeclass) since they were cached. Values with custom
+        (non-standard) objects are never cached, since these could be
+        changed in-place without being saved.
         """
-        return from_pickle(self.db_value, db_obj=self)
+        cache = self._value_cache
+        if cache and (cache[1] is None or cache[1] == _DBOBJ_GENERATION):
+            # move to the end of the LRU order
+            _ATTRIBUTE_VALUE_CACHE[id(self)] = _ATTRIBUTE_VALUE_CACHE.pop(id(self))
+            return cache[0]
+        value = get_pending(self)
+        if value is not None:
+            # changed nested mutables not yet saved
+            return value
+        db_value = self.db_value
+        value = from_pickle(db_value, db_obj=self)
+        if _TYPECLASS_AGGRESSIVE_CACHE and _ATTRIBUTE_VALUE_CACHE_SIZE:
+            size, has_dbobj, has_mutable, has_other = measure_pickle(db_value)
+            # mutables are only safe to cache if they will save themselves
+            # on change (i.e. are _Saver* iterables under the root).
+            if (not has_other and size <= _ATTRIBUTE_VALUE_CACHE_SIZE and
+                    (not has_mutable or type(db_value) in (list, dict, set))):
+                _cache_attribute_value(self, value, size, has_dbobj)
+        return value
 
     #@value.setter
     def __value_set(self, new_value):
         """
-        Setter. Allows for self.value = value. We cannot cache here,
-        see self.__value_get.
+        Setter. Allows for self.value = value. This resets the
+        cache of the decoded value. This is also called when nested
+        mutables in the value are updated.
         """
+        discard_pending(self)
+        _uncache_attribute_value(self)
         self.db_value = to_pickle(new_value)
         self.save(update_fields=["db_value"])
+        if self._lockstate_owner:
+            touch_lockstate(self._lockstate_owner)
 
     #@value.deleter
     def __value_del(self):
         "Deleter. Allows for del attr.value. This removes the entire attribute."
+        discard_pending(self)
         self.delete()
     value = property(__value_get, __value_set, __value_del)
 
@@ -223,6 +316,7 @@ class AttributeHandler(object):
     Handler for adding Attributes to the object.
     """
     _m2m_fieldname = "db_attributes"
+    _handlername = "attributes"
     _attrcreate = "attrcreate"
     _attredit = "attredit"
     _attrread = "attrread"
@@ -235,14 +329,53 @@ class AttributeHandler(object):
         self._model = to_str(obj.__class__.__name__.lower())
         self._cache = None
 
+    def _cache_attr(self, attr):
+        "Add a single Attribute to the cache"
+        attr._lockstate_owner = self.obj
+        self._cache["%s-%s" % (to_str(attr.db_key).lower(),
+                               attr.db_category.lower() if attr.db_category else None)] = attr
+
     def _recache(self):
         "Cache all attributes of this object"
         query = {"%s__id" % self._model : self._objid,
                  "attribute__db_attrtype" : self._attrtype}
-        attrs = [conn.attribute for conn in getattr(self.obj, self._m2m_fieldname).through.objects.filter(**query)]
-        self._cache = dict(("%s-%s" % (to_str(attr.db_key).lower(),
-                                       attr.db_category.lower() if conn.attribute.db_category else None),
-                            attr) for attr in attrs)
+        attrs = [conn.attribute for conn in getattr(self.obj, self._m2m_fieldname).through.objects.filter(
+                                                    **query).select_related("attribute")]
+        self._cache = {}
+        for attr in attrs:
+            self._cache_attr(attr)
+
+    @classmethod
+    def preload(cls, objs):
+        """
+        Load and cache the Attributes of many objects using a single
+        database query, for example all objects in a room:
+
+            AttributeHandler.preload(room.contents)
+
+        All objs must be of the same database model. Objects whose
+        handler is already cached are skipped unless
+        TYPECLASS_AGGRESSIVE_CACHE is off.
+        """
+        cls._preload([getattr(obj, cls._handlername) for obj in make_iter(objs) if obj])
+
+    @classmethod
+    def _preload(cls, handlers):
+        "Load the caches of a list of handlers. See preload()."
+        handlers = dict((handler._objid, handler) for handler in handlers
+                        if handler._cache is None or not _TYPECLASS_AGGRESSIVE_CACHE)
+        if not handlers:
+            return
+        handler = handlers.values()[0]
+        model = handler._model
+        query = {"%s__id__in" % model : handlers.keys(),
+                 "attribute__db_attrtype" : cls._attrtype}
+        conns = getattr(handler.obj, cls._m2m_fieldname).through.objects.filter(
+                                            **query).select_related("attribute")
+        for handler in handlers.values():
+            handler._cache = {}
+        for conn in conns:
+            handlers[getattr(conn, "%s_id" % model)]._cache_attr(conn.attribute)
 
     def has(self, key, category=None):
         """
@@ -359,7 +492,8 @@ class AttributeHandler(object):
             new_attr = Attribute(**kwargs)
             new_attr.save()
             getattr(self.obj, self._m2m_fieldname).add(new_attr)
-            self._cache[cachekey] = new_attr
+            self._cache_attr(new_attr)
+        touch_lockstate(self.obj)
 
 
     def batch_add(self, key, value, category=None, lockstring="",
@@ -385,36 +519,67 @@ class AttributeHandler(object):
 
         if len(keys) != len(values):
             raise RuntimeError("AttributeHandler.add(): key and value of different length: %s vs %s" % key, value)
+        self._bulk_add([self], [zip(keys, values)], category=category, strattr=strattr)
+
+    @classmethod
+    def bulk_add(cls, objs, attributes, category=None, strattr=False):
+        """
+        Add Attributes to many objects at once. All new Attributes
+        are inserted into the database using a few queries
+        in total. No access checks are done.
+
+        objs - list of objects of the same database model.
+        attributes - list of the same length as objs, each element
+                     being a dict or list of (key, value) pairs to
+                     add to the corresponding object. Existing
+                     Attributes with the same key+category are updated.
+        """
+        cls._bulk_add([getattr(obj, cls._handlername) for obj in objs], attributes,
+                      category=category, strattr=strattr)
+
+    @classmethod
+    def _bulk_add(cls, handlers, attributes, category=None, strattr=False):
+        "Add Attributes to a list of handlers. See bulk_add()."
+        if not handlers:
+            return
+        # load the caches of all objects at once
+        cls._preload(handlers)
         category = category.strip().lower() if category is not None else None
         new_attrobjs = []
-        for ikey, keystr in enumerate(keys):
-            keystr = keystr.strip().lower()
-            new_value = values[ikey]
-            cachekey = "%s-%s" % (keystr, category)
-            attr_obj = self._cache.get(cachekey)
+        for handler, attrs in zip(handlers, attributes):
+            if not attrs:
+                continue
+            for keystr, new_value in (attrs.items() if isinstance(attrs, dict) else attrs):
+                keystr = keystr.strip().lower()
+                attr_obj = handler._cache.get("%s-%s" % (keystr, category))
 
-            if attr_obj:
-                # update an existing attribute object
-                if strattr:
-                    # store as a simple string (will not notify OOB handlers)
-                    attr_obj.db_strvalue = new_value
-                    attr_obj.save(update_fields=["db_strvalue"])
+                if attr_obj:
+                    # update an existing attribute object
+                    if strattr:
+                        # store as a simple string (will not notify OOB handlers)
+                        attr_obj.db_strvalue = new_value
+                        attr_obj.save(update_fields=["db_strvalue"])
+                    else:
+                        # store normally (this will also notify OOB handlers)
+                        attr_obj.value = new_value
                 else:
-                    # store normally (this will also notify OOB handlers)
-                    attr_obj.value = new_value
-            else:
-                # create a new Attribute (no OOB handlers can be notified)
-                kwargs = {"db_key" : keystr, "db_category" : category,
-                          "db_attrtype" : self._attrtype,
-                          "db_value" : None if strattr else to_pickle(new_value),
-                          "db_strvalue" : value if strattr else None}
-                new_attr = Attribute(**kwargs)
-                new_attr.save()
-                new_attrobjs.append(new_attr)
+                    # create a new Attribute (no OOB handlers can be notified)
+                    kwargs = {"db_key" : keystr, "db_category" : category,
+                              "db_model" : handler._model, "db_attrtype" : cls._attrtype,
+                              "db_value" : None if strattr else to_pickle(new_value),
+                              "db_strvalue" : new_value if strattr else None}
+                    new_attrobjs.append((handler, Attribute(**kwargs)))
         if new_attrobjs:
-            # Add new objects to m2m field all at once
-            getattr(self.obj, self._m2m_fieldname).add(*new_attrobjs)
-            self._recache()
+            # create all new Attributes and their m2m connections at once
+            Attribute.batch_create(attr for _, attr in new_attrobjs)
+            through = getattr(handlers[0].obj, cls._m2m_fieldname).through
+            objfield = "%s_id" % handlers[0]._model
+            through.objects.bulk_create([through(**{objfield: handler._objid, "attribute_id": attr.id})
+                                         for handler, attr in new_attrobjs])
+            for handler, attr in new_attrobjs:
+                handler._cache_attr(attr)
+        for handler in handlers:
+            touch_lockstate(handler.obj)
 
 
     def remove(self, key, raise_exception=False, category=None,
@@ -433,10 +598,12 @@ class AttributeHandler(object):
             if attr_obj:
                 if not (accessing_obj and not attr_obj.access(accessing_obj,
                         self._attredit, default=default_access)):
+                    discard_pending(attr_obj)
                     attr_obj.delete()
+                    del self._cache[searchstr]
             elif not attr_obj and raise_exception:
                 raise AttributeError
-        self._recache()
+        touch_lockstate(self.obj)
 
     def clear(self, category=None, accessing_obj=None, default_access=True):
         """
@@ -447,11 +614,18 @@ class AttributeHandler(object):
         if self._cache is None or not _TYPECLASS_AGGRESSIVE_CACHE:
             self._recache()
         if accessing_obj:
-            [attr.delete() for attr in self._cache.values()
-             if attr.access(accessing_obj, self._attredit, default=default_access)]
+            cachekeys = [cachekey for cachekey, attr in self._cache.items()
+                         if attr.access(accessing_obj, self._attredit, default=default_access)]
         else:
-            [attr.delete() for attr in self._cache.values()]
-        self._recache()
+            cachekeys = self._cache.keys()
+        if cachekeys:
+            # delete all in one query
+            for cachekey in cachekeys:
+                discard_pending(self._cache[cachekey])
+            Attribute.objects.filter(id__in=[self._cache[cachekey].id for cachekey in cachekeys]).delete()
+            for cachekey in cachekeys:
+                del self._cache[cachekey]
+        touch_lockstate(self.obj)
 
     def all(self, accessing_obj=None, default_access=True):
         """
@@ -479,6 +653,7 @@ class NickHandler(AttributeHandler):
     Nicks are stored as Attributes
     with categories nick_<nicktype>
     """
+    _handlername = "nicks"
     _attrtype = "nick"
 
     def has(self, key, category="inputline"):
@@ -616,6 +791,7 @@ class TagHandler(object):
     Generic tag-handler. Accessed via TypedObject.tags.
     """
     _m2m_fieldname = "db_tags"
+    _handlername = "tags"
     _tagtype = None
 
     def __init__(self, obj):
@@ -638,26 +814,91 @@ class TagHandler(object):
                                        tagobj.db_category.lower() if tagobj.db_category else None),
                             tagobj) for tagobj in tagobjs)
 
+    @classmethod
+    def preload(cls, objs):
+        """
+        Load and cache the tags of many objects (of the same database
+        model) using a single database query. Objects whose handler is
+        already cached are skipped unless TYPECLASS_AGGRESSIVE_CACHE
+        is off.
+        """
+        cls._preload([getattr(obj, cls._handlername) for obj in make_iter(objs) if obj])
+
+    @classmethod
+    def _preload(cls, handlers):
+        "Load the caches of a list of handlers. See preload()."
+        handlers = dict((handler._objid, handler) for handler in handlers
+                        if handler._cache is None or not _TYPECLASS_AGGRESSIVE_CACHE)
+        if not handlers:
+            return
+        handler = handlers.values()[0]
+        model = handler._model
+        query = {"%s__id__in" % model : handlers.keys(),
+                 "tag__db_tagtype" : cls._tagtype}
+        conns = getattr(handler.obj, cls._m2m_fieldname).through.objects.filter(
+                                            **query).select_related("tag")
+        for handler in handlers.values():
+            handler._cache = {}
+        for conn in conns:
+            tagobj = conn.tag
+            handlers[getattr(conn, "%s_id" % model)]._cache["%s-%s" % (
+                        to_str(tagobj.db_key).lower(),
+                        tagobj.db_category.lower() if tagobj.db_category else None)] = tagobj
+
+    @classmethod
+    def bulk_add(cls, objs, tags, category=None, data=None):
+        """
+        Add tags to many objects (of the same database model) at
+        once, using a few queries in total.
+
+        objs - list of objects.
+        tags - list of the same length as objs, each element being
+               a tag or list of tags to add to the corresponding object.
+        """
+        cls._bulk_add([getattr(obj, cls._handlername) for obj in objs], tags,
+                      category=category, data=data)
+
+    @classmethod
+    def _bulk_add(cls, handlers, tags, category=None, data=None):
+        "Add tags to a list of handlers. See bulk_add()."
+        if not handlers:
+            return
+        cls._preload(handlers)
+        category = category.strip().lower() if category is not None else None
+        data = str(data) if data is not None else None
+        manager = handlers[0].obj.__class__.objects
+        tagobjs = {}
+        new_conns = []
+        for handler, tagstrs in zip(handlers, tags):
+            for tagstr in make_iter(tagstrs):
+                if not tagstr:
+                    continue
+                tagstr = tagstr.strip().lower()
+                cachestring = "%s-%s" % (tagstr, category)
+                if cachestring not in tagobjs:
+                    # each unique tag is only looked up/created once. This
+                    # will overload data on an existing tag since that is
+                    # not considered part of making the tag unique.
+                    tagobjs[cachestring] = manager.create_tag(key=tagstr, category=category,
+                                                             data=data, tagtype=cls._tagtype)
+                if cachestring in handler._cache:
+                    continue
+                tagobj = tagobjs[cachestring]
+                handler._cache[cachestring] = tagobj
+                new_conns.append((handler, tagobj))
+        if new_conns:
+            through = getattr(handlers[0].obj, cls._m2m_fieldname).through
+            objfield = "%s_id" % handlers[0]._model
+            through.objects.bulk_create([through(**{objfield: handler._objid, "tag_id": tagobj.id})
+                                         for handler, tagobj in new_conns])
+        for handler in handlers:
+            touch_lockstate(handler.obj)
+
     def add(self, tag=None, category=None, data=None):
         "Add a new tag to the handler. Tag is a string or a list of strings."
         if not tag:
             return
-        for tagstr in make_iter(tag):
-            if not tagstr:
-                continue
-            tagstr = tagstr.strip().lower()
-            category = category.strip().lower() if category is not None else None
-            data = str(data) if data is not None else None
-            # this will only create tag if no matches existed beforehand (it
-            # will overload data on an existing tag since that is not
-            # considered part of making the tag unique)
-            tagobj = self.obj.__class__.objects.create_tag(key=tagstr, category=category, data=data,
-                                            tagtype=self._tagtype)
-            getattr(self.obj, self._m2m_fieldname).add(tagobj)
-            if self._cache is None:
-                self._recache()
-            cachestring = "%s-%s" % (tagstr, category)
-            self._cache[cachestring] = tagobj
+        self._bulk_add([self], [tag], category=category, data=data)
 
     def get(self, key, category="", return_tagobj=False):
         """
@@ -688,11 +929,13 @@ class TagHandler(object):
             if tagobj:
                 getattr(self.obj, self._m2m_fieldname).remove(tagobj[0])
         self._recache()
+        touch_lockstate(self.obj)
 
     def clear(self):
         "Remove all tags from the handler"
         getattr(self.obj, self._m2m_fieldname).clear()
         self._recache()
+        touch_lockstate(self.obj)
 
     def all(self, category=None, return_key_and_category=False):
         """
@@ -725,10 +968,12 @@ class TagHandler(object):
 
 
 class AliasHandler(TagHandler):
+    _handlername = "aliases"
     _tagtype = "alias"
 
 
 class PermissionHandler(TagHandler):
+    _handlername = "permissions"
     _tagtype = "permission"
 
 
@@ -794,6 +1039,9 @@ class TypedObject(SharedMemoryModel):
 
     # quick on-object typeclass cache for speed
     _cached_typeclass = None
+    # lock state, updated when permissions/tags/Attributes change (used
+    # by the lock decision cache, see src.locks.lockhandler)
+    _lockstate = 0
 
     # lock handler self.locks
     def __init__(self, *args, **kwargs):
@@ -880,17 +1128,28 @@ class TypedObject(SharedMemoryModel):
         the typeclass refers back to the databaseobject as well, we
         have to be very careful to avoid loops.
         """
+        cls = type(self)
         try:
-            return _GA(self, propname)
-        except AttributeError:
-            if propname.startswith('_'):
-                # don't relay private/special varname lookups to the typeclass
-                raise AttributeError("private property %s not found on db model (typeclass not searched)." % propname)
-            # check if the attribute exists on the typeclass instead
-            # (we make sure to not incur a loop by not triggering the
-            # typeclass' __getattribute__, since that one would
-            # try to look back to this very database object.)
-            return _GA(_GA(self, 'typeclass'), propname)
+            onclass = CLASS_ATTR_CACHE[cls][propname]
+        except KeyError:
+            onclass = resolve_class_attr(cls, propname)
+        if onclass:
+            try:
+                return _GA(self, propname)
+            except AttributeError:
+                pass
+        else:
+            instdict = _GA(self, '__dict__')
+            if propname in instdict:
+                return instdict[propname]
+        if propname.startswith('_'):
+            # don't relay private/special varname lookups to the typeclass
+            raise AttributeError("private property %s not found on db model (typeclass not searched)." % propname)
+        # check if the attribute exists on the typeclass instead
+        # (we make sure to not incur a loop by not triggering the
+        # typeclass' __getattribute__, since that one would
+        # try to look back to this very database object.)
+        return _GA(_GA(self, 'typeclass'), propname)
 
     def _hasattr(self, obj, attrname):
         """
@@ -1194,6 +1453,9 @@ class TypedObject(SharedMemoryModel):
                                    "right type instead." % self.key)
 
         _SA(self, "typeclass_path", new_typeclass.strip())
+        # cached Attribute values may hold the old typeclass instance
+        _invalidate_dbobj_values()
+        clear_class_attr_cache()
         # this will automatically use a default class if
         # there is an error with the given typeclass.
         new_typeclass = self.typeclass
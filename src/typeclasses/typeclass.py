@@ -30,6 +30,36 @@ PROTECTED = ('id', 'dbobj', 'db', 'ndb', 'objects', 'typeclass', 'db_player',
              'typeclass_paths')
 
 
+# Cache of which attribute names are defined on a class (or its
+# parents), as {class: {propname: bool}}. This lets the
+# __getattribute__ of both typeclasses and typed objects decide with
+# a dict lookup whether to look on the class itself or relay to the
+# other side, instead of trying and catching an AttributeError on
+# every relayed access.
+CLASS_ATTR_CACHE = {}
+
+
+def resolve_class_attr(cls, propname):
+    """
+    Find out if propname is defined on cls or any of its parents
+    and store the result in CLASS_ATTR_CACHE.
+    """
+    found = any(propname in _GA(klass, '__dict__') for klass in _GA(cls, '__mro__'))
+    CLASS_ATTR_CACHE.setdefault(cls, {})[propname] = found
+    return found
+
+
+def clear_class_attr_cache():
+    """
+    Clear the attribute cache. This is needed if classes are
+    changed in-place. Setting or deleting attributes on a typeclass
+    does this automatically (see MetaTypeClass), but it must be called
+    explicitly after adding or removing attributes on a typed object
+    class (like ObjectDB) at runtime.
+    """
+    CLASS_ATTR_CACHE.clear()
+
+
 # If this is true, all non-protected property assignments
 # are directly stored to a database attribute
 
@@ -47,6 +77,16 @@ class MetaTypeClass(type):
         mcs.typename = mcs.__name__
         mcs.path = "%s.%s" % (mcs.__module__, mcs.__name__)
 
+    def __setattr__(cls, propname, value):
+        "Changing a class may change where attributes are found"
+        super(MetaTypeClass, cls).__setattr__(propname, value)
+        clear_class_attr_cache()
+
+    def __delattr__(cls, propname):
+        "Changing a class may change where attributes are found"
+        super(MetaTypeClass, cls).__delattr__(propname)
+        clear_class_attr_cache()
+
     def __str__(cls):
         return "%s" % cls.__name__
 
@@ -98,24 +138,35 @@ class TypeClass(object):
         property on the class, it will NOT be
         accessible through getattr.
         """
+        cls = type(self)
+        try:
+            onclass = CLASS_ATTR_CACHE[cls][propname]
+        except KeyError:
+            onclass = resolve_class_attr(cls, propname)
+        #print "get %s (dbobj:%s)" % (propname, type(dbobj))
+        if onclass:
+            try:
+                return _GA(self, propname)
+            except AttributeError:
+                pass
+        else:
+            instdict = _GA(self, '__dict__')
+            if propname in instdict:
+                return instdict[propname]
         if propname.startswith('__') and propname.endswith('__'):
             # python specials are parsed as-is (otherwise things like
             # isinstance() fail to identify the typeclass)
             return _GA(self, propname)
-        #print "get %s (dbobj:%s)" % (propname, type(dbobj))
         try:
-            return _GA(self, propname)
+            dbobj = _GA(self, 'dbobj')
         except AttributeError:
-            try:
-                dbobj = _GA(self, 'dbobj')
-            except AttributeError:
-                log_trace("Typeclass CRITICAL ERROR! dbobj not found for Typeclass %s!" % self)
-                raise
-            try:
-                return _GA(dbobj, propname)
-            except AttributeError:
-                string = "Object: '%s' not found on %s(#%s), nor on its typeclass %s."
-                raise AttributeError(string % (propname, dbobj, _GA(dbobj, "dbid"), _GA(dbobj, "typeclass_path")))
+            log_trace("Typeclass CRITICAL ERROR! dbobj not found for Typeclass %s!" % self)
+            raise
+        try:
+            return _GA(dbobj, propname)
+        except AttributeError:
+            string = "Object: '%s' not found on %s(#%s), nor on its typeclass %s."
+            raise AttributeError(string % (propname, dbobj, _GA(dbobj, "dbid"), _GA(dbobj, "typeclass_path")))
 
     def __setattr__(self, propname, value):
         """
@@ -130,19 +181,30 @@ class TypeClass(object):
             string += " (protected: [%s])" % (", ".join(PROTECTED))
             log_errmsg(string % (self.name, propname))
             return
+        cls = type(self)
         try:
-            _GA(self, propname)
-            _SA(self, propname, value)
-        except AttributeError:
+            onclass = CLASS_ATTR_CACHE[cls][propname]
+        except KeyError:
+            onclass = resolve_class_attr(cls, propname)
+        if onclass:
             try:
-                dbobj = _GA(self, 'dbobj')
-            except AttributeError:
-                dbobj = None
-            if dbobj:
-                _SA(dbobj, propname, value)
-            else:
-                # only as a last resort do we save on the typeclass object
+                _GA(self, propname)
                 _SA(self, propname, value)
+                return
+            except AttributeError:
+                pass
+        elif propname in _GA(self, '__dict__'):
+            _SA(self, propname, value)
+            return
+        try:
+            dbobj = _GA(self, 'dbobj')
+        except AttributeError:
+            dbobj = None
+        if dbobj:
+            _SA(dbobj, propname, value)
+        else:
+            # only as a last resort do we save on the typeclass object
+            _SA(self, propname, value)
 
     def __eq__(self, other):
         """
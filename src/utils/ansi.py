@@ -14,6 +14,7 @@ user.
 
 """
 import re
+from bisect import bisect_left, bisect_right
 from src.utils import utils
 from src.utils.utils import to_str, to_unicode
 
@@ -60,11 +61,28 @@ ANSI_SPACE = " "
 # Escapes
 ANSI_ESCAPES = ("{{", "%%", "\\\\")
 
-from collections import OrderedDict
-_PARSE_CACHE = OrderedDict()
+# cache of parsed strings. Recently used strings are kept in the new
+# cache. When it is full it becomes the old cache, whose strings are
+# moved back to the new cache if they are used again.
+_PARSE_CACHE = {}
+_PARSE_CACHE_OLD = {}
 _PARSE_CACHE_SIZE = 10000
 
 
+def _factor_tokens(tokens):
+    """
+    Build a regex matching any of the given tokens, grouping tokens
+    that only differ in their last character. This is much faster
+    to match than one alternative per token.
+    """
+    prefixes = {}
+    for token in tokens:
+        prefixes.setdefault(token[:-1], []).append(token[-1])
+    # longest prefixes first, so {[r is not matched as {[
+    return "|".join("%s[%s]" % (re.escape(prefix), "".join(re.escape(char) for char in chars))
+                    for prefix, chars in sorted(prefixes.items(), key=lambda tup: -len(tup[0])))
+
+
 class ANSIParser(object):
     """
     A class that parses ansi markup
@@ -166,6 +184,16 @@ class ANSIParser(object):
                 else:
                     return ANSI_NORMAL + ANSI_BLUE
 
+    def sub_markup(self, markupmatch):
+        """
+        Replacer used by re.sub to replace escapes, ansi markers
+        and xterm256 tags with their replacements in one pass.
+        """
+        try:
+            return self.markup_map[markupmatch.group()]
+        except KeyError:
+            return self.sub_xterm256(markupmatch)
+
     def strip_raw_codes(self, string):
         """
         Strips raw ANSI codes from a string.
@@ -195,39 +223,43 @@ class ANSIParser(object):
         if not string:
             return ''
 
+        in_string = utils.to_str(string)
+
+        if not ("{" in in_string or "%" in in_string or
+                (strip_ansi and ANSI_ESCAPE in in_string)):
+            # no markup to parse; nothing to do (and nothing to cache)
+            return in_string
+
         # check cached parsings
-        global _PARSE_CACHE
-        cachekey = "%s-%s-%s" % (string, strip_ansi, xterm256)
-        if cachekey in _PARSE_CACHE:
+        global _PARSE_CACHE, _PARSE_CACHE_OLD
+        cachekey = (in_string, strip_ansi, xterm256, mxp)
+        try:
             return _PARSE_CACHE[cachekey]
+        except KeyError:
+            pass
 
         self.do_xterm256 = xterm256
         self.do_mxp = mxp
-        in_string = utils.to_str(string)
-
-        # do string replacement
-        parsed_string =  ""
-        parts = self.ansi_escapes.split(in_string) + [" "]
-        for part, sep in zip(parts[::2], parts[1::2]):
-            pstring = self.xterm256_sub.sub(self.sub_xterm256, part)
-            pstring = self.ansi_sub.sub(self.sub_ansi, pstring)
-            parsed_string += "%s%s" % (pstring, sep[0].strip())
 
-        if strip_ansi:
-            # remove all ansi codes (including those manually
-            # inserted in string)
-            parsed_string = self.strip_mxp(parsed_string)
-            return self.strip_raw_codes(parsed_string)
+        parsed_string = _PARSE_CACHE_OLD.get(cachekey)
+        if parsed_string is None:
+            # do all replacements in one pass
+            parsed_string = self.markup_sub.sub(self.sub_markup, in_string)
 
-        if not mxp:
-            parsed_string = self.strip_mxp(parsed_string)
+            if "{lc" in parsed_string and (strip_ansi or not mxp):
+                parsed_string = self.strip_mxp(parsed_string)
+            if strip_ansi and ANSI_ESCAPE in parsed_string:
+                # remove all ansi codes (including those manually
+                # inserted in string)
+                parsed_string = self.strip_raw_codes(parsed_string)
 
-         # cache and crop old cache
+        # cache and rotate the old cache out
         _PARSE_CACHE[cachekey] = parsed_string
-        if len(_PARSE_CACHE) > _PARSE_CACHE_SIZE:
-           _PARSE_CACHE.popitem(last=False)
+        if len(_PARSE_CACHE) > _PARSE_CACHE_SIZE / 2:
+            _PARSE_CACHE_OLD, _PARSE_CACHE = _PARSE_CACHE, {}
 
         return parsed_string
+
     # MUX-style mappings %cr %cn etc
 
     mux_ansi_map = [
@@ -331,6 +363,16 @@ class ANSIParser(object):
     # instance of each
     ansi_escapes = re.compile(r"(%s)" % "|".join(ANSI_ESCAPES), re.DOTALL)
 
+    # all of the above in one regex, used for parsing in one pass.
+    # Escapes are matched first, so escaped markup is never parsed.
+    markup_sub = re.compile(r"(?=[{%%\\])(?:%s|%s|%s)" % (
+                            "|".join(ANSI_ESCAPES), xterm256_sub.pattern,
+                            _factor_tokens(ansi_map)), re.DOTALL)
+
+    # what to replace escapes and ansi markers with
+    markup_map = dict(ansi_map)
+    markup_map.update({"{{": "{", "%%": "%", "\\": "\\"})
+
 ANSI_PARSER = ANSIParser()
 
 
@@ -603,7 +645,7 @@ class ANSIString(unicode):
         code_indexes.extend(
             cls._shifter(second._code_indexes, len(first._raw_string)))
         char_indexes.extend(
-            cls._shifter(second._code_indexes, len(first._raw_string)))
+            cls._shifter(second._char_indexes, len(first._raw_string)))
         return ANSIString(raw_string, code_indexes=code_indexes,
                           char_indexes=char_indexes,
                           clean_string=clean_string)
@@ -652,7 +694,8 @@ class ANSIString(unicode):
         those indexes to figure out what escape characters need to be
         replayed.
         """
-        slice_indexes = self._char_indexes[slc]
+        char_indexes = self._char_indexes
+        slice_indexes = char_indexes[slc]
         # If it's the end of the string, we need to append final color codes.
         if not slice_indexes:
             return ANSIString('')
@@ -660,22 +703,30 @@ class ANSIString(unicode):
             string = self[slc.start]._raw_string
         except IndexError:
             return ANSIString('')
-        last_mark = slice_indexes[0]
-        # Check between the slice intervals for escape sequences.
-        i = None
-        for i in slice_indexes[1:]:
-            for index in xrange(last_mark, i):
-                if index in self._code_indexes:
-                    string += self._raw_string[index]
-            last_mark = i
-            try:
-                string += self._raw_string[i]
-            except IndexError:
-                pass
-        if i is not None:
-            append_tail = self._get_interleving(self._char_indexes.index(i) + 1)
+        if len(slice_indexes) == 1:
+            return ANSIString(string, decoded=True)
+        raw_string = self._raw_string
+        first, last = slice_indexes[0], slice_indexes[-1]
+        if slc.step in (None, 1):
+            # a continuous slice; all escapes between the first and last
+            # character are kept as they are
+            string += raw_string[first + 1:last + 1]
         else:
-            append_tail = ''
+            # Check between the slice intervals for escape sequences.
+            code_indexes = self._code_indexes
+            parts = [string]
+            last_mark = first
+            for i in slice_indexes[1:]:
+                if i > last_mark:
+                    parts.extend(raw_string[index] for index in
+                                 code_indexes[bisect_left(code_indexes, last_mark):
+                                              bisect_left(code_indexes, i)])
+                parts.append(raw_string[i])
+                last_mark = i
+            string = "".join(parts)
+        # the position of the last character among all characters
+        last_pos = xrange(*slc.indices(len(char_indexes)))[-1]
+        append_tail = self._get_interleving(last_pos + 1)
         return ANSIString(string + append_tail, decoded=True)
 
     def __getitem__(self, item):
@@ -700,12 +751,11 @@ class ANSIString(unicode):
         item = self._char_indexes[item]
 
         clean = self._raw_string[item]
-        result = ''
         # Get the character they're after, and replay all escape sequences
         # previous to it.
-        for index in xrange(0, item + 1):
-            if index in self._code_indexes:
-                result += self._raw_string[index]
+        code_indexes = self._code_indexes
+        result = "".join(self._raw_string[index] for index in
+                         code_indexes[:bisect_right(code_indexes, item)])
         return ANSIString(result + clean + append_tail, decoded=True)
 
     def clean(self):
@@ -768,7 +818,8 @@ class ANSIString(unicode):
             # Plain string, no ANSI codes.
             return code_indexes, range(0, len(self._raw_string))
         # all indexes not occupied by ansi codes are normal characters
-        char_indexes = [i for i in range(len(self._raw_string)) if i not in code_indexes]
+        code_set = set(code_indexes)
+        char_indexes = [i for i in xrange(len(self._raw_string)) if i not in code_set]
         return code_indexes, char_indexes
 
     def _get_interleving(self, index):
@@ -780,16 +831,12 @@ class ANSIString(unicode):
             index = self._char_indexes[index - 1]
         except IndexError:
             return ''
-        s = ''
-        while True:
-            index += 1
-            if index in self._char_indexes:
-                break
-            elif index in self._code_indexes:
-                s += self._raw_string[index]
-            else:
-                break
-        return s
+        # the escape codes directly following the character
+        code_indexes = self._code_indexes
+        start = end = bisect_right(code_indexes, index)
+        while end < len(code_indexes) and code_indexes[end] == index + 1 + end - start:
+            end += 1
+        return "".join(self._raw_string[i] for i in code_indexes[start:end])
 
     def split(self, by, maxsplit=-1):
         """
@@ -827,7 +874,7 @@ class ANSIString(unicode):
         clean_string = self._clean_string * other
         code_indexes = self._code_indexes[:]
         char_indexes = self._char_indexes[:]
-        for i in range(1, other + 1):
+        for i in range(1, other):
             code_indexes.extend(
                 self._shifter(self._code_indexes, i * len(self._raw_string)))
             char_indexes.extend(
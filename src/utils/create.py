@@ -313,6 +313,11 @@ def create_script(typeclass, key=None, obj=None, player=None, locks=None,
     if autostart:
         new_script.start()
 
+    # make sure the new script is validated on its object
+    for holder in (obj, player):
+        if holder:
+            holder.scripts.invalidate()
+
     return new_script
 #alias
 script = create_script
@@ -19,22 +19,33 @@ be out of sync with the database.
 
 """
 
+import marshal
 from functools import update_wrapper
 from collections import defaultdict, MutableSequence, MutableSet, MutableMapping
 try:
     from cPickle import dumps, loads
 except ImportError:
     from pickle import dumps, loads
+from twisted.internet import reactor
+from twisted.python.threadable import isInIOThread
+from django.conf import settings
 from django.db import transaction
 from django.core.exceptions import ObjectDoesNotExist
 from django.contrib.contenttypes.models import ContentType
 from src.server.models import ServerConfig
+from src.locks.lockhandler import touch_lockstate
 from src.utils.utils import to_str, uses_database
 from src.utils import logger
 
-__all__ = ("to_pickle", "from_pickle", "do_pickle", "do_unpickle")
+__all__ = ("to_pickle", "from_pickle", "do_pickle", "do_unpickle",
+           "do_binary", "is_binary", "flush")
 
 PICKLE_PROTOCOL = 2
+# header marking the binary format. Pickles never start with \x01.
+BINARY_HEADER = "\x01\x00"
+# marshal version 0 does not share interned strings, so equal data
+# always gives the same binary string (needed for database lookups)
+_MARSHAL_VERSION = 0
 
 # initialization and helpers
 
@@ -43,6 +54,11 @@ _SA = object.__setattr__
 _FROM_MODEL_MAP = None
 _TO_MODEL_MAP = None
 _TO_TYPECLASS = lambda o: hasattr(o, 'typeclass') and o.typeclass or o
+_MUTABLES = frozenset((list, dict, set))
+_WRITE_BEHIND = settings.ATTRIBUTE_WRITE_BEHIND
+# root Attributes with unsaved changes to nested mutables, {db_obj: root}
+_PENDING = {}
+_FLUSH_CALL = None
 _IS_PACKED_DBOBJ = lambda o: type(o) == tuple and len(o) == 4 and o[0] == '__packed_dbobj__'
 if uses_database("mysql") and ServerConfig.objects.get_mysql_db_version() < '5.6.4':
     # mysql <5.6.4 don't support millisecond precision
@@ -79,6 +95,60 @@ def _init_globals():
 #
 
 
+def _write_behind():
+    """
+    Check if saves of nested mutables should be delayed. This is only
+    done in the main thread of the running server; the flush
+    is then always scheduled.
+    """
+    return _WRITE_BEHIND and reactor.running and isInIOThread()
+
+
+def flush(db_obj=None):
+    """
+    Save all changes to nested mutables (like obj.db.mylist.append(1))
+    that have not yet been written to the database. With write-behind
+    (settings.ATTRIBUTE_WRITE_BEHIND) this happens automatically after
+    each command and at the end of each reactor iteration. Call this
+    if the changes must be in the database right away.
+
+    db_obj - only save the changes to this Attribute.
+    """
+    global _FLUSH_CALL
+    if db_obj is not None:
+        pending = [(db_obj, _PENDING.pop(db_obj))] if db_obj in _PENDING else []
+    else:
+        if _FLUSH_CALL and _FLUSH_CALL.active():
+            _FLUSH_CALL.cancel()
+        _FLUSH_CALL = None
+        pending = _PENDING.items()
+        _PENDING.clear()
+    for db_obj, root in pending:
+        if db_obj.pk is None:
+            # deleted since it was changed
+            continue
+        try:
+            db_obj.value = root
+        except Exception:
+            logger.log_trace()
+
+
+def get_pending(db_obj):
+    """
+    Return the value of db_obj if it has changes not yet saved to the
+    database, otherwise None.
+    """
+    return _PENDING.get(db_obj)
+
+
+def discard_pending(db_obj):
+    """
+    Forget the unsaved changes of db_obj. This is called when
+    it is given a new value or is deleted.
+    """
+    _PENDING.pop(db_obj, None)
+
+
 def _save(method):
     "method decorator that saves data to Attribute"
     def save_wrapper(self, *args, **kwargs):
@@ -104,10 +174,21 @@ class _SaverMutable(object):
 
     def _save_tree(self):
         "recursively traverse back up the tree, save when we reach the root"
+        global _FLUSH_CALL
         if self._parent:
             self._parent._save_tree()
         elif self._db_obj:
-            self._db_obj.value = self
+            if _write_behind():
+                # mark as changed and save once later
+                _PENDING[self._db_obj] = self
+                # lock decisions may depend on the new value right away
+                owner = getattr(self._db_obj, "_lockstate_owner", None)
+                if owner:
+                    touch_lockstate(owner)
+                if not _FLUSH_CALL:
+                    _FLUSH_CALL = reactor.callLater(0, flush)
+            else:
+                self._db_obj.value = self
         else:
             logger.log_errmsg("_SaverMutable %s has no root Attribute to save to." % self)
 
@@ -116,20 +197,21 @@ class _SaverMutable(object):
         def process_tree(item, parent):
             "recursively populate the tree, storing parents"
             dtype = type(item)
-            if dtype in (basestring, int, long, float, bool, tuple):
-                return item
-            elif dtype == list:
+            if dtype == list:
+                if _MUTABLES.isdisjoint(map(type, item)):
+                    return _SaverList(item, parent=parent)
                 dat = _SaverList(parent=parent)
-                dat._data.extend(process_tree(val, dat) for val in item)
+                dat._data.extend([process_tree(val, dat) for val in item])
                 return dat
             elif dtype == dict:
+                if _MUTABLES.isdisjoint(map(type, item.itervalues())):
+                    return _SaverDict(item, parent=parent)
                 dat = _SaverDict(parent=parent)
-                dat._data.update((key, process_tree(val, dat)) for key, val in item.items())
+                dat._data.update([(key, process_tree(val, dat)) for key, val in item.iteritems()])
                 return dat
             elif dtype == set:
-                dat = _SaverSet(parent=parent)
-                dat._data.update(process_tree(val, dat) for val in item)
-                return dat
+                # set elements are hashable, so they are never mutables
+                return _SaverSet(item, parent=parent)
             return item
         return process_tree(data, self)
 
@@ -243,6 +325,201 @@ def unpack_dbobj(item):
         dbobj = obj
     return _TO_DATESTRING(dbobj) == item[2] and obj or None
 
+
+def measure_pickle(data):
+    """
+    Inspect data on the form returned by to_pickle (i.e. before
+    from_pickle is called on it). Returns a tuple
+      (size, has_dbobj, has_mutable, has_other)
+    where size is the approximate size of the data (one unit per
+    element plus one per 64 characters of string data), has_dbobj is
+    True if data contains packed database objects, has_mutable if it
+    contains lists, dicts or sets, and has_other if it contains
+    objects not of a standard python type.
+    """
+    stats = [0, False, False, False]
+
+    def process_item(item):
+        "Recursive processor"
+        stats[0] += 1
+        if item is None or isinstance(item, (bool, int, long, float)):
+            return
+        elif isinstance(item, basestring):
+            stats[0] += len(item) // 64
+        elif _IS_PACKED_DBOBJ(item):
+            stats[1] = True
+        elif type(item) == tuple:
+            for val in item:
+                process_item(val)
+        elif type(item) == dict:
+            stats[2] = True
+            for key, val in item.items():
+                process_item(key)
+                process_item(val)
+        elif type(item) in (list, set):
+            stats[2] = True
+            for val in item:
+                process_item(val)
+        else:
+            stats[3] = True
+    process_item(data)
+    return tuple(stats)
+
+#
+# Dispatch tables for the (un)serializers. Primitives are returned
+# as-is and containers holding only primitives are copied without
+# recursing into them.
+#
+
+_PRIMITIVES = frozenset((str, unicode, int, long, float, bool, type(None)))
+
+
+def _is_flat(iterable):
+    "Check if iterable only holds primitives (so needs no processing)"
+    return _PRIMITIVES.issuperset(map(type, iterable))
+
+
+def _to_pickle_item(item):
+    "Recursive processor and identification of data"
+    dtype = type(item)
+    if dtype in _PRIMITIVES:
+        return item
+    handler = _TO_PICKLE.get(dtype)
+    if handler:
+        return handler(item)
+    elif hasattr(item, '__item__'):
+        # we try to conserve the iterable class, if not convert to list
+        try:
+            return item.__class__([_to_pickle_item(val) for val in item])
+        except (AttributeError, TypeError):
+            return [_to_pickle_item(val) for val in item]
+    return pack_dbobj(item)
+
+
+def _to_pickle_tuple(item):
+    return item if _is_flat(item) else tuple([_to_pickle_item(val) for val in item])
+
+
+def _to_pickle_list(item):
+    return list(item) if _is_flat(item) else [_to_pickle_item(val) for val in item]
+
+
+def _to_pickle_dict(item):
+    if _is_flat(item.itervalues()) and _is_flat(item):
+        return dict(item)
+    return dict([(_to_pickle_item(key), _to_pickle_item(val)) for key, val in item.iteritems()])
+
+
+def _to_pickle_set(item):
+    return set(item) if _is_flat(item) else set([_to_pickle_item(val) for val in item])
+
+
+_TO_PICKLE = {tuple: _to_pickle_tuple,
+              list: _to_pickle_list,
+              dict: _to_pickle_dict,
+              set: _to_pickle_set,
+              _SaverList: lambda item: _to_pickle_list(item._data),
+              _SaverDict: lambda item: _to_pickle_dict(item._data),
+              _SaverSet: lambda item: _to_pickle_set(item._data)}
+
+
+def _from_pickle_item(item):
+    "Recursive processor and identification of data"
+    dtype = type(item)
+    if dtype in _PRIMITIVES:
+        return item
+    handler = _FROM_PICKLE.get(dtype)
+    if handler:
+        return handler(item)
+    elif hasattr(item, '__iter__'):
+        try:
+            # we try to conserve the iterable class if
+            # it accepts an iterator
+            return item.__class__(_from_pickle_item(val) for val in item)
+        except (AttributeError, TypeError):
+            return [_from_pickle_item(val) for val in item]
+    return item
+
+
+def _from_pickle_tuple(item):
+    if _IS_PACKED_DBOBJ(item):
+        return unpack_dbobj(item)
+    return item if _is_flat(item) else tuple([_from_pickle_item(val) for val in item])
+
+
+def _from_pickle_dict(item):
+    if _is_flat(item.itervalues()) and _is_flat(item):
+        return dict(item)
+    return dict([(_from_pickle_item(key), _from_pickle_item(val)) for key, val in item.iteritems()])
+
+
+_FROM_PICKLE = {tuple: _from_pickle_tuple,
+                list: lambda item: list(item) if _is_flat(item) else [_from_pickle_item(val) for val in item],
+                dict: _from_pickle_dict,
+                set: lambda item: set(item) if _is_flat(item) else set([_from_pickle_item(val) for val in item])}
+
+
+def _from_pickle_tree(item, parent=None, db_obj=None):
+    """
+    Recursive processor, building a parent-tree from iterable data.
+    The root of the tree saves to db_obj, the other nodes to their
+    parent.
+    """
+    dtype = type(item)
+    if dtype in _PRIMITIVES:
+        return item
+    handler = _FROM_PICKLE_TREE.get(dtype)
+    if handler:
+        return handler(item, parent, db_obj)
+    elif hasattr(item, '__iter__'):
+        try:
+            # we try to conserve the iterable class if it
+            # accepts an iterator
+            return item.__class__(_from_pickle_tree(val, parent) for val in item)
+        except (AttributeError, TypeError):
+            dat = _SaverList(parent=parent, db_obj=db_obj)
+            dat._data.extend([_from_pickle_tree(val, dat) for val in item])
+            return dat
+    return item
+
+
+def _from_pickle_tree_tuple(item, parent, db_obj):
+    if _IS_PACKED_DBOBJ(item):
+        return unpack_dbobj(item)
+    elif _is_flat(item):
+        return item
+    # tuples are immutable, so any mutables inside save to our parent
+    return tuple([_from_pickle_tree(val, parent) for val in item])
+
+
+def _from_pickle_tree_list(item, parent, db_obj):
+    if _is_flat(item):
+        return _SaverList(item, parent=parent, db_obj=db_obj)
+    dat = _SaverList(parent=parent, db_obj=db_obj)
+    dat._data.extend([_from_pickle_tree(val, dat) for val in item])
+    return dat
+
+
+def _from_pickle_tree_dict(item, parent, db_obj):
+    if _is_flat(item.itervalues()) and _is_flat(item):
+        return _SaverDict(item, parent=parent, db_obj=db_obj)
+    dat = _SaverDict(parent=parent, db_obj=db_obj)
+    dat._data.update([(_from_pickle_item(key), _from_pickle_tree(val, dat))
+                      for key, val in item.iteritems()])
+    return dat
+
+
+def _from_pickle_tree_set(item, parent, db_obj):
+    # set elements are hashable, so they are never mutables
+    return _SaverSet(item if _is_flat(item) else [_from_pickle_item(val) for val in item],
+                     parent=parent, db_obj=db_obj)
+
+
+_FROM_PICKLE_TREE = {tuple: _from_pickle_tree_tuple,
+                     list: _from_pickle_tree_list,
+                     dict: _from_pickle_tree_dict,
+                     set: _from_pickle_tree_set}
+
 #
 # Access methods
 #
@@ -255,27 +532,7 @@ def to_pickle(data):
     We also convert any Saver*-type objects back to their normal
     representations, they are not pickle-safe.
     """
-    def process_item(item):
-        "Recursive processor and identification of data"
-        dtype = type(item)
-        if dtype in (basestring, int, long, float, bool):
-            return item
-        elif dtype == tuple:
-            return tuple(process_item(val) for val in item)
-        elif dtype in (list, _SaverList):
-            return [process_item(val) for val in item]
-        elif dtype in (dict, _SaverDict):
-            return dict((process_item(key), process_item(val)) for key, val in item.items())
-        elif dtype in (set, _SaverSet):
-            return set(process_item(val) for val in item)
-        elif hasattr(item, '__item__'):
-            # we try to conserve the iterable class, if not convert to list
-            try:
-                return item.__class__([process_item(val) for val in item])
-            except (AttributeError, TypeError):
-                return [process_item(val) for val in item]
-        return pack_dbobj(item)
-    return process_item(data)
+    return _to_pickle_item(data)
 
 
 #@transaction.autocommit
@@ -295,81 +552,11 @@ def from_pickle(data, db_obj=None):
     to their _SaverList, _SaverDict and _SaverSet counterparts.
 
     """
-    def process_item(item):
-        "Recursive processor and identification of data"
-        dtype = type(item)
-        if dtype in (basestring, int, long, float, bool):
-            return item
-        elif _IS_PACKED_DBOBJ(item):
-            # this must be checked before tuple
-            return unpack_dbobj(item)
-        elif dtype == tuple:
-            return tuple(process_item(val) for val in item)
-        elif dtype == dict:
-            return dict((process_item(key), process_item(val)) for key, val in item.items())
-        elif dtype == set:
-            return set(process_item(val) for val in item)
-        elif hasattr(item, '__iter__'):
-            try:
-                # we try to conserve the iterable class if
-                # it accepts an iterator
-                return item.__class__(process_item(val) for val in item)
-            except (AttributeError, TypeError):
-                return [process_item(val) for val in item]
-        return item
-
-    def process_tree(item, parent):
-        "Recursive processor, building a parent-tree from iterable data"
-        dtype = type(item)
-        if dtype in (basestring, int, long, float, bool):
-            return item
-        elif _IS_PACKED_DBOBJ(item):
-            # this must be checked before tuple
-            return unpack_dbobj(item)
-        elif dtype == tuple:
-            return tuple(process_tree(val, item) for val in item)
-        elif dtype == list:
-            dat = _SaverList(parent=parent)
-            dat._data.extend(process_tree(val, dat) for val in item)
-            return dat
-        elif dtype == dict:
-            dat = _SaverDict(parent=parent)
-            dat._data.update(dict((process_item(key), process_tree(val, dat))
-                                   for key, val in item.items()))
-            return dat
-        elif dtype == set:
-            dat = _SaverSet(parent=parent)
-            dat._data.update(set(process_tree(val, dat) for val in item))
-            return dat
-        elif hasattr(item, '__iter__'):
-            try:
-                # we try to conserve the iterable class if it
-                # accepts an iterator
-                return item.__class__(process_tree(val, parent) for val in item)
-            except (AttributeError, TypeError):
-                dat = _SaverList(parent=parent)
-                dat._data.extend(process_tree(val, dat) for val in item)
-                return dat
-        return item
-
-    if db_obj:
+    if db_obj and type(data) in (list, dict, set):
         # convert lists, dicts and sets to their Saved* counterparts. It
         # is only relevant if the "root" is an iterable of the right type.
-        dtype = type(data)
-        if dtype == list:
-            dat = _SaverList(db_obj=db_obj)
-            dat._data.extend(process_tree(val, parent=dat) for val in data)
-            return dat
-        elif dtype == dict:
-            dat = _SaverDict(db_obj=db_obj)
-            dat._data.update((process_item(key), process_tree(val, parent=dat))
-                              for key, val in data.items())
-            return dat
-        elif dtype == set:
-            dat = _SaverSet(db_obj=db_obj)
-            dat._data.update(process_tree(val, parent=dat) for val in data)
-            return dat
-    return process_item(data)
+        return _from_pickle_tree(data, db_obj=db_obj)
+    return _from_pickle_item(data)
 
 
 def do_pickle(data):
@@ -378,8 +565,38 @@ def do_pickle(data):
 
 
 def do_unpickle(data):
-    "Retrieve pickle from pickled string"
-    return loads(to_str(data))
+    "Retrieve pickle from pickled string (or from the binary format)"
+    data = to_str(data)
+    if data.startswith(BINARY_HEADER):
+        return marshal.loads(data[len(BINARY_HEADER):])
+    return loads(data)
+
+
+def do_binary(data):
+    """
+    Serialize data on the form returned by to_pickle to the binary
+    format, a tagged marshal string. This is faster to read
+    than a pickle, but only supports the standard python types
+    (including packed database objects). Data that does not read back
+    equal from the binary format (such as custom classes or
+    subclasses of the standard types) is returned as a normal pickle
+    instead.
+
+    Use do_unpickle to read either format back.
+    """
+    try:
+        binary = marshal.dumps(data, _MARSHAL_VERSION)
+        if marshal.loads(binary) == data:
+            return BINARY_HEADER + binary
+    except ValueError:
+        # not marshallable
+        pass
+    return do_pickle(data)
+
+
+def is_binary(data):
+    "Check if the serialized string data is on the binary format"
+    return to_str(data).startswith(BINARY_HEADER)
 
 
 def dbserialize(data):
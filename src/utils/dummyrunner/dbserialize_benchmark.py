@@ -0,0 +1,73 @@
+"""
+Benchmark of the serialization used to store Attributes.
+
+This times converting a set of representative Attribute payloads
+to and from their storage form (to_pickle/from_pickle, including
+building the _Saver* tree used for Attributes) as well as encoding
+and decoding them as pickles and in the binary format.
+
+Run from the game directory:
+
+    python ../src/utils/dummyrunner/dbserialize_benchmark.py [repeats]
+
+"""
+import sys, os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))))
+os.environ["DJANGO_SETTINGS_MODULE"] = "game.settings"
+from timeit import Timer
+
+from src.utils.dbserialize import (to_pickle, from_pickle, do_pickle,
+                                   do_unpickle, do_binary)
+
+REPEATS = 1000
+
+
+class _DummyAttribute(object):
+    "Stands in for the Attribute the _Saver* tree saves to"
+    value = None
+
+
+PAYLOADS = (
+    ("string", "A long description of a room. " * 10),
+    ("number", 123456),
+    ("flat list", ["item%i" % i for i in range(50)]),
+    ("flat dict", dict(("stat%i" % i, i) for i in range(30))),
+    ("nested", {"quests": dict(("quest%i" % i, {"done": False, "steps": [1, 2, 3],
+                                                "log": ["started", "met the king"]})
+                               for i in range(20)),
+                "position": (10, 20, 0)}),
+    ("history", [(i, "said", "hello there number %i" % i, 1.5 * i) for i in range(200)]),
+    ("set", set("tag%i" % i for i in range(50))),
+)
+
+
+def _time(func, repeats):
+    "Return the time per call in microseconds"
+    return min(Timer(func).repeat(3, repeats)) / repeats * 1e6
+
+
+def run(repeats=REPEATS):
+    """
+    Run the benchmarks and print the results
+    """
+    dbobj = _DummyAttribute()
+    print "%-10s %9s %9s %9s %9s %9s %9s %9s %9s" % (
+        "payload", "to_pickl", "from_pkl", "to_saver", "pickle",
+        "unpickle", "binary", "unbinary", "size")
+    for name, payload in PAYLOADS:
+        data = to_pickle(payload)
+        pickled, binary = do_pickle(data), do_binary(data)
+        results = (_time(lambda: to_pickle(payload), repeats),
+                   _time(lambda: from_pickle(data), repeats),
+                   _time(lambda: from_pickle(data, db_obj=dbobj), repeats),
+                   _time(lambda: do_pickle(data), repeats),
+                   _time(lambda: do_unpickle(pickled), repeats),
+                   _time(lambda: do_binary(data), repeats),
+                   _time(lambda: do_unpickle(binary), repeats))
+        print "%-10s %s %4i/%4i" % (name, " ".join("%9.2f" % res for res in results),
+                                      len(pickled), len(binary))
+    print "(times in microseconds per call, size is pickle/binary bytes)"
+
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else REPEATS)
@@ -0,0 +1,48 @@
+"""
+Benchmark of attribute access relayed between typeclasses and
+their database objects.
+
+This times looking up database fields, handlers and methods on an
+Object typeclass and on its ObjectDB. Relaying through the typeclass
+should cost about as much as accessing the ObjectDB directly.
+
+Run from the game directory:
+
+    python ../src/utils/dummyrunner/typeclass_benchmark.py [repeats]
+
+"""
+import sys, os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))))
+os.environ["DJANGO_SETTINGS_MODULE"] = "game.settings"
+import django
+django.setup()
+from timeit import Timer
+
+from src.objects.models import ObjectDB
+
+REPEATS = 10000
+
+
+def _time(func, repeats):
+    "Return the time per call in microseconds"
+    return min(Timer(func).repeat(3, repeats)) / repeats * 1e6
+
+
+def run(repeats=REPEATS):
+    """
+    Run the benchmarks and print the results
+    """
+    dbobj = ObjectDB(db_key="Tester", db_typeclass_path="src.objects.objects.Object")
+    obj = dbobj.typeclass
+    tests = (("dbobj.key", lambda: dbobj.key),
+             ("obj.key", lambda: obj.key),
+             ("obj.db", lambda: obj.db),
+             ("dbobj.at_msg_receive", lambda: dbobj.at_msg_receive),
+             ("obj.at_msg_receive", lambda: obj.at_msg_receive))
+    for name, func in tests:
+        print "%-22s %9.2f" % (name, _time(func, repeats))
+    print "(times in microseconds per access)"
+
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else REPEATS)
@@ -4,15 +4,25 @@ Django ID mapper
 Modified for Evennia by making sure that no model references
 leave caching unexpectedly (no use of WeakRefs).
 
+The cache of each model class is capped to a max number of entries
+(settings.IDMAPPER_CACHE_MAX_ENTRIES). Caches above their cap are
+trimmed by trim_cache(), which evicts instances not recently used
+using a CLOCK (second-chance) policy. Evicted instances are only
+weakly referenced until garbage collected, so an instance still
+referenced elsewhere is put back in the cache when next looked up
+instead of being loaded a second time.
+
 Also adds cache_size() for monitoring the size of the cache.
 """
 
-import os, threading, gc, time
+import os, threading, gc
+from django.conf import settings
 #from twisted.internet import reactor
 #from twisted.internet.threads import blockingCallFromThread
 from weakref import WeakValueDictionary
 from twisted.internet.reactor import callFromThread
 from django.core.exceptions import ObjectDoesNotExist, FieldError
+from django.db import connections, router, transaction
 from django.db.models.base import Model, ModelBase
 from django.db.models.signals import post_save, pre_delete, post_syncdb
 from src.utils import logger
@@ -20,7 +30,7 @@ from src.utils.utils import dbref, get_evennia_pids, to_str
 
 from manager import SharedMemoryManager
 
-AUTO_FLUSH_MIN_INTERVAL = 60.0 * 5 # at least 5 mins between cache flushes
+_IDMAPPER_CACHE_MAX_ENTRIES = settings.IDMAPPER_CACHE_MAX_ENTRIES
 
 _GA = object.__getattribute__
 _SA = object.__setattr__
@@ -69,6 +79,14 @@ class SharedMemoryModelBase(ModelBase):
 
     def _prepare(cls):
         cls.__instance_cache__ = {}
+        # pks of instances used since last visited by the evictor
+        cls.__instance_cache_used__ = set()
+        # evicted instances, until they are garbage collected
+        cls.__instance_cache_evicted__ = WeakValueDictionary()
+        cls.__instance_cache_stats__ = {"hits": 0, "misses": 0, "evictions": 0}
+        if "_idmapper_cache_max_entries" not in cls.__dict__:
+            # this can be set on a model class to give it its own limit
+            cls._idmapper_cache_max_entries = _IDMAPPER_CACHE_MAX_ENTRIES
         cls._idmapper_recache_protection = False
         super(SharedMemoryModelBase, cls)._prepare()
 
@@ -227,18 +245,78 @@ class SharedMemoryModel(Model):
         (which will always be the case when caching is disabled for this class). Please
         note that the lookup will be done even when instance caching is disabled.
         """
-        return cls.__instance_cache__.get(id)
+        instance = cls.__instance_cache__.get(id)
+        if instance is None:
+            # an evicted instance may still be in use somewhere
+            instance = cls.__instance_cache_evicted__.pop(id, None)
+            if instance is not None:
+                cls.__instance_cache__[id] = instance
+        if instance is None:
+            cls.__instance_cache_stats__["misses"] += 1
+        else:
+            cls.__instance_cache_stats__["hits"] += 1
+            cls.__instance_cache_used__.add(id)
+        return instance
     get_cached_instance = classmethod(get_cached_instance)
 
     def cache_instance(cls, instance):
         """
-        Method to store an instance in the cache.
+        Method to store an instance in the cache. This never
+        evicts anything, see trim_cache().
         """
-        if instance._get_pk_val() is not None:
-
-            cls.__instance_cache__[instance._get_pk_val()] = instance
+        pk = instance._get_pk_val()
+        if pk is not None:
+            cls.__instance_cache__[pk] = instance
+            cls.__instance_cache_evicted__.pop(pk, None)
+            cls.__instance_cache_used__.add(pk)
     cache_instance = classmethod(cache_instance)
 
+    def evict_instances(cls, num=None):
+        """
+        Evict instances from the cache using a CLOCK (second-chance)
+        policy: instances used since the evictor last passed them are
+        spared (but will be evicted next time unless used again).
+        Instances whose at_idmapper_flush() returns False are never
+        evicted, nor are those in get_protected_pks(). This is
+        called by trim_cache().
+
+        num - the number of instances to evict. If not given, evict
+              down to 90% of the max number of entries for this class.
+        Returns the number of evicted instances.
+        """
+        cache = cls.__instance_cache__
+        used = cls.__instance_cache_used__
+        maxnum = cls._idmapper_cache_max_entries
+        if num is None:
+            num = len(cache) - int(maxnum * 0.9) if maxnum else 0
+        evicted = 0
+        if num <= 0:
+            return evicted
+        protected = cls.get_protected_pks()
+        evicted_cache = cls.__instance_cache_evicted__
+        for pk, instance in cache.items():
+            if evicted >= num:
+                break
+            if pk in used:
+                # second chance
+                used.discard(pk)
+            elif pk not in protected and instance.at_idmapper_flush():
+                del cache[pk]
+                evicted_cache[pk] = instance
+                evicted += 1
+        cls.__instance_cache_stats__["evictions"] += evicted
+        return evicted
+    evict_instances = classmethod(evict_instances)
+
+    def get_protected_pks(cls):
+        """
+        Returns the pks of cached instances that may not be evicted
+        even though their at_idmapper_flush() allows it, such as
+        instances the protected ones depend on.
+        """
+        return ()
+    get_protected_pks = classmethod(get_protected_pks)
+
     def get_all_cached_instances(cls):
         "return the objects so far cached by idmapper for this class."
         return cls.__instance_cache__.values()
@@ -248,7 +326,9 @@ class SharedMemoryModel(Model):
         "Remove the cached reference."
         try:
             if force or not cls._idmapper_recache_protection:
+                cls.__instance_cache_evicted__.pop(key, None)
                 del cls.__instance_cache__[key]
+                cls.__instance_cache_used__.discard(key)
         except KeyError:
             pass
     _flush_cached_by_key = classmethod(_flush_cached_by_key)
@@ -270,6 +350,14 @@ class SharedMemoryModel(Model):
         "set if this instance should be allowed to be recached."
         cls._idmapper_recache_protection = bool(mode)
 
+    def at_idmapper_flush(cls):
+        """
+        Called on an instance before it is evicted or flushed
+        from the cache (except for forced flushes). If this returns
+        False, the instance stays in the cache.
+        """
+        return not cls._idmapper_recache_protection
+
     def flush_instance_cache(cls, force=False):
         """
         This will clean safe objects from the cache. Use force
@@ -277,9 +365,12 @@ class SharedMemoryModel(Model):
         """
         if force:
             cls.__instance_cache__ = {}
+            cls.__instance_cache_evicted__ = WeakValueDictionary()
         else:
+            cls.__instance_cache_evicted__.update(cls.__instance_cache__)
             cls.__instance_cache__ = dict((key, obj) for key, obj in cls.__instance_cache__.items()
-                                                      if obj._idmapper_recache_protection)
+                                                      if not obj.at_idmapper_flush())
+        cls.__instance_cache_used__ = set()
     flush_instance_cache = classmethod(flush_instance_cache)
 
     def save(cls, *args, **kwargs):
@@ -302,6 +393,67 @@ class SharedMemoryModel(Model):
             #blockingCallFromThread(reactor, _save_callback, cls, *args, **kwargs)
             callFromThread(_save_callback, cls, *args, **kwargs)
 
+    def _reserve_pks(cls, using, num):
+        """
+        Reserve num primary keys from the database's own pk sequence,
+        so they are never handed out again (not even those of deleted
+        objects). Must be called inside a transaction. Returns the
+        list of pks, or None if the backend is not supported.
+        """
+        connection = connections[using]
+        table = cls._meta.db_table
+        cursor = connection.cursor()
+        if connection.vendor == "postgresql":
+            cursor.execute("SELECT nextval(pg_get_serial_sequence(%s, %s)) "
+                           "FROM generate_series(1, %s)",
+                           [table, cls._meta.pk.column, num])
+            return sorted(row[0] for row in cursor.fetchall())
+        if connection.vendor == "sqlite":
+            # AUTOINCREMENT tables keep their counter in sqlite_sequence.
+            # Updating it write-locks the database until we commit.
+            cursor.execute("UPDATE sqlite_sequence SET seq = seq + %s WHERE name = %s",
+                           [num, table])
+            if cursor.rowcount == 1:
+                cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = %s", [table])
+                last = cursor.fetchone()[0]
+                return range(last - num + 1, last + 1)
+        return None
+    _reserve_pks = classmethod(_reserve_pks)
+
+    def batch_create(cls, instances):
+        """
+        Create many new, unsaved instances of this model using a few
+        queries per batch. Unlike bulk_create, this assigns primary
+        keys to the instances (by reserving them from the database's
+        pk sequence) and stores the instances in the idmapper cache.
+
+        Note that save() is not called and no save signals are sent.
+        On backends where pks can't be reserved (and on sqlite tables
+        without any rows yet) the instances are instead saved one by
+        one, which does send them. This must only be called from the
+        main server process. Returns the list of instances.
+        """
+        instances = list(instances)
+        if not instances:
+            return instances
+        using = router.db_for_write(cls)
+        pkname = cls._meta.pk.attname
+        with transaction.atomic(using=using):
+            pks = cls._reserve_pks(using, len(instances))
+            if pks is None:
+                for instance in instances:
+                    instance.save(using=using)
+                return instances
+            for pk, instance in zip(pks, instances):
+                setattr(instance, pkname, pk)
+            cls._default_manager.using(using).bulk_create(instances)
+        for instance in instances:
+            instance._state.adding = False
+            instance._state.db = using
+            cls.cache_instance(instance)
+        return instances
+    batch_create = classmethod(batch_create)
+
 
 class WeakSharedMemoryModelBase(SharedMemoryModelBase):
     """
@@ -370,70 +522,29 @@ def update_cached_instance(sender, instance, **kwargs):
 post_save.connect(update_cached_instance)
 
 
-LAST_FLUSH = None
-def conditional_flush(max_rmem, force=False):
+def trim_cache():
     """
-    Flush the cache if the estimated memory usage exceeds max_rmem.
-
-    The flusher has a timeout to avoid flushing over and over
-    in particular situations (this means that for some setups
-    the memory usage will exceed the requirement and a server with
-    more memory is probably required for the given game)
-
-    force - forces a flush, regardless of timeout.
+    Evict instances from the caches of all models that have more
+    entries than allowed. This is called regularly by the
+    ValidateIdmapperCache script, outside of command handling, so
+    the caches may grow above their limits in between.
     """
-    global LAST_FLUSH
-
-    def mem2cachesize(desired_rmem):
-        """
-        Estimate the size of the idmapper cache based on the memory
-        desired. This is used to optionally cap the cache size.
-
-        desired_rmem - memory in MB (minimum 50MB)
-
-        The formula is empirically estimated from usage tests (Linux)
-        and is
-            Ncache = RMEM - 35.0 / 0.0157
-        where RMEM is given in MB and Ncache is the size of the cache
-        for this memory usage. VMEM tends to be about 100MB higher
-        than RMEM for large memory usage.
-        """
-        vmem = max(desired_rmem, 50.0)
-        Ncache = int(abs(float(vmem) - 35.0) / 0.0157)
-        return Ncache
-
-    if not max_rmem:
-        # auto-flush is disabled
-        return
-
-    now = time.time()
-    if not LAST_FLUSH:
-        # server is just starting
-        LAST_FLUSH = now
-        return
-
-    if ((now - LAST_FLUSH) < AUTO_FLUSH_MIN_INTERVAL) and not force:
-        # too soon after last flush.
-        logger.log_warnmsg("Warning: Idmapper flush called more than "\
-                            "once in %s min interval. Check memory usage." % (AUTO_FLUSH_MIN_INTERVAL/60.0))
-        return
-
-    if os.name == "nt":
-        # we can't look for mem info in Windows at the moment
-        return
-
-    # check actual memory usage
-    Ncache_max = mem2cachesize(max_rmem)
-    Ncache, _ = cache_size()
-    actual_rmem = float(os.popen('ps -p %d -o %s | tail -1' % (os.getpid(), "rss")).read()) / 1000.0  # resident memory
+    def class_hierarchy(clslist):
+        """Recursively yield a class hierarchy"""
+        for cls in clslist:
+            subclass_list = cls.__subclasses__()
+            if subclass_list:
+                for subcls in class_hierarchy(subclass_list):
+                    yield subcls
+            else:
+                yield cls
 
-    if Ncache >= Ncache_max and actual_rmem > max_rmem * 0.9:
-        # flush cache when number of objects in cache is big enough and our
-        # actual memory use is within 10% of our set max
-        flush_cache()
-        LAST_FLUSH = now
+    for cls in class_hierarchy([SharedMemoryModel]):
+        maxnum = cls._idmapper_cache_max_entries
+        if maxnum and len(cls.__instance_cache__) > maxnum:
+            cls.evict_instances()
 
-def cache_size(mb=True):
+def cache_size(mb=True, stats=False):
     """
     Calculate statistics about the cache.
 
@@ -446,6 +557,8 @@ def cache_size(mb=True):
 
     Returns
       total_num, {objclass:total_num, ...}
+    or, if stats is set,
+      total_num, {objclass:(total_num, hits, misses, evictions), ...}
     """
     numtotal = [0] # use mutable to keep reference through recursion
     classdict = {}
@@ -455,7 +568,12 @@ def cache_size(mb=True):
             if not subclasses:
                 num = len(submodel.get_all_cached_instances())
                 numtotal[0] += num
-                classdict[submodel.__name__] = num
+                if stats:
+                    cstats = submodel.__instance_cache_stats__
+                    classdict[submodel.__name__] = (num, cstats["hits"],
+                                                    cstats["misses"], cstats["evictions"])
+                else:
+                    classdict[submodel.__name__] = num
             else:
                 get_recurse(subclasses)
     get_recurse(SharedMemoryModel.__subclasses__())
@@ -163,6 +163,13 @@ def _execute_inline_single_function(funcname, text, session):
         return _INLINE_FUNCS[funcname][0]("", *args, **kwargs)
     return _INLINE_FUNCS[funcname][2].sub(subfunc, text)
 
+def has_inlinefunc(text):
+    """
+    Check if text contains any inlinefunc tags. If not,
+    parse_inlinefunc will return text unchanged whatever the session.
+    """
+    return bool(_FUNCSPLIT_REGEX.search(text))
+
 def parse_inlinefunc(text, strip=False, session=None):
     """
     Parse inline function-replacement.
@@ -43,7 +43,7 @@ from django.forms import CharField, Textarea
 from django.forms.util import flatatt
 from django.utils.html import format_html
 
-from src.utils.dbserialize import from_pickle, to_pickle
+from src.utils.dbserialize import from_pickle, to_pickle, do_binary, do_unpickle, is_binary
 
 try:
     from django.utils.encoding import force_text
@@ -93,14 +93,20 @@ def wrap_conflictual_object(obj):
     return obj
 
 
-def dbsafe_encode(value, compress_object=False, pickle_protocol=DEFAULT_PROTOCOL):
-    # We use deepcopy() here to avoid a problem with cPickle, where dumps
-    # can generate different character streams for same lookup value if
-    # they are referenced differently.
-    # The reason this is important is because we do all of our lookups as
-    # simple string matches, thus the character streams must be the same
-    # for the lookups to work properly. See tests.py for more information.
-    value = dumps(deepcopy(value), protocol=pickle_protocol)
+def dbsafe_encode(value, compress_object=False, pickle_protocol=DEFAULT_PROTOCOL, binary=False):
+    # the binary format only stores standard types; for anything else
+    # we fall back to pickle. The binary format is always deterministic.
+    encoded = do_binary(value) if binary else None
+    if encoded and is_binary(encoded):
+        value = encoded
+    else:
+        # We use deepcopy() here to avoid a problem with cPickle, where dumps
+        # can generate different character streams for same lookup value if
+        # they are referenced differently.
+        # The reason this is important is because we do all of our lookups as
+        # simple string matches, thus the character streams must be the same
+        # for the lookups to work properly. See tests.py for more information.
+        value = dumps(deepcopy(value), protocol=pickle_protocol)
     if compress_object:
         value = compress(value)
     value = b64encode(value).decode() # decode bytes to str
@@ -112,7 +118,8 @@ def dbsafe_decode(value, compress_object=False):
     value = b64decode(value)
     if compress_object:
         value = decompress(value)
-    return loads(value)
+    # this reads both pickles and the binary format
+    return do_unpickle(value)
 
 
 def _get_subfield_superclass():
@@ -171,7 +178,10 @@ class PickledObjectField(_get_subfield_superclass()):
     """
     A field that will accept *any* python object and store it in the
     database. PickledObjectField will optionally compress its values if
-    declared with the keyword argument ``compress=True``.
+    declared with the keyword argument ``compress=True``. With
+    ``binary=True`` values of standard python types are stored in
+    the binary format of src.utils.dbserialize instead of as
+    pickles. Both formats are always read.
 
     Does not actually encode and compress ``None`` objects (although you
     can still do lookups using None). This way, it is still possible to
@@ -182,6 +192,7 @@ class PickledObjectField(_get_subfield_superclass()):
     def __init__(self, *args, **kwargs):
         self.compress = kwargs.pop('compress', False)
         self.protocol = kwargs.pop('protocol', DEFAULT_PROTOCOL)
+        self.binary = kwargs.pop('binary', False)
         super(PickledObjectField, self).__init__(*args, **kwargs)
 
     def get_default(self):
@@ -251,7 +262,7 @@ class PickledObjectField(_get_subfield_superclass()):
             # marshaller (telling it to store it like it would a string), but
             # since both of these methods result in the same value being stored,
             # doing things this way is much easier.
-            value = force_text(dbsafe_encode(value, self.compress, self.protocol))
+            value = force_text(dbsafe_encode(value, self.compress, self.protocol, self.binary))
         return value
 
     def value_to_string(self, obj):
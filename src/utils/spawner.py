@@ -76,6 +76,7 @@ os.environ['DJANGO_SETTINGS_MODULE'] = 'game.settings'
 from django.conf import settings
 from random import randint
 from src.objects.models import ObjectDB
+from src.typeclasses.models import AttributeHandler, AliasHandler, PermissionHandler
 from src.utils.create import handle_dbref
 from src.utils.utils import make_iter, all_from_module
 
@@ -123,6 +124,10 @@ def _batch_create_object(*objparams):
     optimized for speed. It does NOT check and convert various input
     so make sure the spawned Typeclass works before using this!
 
+    All database objects are created in one go, as are the
+    permissions, aliases and Attributes given by the prototypes. The
+    creation hooks are still called on each object.
+
     Input:
     objsparams - each argument should be a tuple of arguments for the respective
                  creation/add handlers in the following order:
@@ -131,40 +136,35 @@ def _batch_create_object(*objparams):
     A list of created objects
     """
 
-    # bulk create all objects in one go
-    dbobjs = [ObjectDB(**objparam[0]) for objparam in objparams]
-    # unfortunately this doesn't work since bulk_create don't creates pks;
-    # the result are double objects at the next stage
-    #dbobjs = _ObjectDB.objects.bulk_create(dbobjs)
+    # bulk create all objects in one go (this also assigns their pks)
+    dbobjs = ObjectDB.batch_create(ObjectDB(**objparam[0]) for objparam in objparams)
 
     objs = []
     for iobj, dbobj in enumerate(dbobjs):
         # call all setup hooks on each object
         objparam = objparams[iobj]
-        obj = dbobj.typeclass # this saves dbobj if not done already
+        # batch_create usually sends no save signals
+        dbobj.update_contents_index()
+        obj = dbobj.typeclass
         obj.basetype_setup()
         obj.at_object_creation()
 
-        if objparam[1]:
-            # permissions
-            obj.permissions.add(objparam[1])
         if objparam[2]:
             # locks
             obj.locks.add(objparam[2])
-        if objparam[3]:
-            # aliases
-            obj.aliases.add(objparam[3])
         if objparam[4]:
             # nattributes
             for key, value in objparam[4].items():
                 obj.nattributes.add(key, value)
-        if objparam[5]:
-            # attributes
-            keys, values = objparam[5].keys(), objparam[5].values()
-            obj.attributes.batch_add(keys, values)
+        objs.append(obj)
 
+    # permissions, aliases and attributes for all objects at once
+    PermissionHandler.bulk_add(objs, [objparam[1] for objparam in objparams])
+    AliasHandler.bulk_add(objs, [objparam[3] for objparam in objparams])
+    AttributeHandler.bulk_add(objs, [objparam[5] for objparam in objparams])
+
+    for obj in objs:
         obj.basetype_posthook_setup()
-        objs.append(obj)
     return objs
 
 
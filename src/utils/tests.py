@@ -5,7 +5,14 @@ try:
 except ImportError:
     from django.test import TestCase
 
-from ansi import ANSIString
+from twisted.internet.task import Clock
+from ansi import ANSIString, parse_ansi
+from src.utils import ansi, create, dbserialize
+from src.utils.dbserialize import (to_pickle, from_pickle, do_pickle, do_unpickle,
+                                   do_binary, is_binary)
+from src.utils.picklefield import dbsafe_encode, dbsafe_decode
+from src.locks.lockhandler import _get_lockstate
+from src.typeclasses.models import _uncache_attribute_value
 
 
 class ANSIStringTestCase(TestCase):
@@ -118,4 +125,189 @@ class ANSIStringTestCase(TestCase):
         """
         target = ANSIString('{gtest{n')
         result = u'\x1b[1m\x1b[32mTest\x1b[0m'
-        self.checker(target.capitalize(), result, u'Test')
\ No newline at end of file
+        self.checker(target.capitalize(), result, u'Test')
+
+    def test_large(self):
+        """
+        Build, slice and index a 10 KB colored string. The indexes used
+        to be built in quadratic time, which made this take minutes.
+        """
+        words = ["{%s%s " % ("rgbymc"[i % 6], "word%i" % i) for i in range(1200)]
+        text = "".join(words)
+        clean = "".join(word[2:] for word in words)
+        target = ANSIString(text)
+        raw = target.raw()
+        self.assertTrue(len(raw) > 10000)
+        lines = [target[i:i + 78] for i in range(0, len(target), 78)]
+        chars = [target[i] for i in range(0, len(target), 100)]
+        self.assertEqual(clean, u"".join(line.clean() for line in lines))
+        self.assertEqual(clean[::100], u"".join(char.clean() for char in chars))
+        # every raw character is indexed exactly once, in order
+        self.assertEqual(len(target._char_indexes), len(clean))
+        self.assertEqual(range(len(raw)), sorted(target._char_indexes + target._code_indexes))
+        self.assertEqual(sorted(target._char_indexes), target._char_indexes)
+
+    def test_add_mul(self):
+        """
+        Verify the indexes of added and multiplied ANSIStrings.
+        """
+        target = ANSIString("{rA{n") + ANSIString("{gB{n")
+        self.assertEqual(target._char_indexes, [9, 23])
+        self.assertEqual(target[1].clean(), u"B")
+        target = ANSIString("{rAB{n") * 2
+        self.assertEqual(target._char_indexes, [9, 10, 24, 25])
+
+class ANSIParserTestCase(TestCase):
+    """
+    Verifies the parsing of ansi markup
+    """
+    def test_parse(self):
+        self.assertEqual(parse_ansi("Plain text"), "Plain text")
+        self.assertEqual(parse_ansi(u"{rRed{n"), "\x1b[1m\x1b[31mRed\x1b[0m")
+        self.assertEqual(parse_ansi("%crRed%cn {{r %%cr {[123"), "\x1b[31mRed\x1b[0m {r %cr \x1b[44m")
+        self.assertEqual(parse_ansi("{[123", xterm256=True), "\x1b[48;5;067m")
+        self.assertEqual(parse_ansi("{rRed\x1b[32m{n", strip_ansi=True), "Red")
+        link = "{lclook{ltLook here{le"
+        self.assertEqual(parse_ansi(link), "Look here")
+        self.assertEqual(parse_ansi(link, mxp=True), link)
+        self.assertEqual(parse_ansi(link, strip_ansi=True, mxp=True), "Look here")
+
+    def test_parse_cache(self):
+        ansi.parse_ansi("{rcached{n")
+        size = len(ansi._PARSE_CACHE) + len(ansi._PARSE_CACHE_OLD)
+        for i in range(100):
+            self.assertEqual("plain line %i" % i, ansi.parse_ansi("plain line %i" % i))
+        # strings without markup are not cached
+        self.assertEqual(size, len(ansi._PARSE_CACHE) + len(ansi._PARSE_CACHE_OLD))
+        cachekey = ("{rcached{n", False, False, False)
+        self.assertTrue(cachekey in ansi._PARSE_CACHE or cachekey in ansi._PARSE_CACHE_OLD)
+
+
+class _Unicode(unicode):
+    "custom string type"
+    pass
+
+
+class _SaveRecorder(object):
+    "Stand-in for an Attribute, recording the values saved to it"
+    pk = 1
+
+    def __init__(self):
+        self.saved = []
+
+    def _set_value(self, value):
+        self.saved.append(value)
+    value = property(lambda self: self.saved[-1], _set_value)
+
+
+class DBSerializeTestCase(TestCase):
+    """
+    Verifies the serialization of Attribute data
+    """
+    data = {"name": "test", "num": 3, "float": 1.0 / 3, "none": None,
+            "flat": [1, 2L, "three", u"f\xf6ur", True],
+            "nested": [{"a": (1, 2, [3, {4: set([5])}])}, [[]], ()],
+            "tuple": ("a", ("b", ["c"])),
+            "set": set([1, ("a", "b")]), u"uni": {}}
+
+    def test_roundtrip(self):
+        flat = self.data["flat"]
+        self.assertFalse(to_pickle(flat) is flat)
+        self.assertEqual(self.data, from_pickle(do_unpickle(do_pickle(to_pickle(self.data)))))
+
+    def test_saver_tree(self):
+        db_obj = _SaveRecorder()
+        value = from_pickle(to_pickle(self.data), db_obj=db_obj)
+        self.assertEqual(self.data, to_pickle(value))
+        value["nested"][0]["a"][2][1][4].add(6)
+        value["tuple"][1][1].append("d")
+        value["flat"][0] = [7]
+        value["flat"][0].append(8)
+        self.assertEqual(4, len(db_obj.saved))
+        saved = to_pickle(db_obj.saved[-1])
+        self.assertEqual(set([5, 6]), saved["nested"][0]["a"][2][1][4])
+        self.assertEqual(("b", ["c", "d"]), saved["tuple"][1])
+        self.assertEqual([7, 8], saved["flat"][0])
+
+    def test_binary(self):
+        data = to_pickle(self.data)
+        binary = do_binary(data)
+        self.assertTrue(is_binary(binary))
+        self.assertEqual(data, do_unpickle(binary))
+        # old pickles are still read
+        self.assertFalse(is_binary(do_pickle(data)))
+        self.assertEqual(data, do_unpickle(do_pickle(data)))
+        # equal data gives equal strings
+        self.assertEqual(binary, do_binary(to_pickle(dict(reversed(self.data.items())))))
+        # subclasses of the standard types can't be stored in binary
+        for value in (_Unicode(u"test"), [1, _Unicode(u"test")], {1: _SaveRecorder}):
+            self.assertFalse(is_binary(do_binary(value)))
+            self.assertEqual(value, do_unpickle(do_binary(value)))
+
+    def test_picklefield(self):
+        for compress in (False, True):
+            for binary in (False, True):
+                encoded = dbsafe_encode(self.data, compress, binary=binary)
+                self.assertEqual(self.data, dbsafe_decode(encoded, compress))
+
+
+class WriteBehindTestCase(TestCase):
+    """
+    Verifies the delayed saving of changes to nested mutables
+    """
+    def setUp(self):
+        self.dbserialize = dbserialize
+        self.clock = Clock()
+        self.old = dbserialize._write_behind, dbserialize.reactor
+        dbserialize._write_behind = lambda: True
+        dbserialize.reactor = self.clock
+
+    def tearDown(self):
+        self.dbserialize.flush()
+        self.dbserialize._write_behind, self.dbserialize.reactor = self.old
+
+    def test_write_behind(self):
+        dbserialize = self.dbserialize
+        db_obj = _SaveRecorder()
+        value = dbserialize.from_pickle([1, {"a": []}], db_obj=db_obj)
+        for i in range(100):
+            value[1]["a"].append(i)
+        self.assertEqual([], db_obj.saved)
+        self.assertTrue(dbserialize.get_pending(db_obj) is value)
+        self.assertEqual(1, len(self.clock.getDelayedCalls()))
+        self.clock.advance(0)
+        self.assertEqual(1, len(db_obj.saved))
+        self.assertEqual(range(100), dbserialize.to_pickle(db_obj.saved[0])[1]["a"])
+        self.assertEqual(None, dbserialize.get_pending(db_obj))
+        # explicit flush
+        value[0] = 2
+        dbserialize.flush(db_obj)
+        self.assertEqual(2, len(db_obj.saved))
+        self.assertEqual(2, dbserialize.to_pickle(db_obj.saved[-1])[0])
+        # changes to deleted or replaced Attributes are not saved
+        value.append(3)
+        dbserialize.discard_pending(db_obj)
+        value.append(4)
+        db_obj.pk = None
+        dbserialize.flush()
+        self.assertEqual(2, len(db_obj.saved))
+
+    def test_attribute(self):
+        obj = create.create_object("src.objects.objects.Object", key="WriteBehindTest")
+        obj.db.test = []
+        attr = obj.attributes.get("test", return_obj=True)
+        for i in range(10):
+            obj.db.test.append(i)
+        self.assertEqual(range(10), list(obj.db.test))
+        self.assertEqual([], attr.db_value)
+        # cached lock decisions are invalidated before the flush
+        lockstate = _get_lockstate(obj.dbobj)
+        obj.db.test.append(10)
+        self.assertNotEqual(lockstate, _get_lockstate(obj.dbobj))
+        obj.db.test.remove(10)
+        # the value is read from the pending changes if not cached
+        _uncache_attribute_value(attr)
+        self.assertEqual(range(10), list(obj.db.test))
+        self.dbserialize.flush()
+        self.assertEqual(range(10), attr.db_value)
+        obj.delete()
@@ -29,6 +29,7 @@ from base64 import b64encode, b64decode
 from hashlib import md5, sha1
 from string import digits
 from struct import pack, unpack
+import zlib
 
 from twisted.internet.interfaces import ISSLTransport
 from twisted.protocols.policies import ProtocolWrapper, WrappingFactory
@@ -83,6 +84,17 @@ decoders = {
     "base64": b64decode,
 }
 
+# The permessage-deflate extension (RFC 7692). Each message is compressed
+# with raw deflate and flushed, and the trailing empty block left by the
+# flush is stripped off the wire.
+
+DEFLATE_TAIL = "\x00\x00\xff\xff"
+
+# Compressed messages inflating to more than this many bytes are refused,
+# so a small frame can't make us allocate huge amounts of memory.
+
+MAX_INFLATED_LENGTH = 1024 * 1024
+
 # Fake HTTP stuff, and a couple convenience methods for examining fake HTTP
 # headers.
 
@@ -102,6 +114,30 @@ def http_headers(s):
 
     return d
 
+def parse_deflate_offer(header):
+    """
+    Find the first acceptable permessage-deflate offer in a
+    Sec-WebSocket-Extensions header.
+
+    Returns a dict of the offer's parameters, or None if the client did not
+    offer the extension (or only offered parameters we cannot honour).
+    """
+
+    for offer in header.split(","):
+        parts = [p.strip() for p in offer.split(";")]
+        if parts[0] != "permessage-deflate":
+            continue
+        params = {}
+        for param in parts[1:]:
+            key, chaff, value = param.partition("=")
+            params[key.strip()] = value.strip().strip('"') or None
+        bits = params.get("server_max_window_bits")
+        if bits is not None and not (bits.isdigit() and 9 <= int(bits) <= 15):
+            # zlib can't do raw deflate with an 8-bit window.
+            continue
+        return params
+    return None
+
 def is_websocket(headers):
     """
     Determine whether a given set of headers is asking for WebSockets.
@@ -204,12 +240,13 @@ def mask(buf, key):
         buf[i] = chr(ord(char) ^ key[i % 4])
     return "".join(buf)
 
-def make_hybi07_frame(buf, opcode=0x1):
+def make_hybi07_frame(buf, opcode=0x1, compressed=False):
     """
     Make a HyBi-07 frame.
 
     This function always creates unmasked frames, and attempts to use the
-    smallest possible lengths.
+    smallest possible lengths. If compressed is set, buf must already be
+    deflated and the frame is flagged as such (RSV1).
     """
 
     if len(buf) > 0xffff:
@@ -220,7 +257,7 @@ def make_hybi07_frame(buf, opcode=0x1):
         length = chr(len(buf))
 
     # Always make a normal packet.
-    header = chr(0x80 | opcode)
+    header = chr(0x80 | (0x40 if compressed else 0) | opcode)
     frame = "%s%s%s" % (header, length, buf)
     return frame
 
@@ -237,9 +274,35 @@ def make_hybi07_frame_dwim(buf):
     else:
         raise TypeError("In binary support mode, frame data must be either str or unicode")
 
-def parse_hybi07_frames(buf):
+def deflate(compressor, buf):
+    """
+    Compress one message for the permessage-deflate extension.
+    """
+
+    data = compressor.compress(buf) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    if data.endswith(DEFLATE_TAIL):
+        data = data[:-4]
+    return data
+
+def inflate(decompressor, buf, max_length=MAX_INFLATED_LENGTH):
+    """
+    Decompress one message sent with the permessage-deflate extension.
+
+    Raises WSException if the message inflates to more than max_length
+    bytes.
+    """
+
+    data = decompressor.decompress(buf + DEFLATE_TAIL, max_length)
+    if decompressor.unconsumed_tail:
+        raise WSException("Compressed HyBi-07 frame too large")
+    return data
+
+def parse_hybi07_frames(buf, inflater=None):
     """
     Parse HyBi-07 frames in a highly compliant manner.
+
+    If inflater is given, permessage-deflate has been negotiated and data
+    frames flagged as compressed (RSV1) are passed through it.
     """
 
     start = 0
@@ -253,7 +316,8 @@ def parse_hybi07_frames(buf):
         # Grab the header. This single byte holds some flags nobody cares
         # about, and an opcode which nobody cares about.
         header = ord(buf[start])
-        if header & 0x70:
+        compressed = header & 0x40 and inflater and (header & 0xf) in (0x1, 0x2)
+        if header & (0x30 if compressed else 0x70):
             # At least one of the reserved flags is set. Pork chop sandwiches!
             raise WSException("Reserved flag in HyBi-07 frame (%d)" % header)
             frames.append(("", CLOSE))
@@ -314,6 +378,12 @@ def parse_hybi07_frames(buf):
         if masked:
             data = mask(data, key)
 
+        if compressed:
+            try:
+                data = inflater(data)
+            except zlib.error:
+                raise WSException("Malformed compressed HyBi-07 frame")
+
         if opcode == CLOSE:
             if len(data) >= 2:
                 # Gotta unpack the opcode and return usable data here.
@@ -341,6 +411,10 @@ class WebSocketProtocol(ProtocolWrapper):
     state = REQUEST
     flavor = None
     do_binary_frames = False
+    compressor = None
+    decompressor = None
+    no_context_takeover = False
+    window_bits = 15
 
     def __init__(self, *args, **kwargs):
         ProtocolWrapper.__init__(self, *args, **kwargs)
@@ -404,7 +478,48 @@ class WebSocketProtocol(ProtocolWrapper):
         challenge = self.headers["Sec-WebSocket-Key"]
         response = make_accept(challenge)
 
-        self.transport.write("Sec-WebSocket-Accept: %s\r\n\r\n" % response)
+        self.transport.write("Sec-WebSocket-Accept: %s\r\n" % response)
+        if self.compressor:
+            extension = "permessage-deflate"
+            if self.no_context_takeover:
+                extension += "; server_no_context_takeover"
+            if self.window_bits != 15:
+                extension += "; server_max_window_bits=%d" % self.window_bits
+            self.transport.write("Sec-WebSocket-Extensions: %s\r\n" % extension)
+        self.transport.write("\r\n")
+
+    def negotiateDeflate(self):
+        """
+        Set up permessage-deflate if both we and the client want it.
+        """
+
+        if not getattr(self.factory, "deflate", False):
+            return
+        offer = parse_deflate_offer(self.headers.get("Sec-WebSocket-Extensions", ""))
+        if offer is None:
+            return
+        self.no_context_takeover = "server_no_context_takeover" in offer
+        self.window_bits = int(offer.get("server_max_window_bits") or 15)
+        self.compressor = self.makeCompressor()
+        # the client may compress with any window size, so always use the
+        # largest one for decompressing.
+        self.decompressor = zlib.decompressobj(-15)
+        log.msg("Using permessage-deflate")
+
+    def makeCompressor(self):
+        """
+        Create a compressor for outgoing messages.
+        """
+
+        return zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED,
+                                -self.window_bits)
+
+    def inflate(self, data):
+        """
+        Decompress an incoming message.
+        """
+
+        return inflate(self.decompressor, data)
 
     def parseFrames(self):
         """
@@ -419,7 +534,10 @@ class WebSocketProtocol(ProtocolWrapper):
             raise WSException("Unknown flavor %r" % self.flavor)
 
         try:
-            frames, self.buf = parser(self.buf)
+            if self.decompressor:
+                frames, self.buf = parser(self.buf, inflater=self.inflate)
+            else:
+                frames, self.buf = parser(self.buf)
         except WSException, wse:
             # Couldn't parse all the frames, something went wrong, let's bail.
             self.close(wse.args[0])
@@ -459,6 +577,9 @@ class WebSocketProtocol(ProtocolWrapper):
         else:
             raise WSException("Unknown flavor %r" % self.flavor)
 
+        if self.compressor and self.flavor != HYBI00:
+            maker = self.makeDeflatedFrame
+
         for frame in self.pending_frames:
             # Encode the frame before sending it.
             if self.codec:
@@ -467,6 +588,21 @@ class WebSocketProtocol(ProtocolWrapper):
             self.transport.write(packet)
         self.pending_frames = []
 
+    def makeDeflatedFrame(self, buf):
+        """
+        Make a compressed HyBi-07 frame for the permessage-deflate extension.
+        """
+
+        opcode = 0x1
+        if isinstance(buf, unicode):
+            buf = buf.encode("utf-8")
+        elif self.do_binary_frames:
+            opcode = 0x2
+        if self.no_context_takeover:
+            self.compressor = self.makeCompressor()
+        return make_hybi07_frame(deflate(self.compressor, buf),
+                                 opcode=opcode, compressed=True)
+
     def validateHeaders(self):
         """
         Check received headers for sanity and correctness, and stash any data
@@ -516,6 +652,7 @@ class WebSocketProtocol(ProtocolWrapper):
 
         # Start the next phase of the handshake for HyBi-07+.
         if "Sec-WebSocket-Version" in self.headers:
+            self.negotiateDeflate()
             version = self.headers["Sec-WebSocket-Version"]
             if version == "7":
                 log.msg("Starting HyBi-07 conversation")
@@ -641,3 +778,12 @@ class WebSocketFactory(WrappingFactory):
     """
 
     protocol = WebSocketProtocol
+
+    def __init__(self, wrappedFactory, deflate=False):
+        """
+        If deflate is set, the permessage-deflate extension is used with
+        clients that support it.
+        """
+
+        WrappingFactory.__init__(self, wrappedFactory)
+        self.deflate = deflate
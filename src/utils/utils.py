@@ -17,7 +17,7 @@ import datetime
 import random
 import traceback
 from inspect import ismodule
-from collections import defaultdict
+from collections import defaultdict, Counter
 from twisted.internet import threads, defer, reactor
 from django.conf import settings
 
@@ -559,7 +559,7 @@ def clean_object_caches(obj):
     obj = hasattr(obj, "dbobj") and obj.dbobj or obj
     # contents cache
     try:
-        _SA(obj, "_contents_cache", None)
+        _SA(obj, "contents_dirty", True)
     except AttributeError:
         pass
 
@@ -927,6 +927,70 @@ def string_suggestions(string, vocabulary, cutoff=0.6, maxnum=3):
                                            if tup[0] >= cutoff][:maxnum]
 
 
+class StringSimilarityIndex(object):
+    """
+    An index for looking up string suggestions repeatedly in the same
+    vocabulary, such as the commands of a cmdset or the help topics.
+
+    string_similarity rates strings by the letters they contain, so
+    the index maps each letter to the vocabulary entries having it
+    (and how many times). A lookup only visits the entries sharing
+    letters with the searched string, instead of comparing with the
+    whole vocabulary, and gives the same result as string_suggestions.
+
+    Args:
+        vocabulary (iterable) - the strings to index
+    """
+    def __init__(self, vocabulary):
+        self.vocabulary = list(vocabulary)
+        self._postings = defaultdict(list)
+        self._norms = []
+        for ipos, word in enumerate(self.vocabulary):
+            counts = Counter(word)
+            for char, count in counts.iteritems():
+                self._postings[char].append((ipos, count))
+            self._norms.append(math.sqrt(sum(count**2 for count in counts.itervalues())))
+
+    def match(self, string, cutoff=0.6):
+        """
+        Find the vocabulary entries similar to string.
+
+        Args:
+            string (str) - the string to search for
+            cutoff (int, 0-1) - the lowest similarity to include
+        Returns:
+            list of positions in vocabulary, most similar first
+            (entries equally similar are in vocabulary order)
+        """
+        counts = Counter(string)
+        dots = defaultdict(int)
+        for char, count in counts.iteritems():
+            for ipos, wcount in self._postings.get(char, ()):
+                dots[ipos] += count * wcount
+        norm = math.sqrt(sum(count**2 for count in counts.itervalues()))
+        norms = self._norms
+        # without shared letters the similarity is 0, so only the
+        # entries in dots need to be rated unless cutoff allows 0
+        positions = dots.iterkeys() if cutoff > 0 else xrange(len(norms))
+        scores = []
+        for ipos in positions:
+            try:
+                score = float(dots.get(ipos, 0)) / (norm * norms[ipos])
+            except ZeroDivisionError:
+                score = 0
+            if score >= cutoff:
+                scores.append((-score, ipos))
+        scores.sort()
+        return [ipos for score, ipos in scores]
+
+    def suggestions(self, string, cutoff=0.6, maxnum=3):
+        """
+        Works like string_suggestions(string, vocabulary, cutoff, maxnum)
+        for the indexed vocabulary.
+        """
+        return [self.vocabulary[ipos] for ipos in self.match(string, cutoff)[:maxnum]]
+
+
 def string_partial_matching(alternatives, inp, ret_index=True):
     """
     Partially matches a string based on a list of alternatives. Matching
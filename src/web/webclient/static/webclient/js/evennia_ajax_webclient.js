@@ -18,7 +18,8 @@ contain the 'mode' of the request to be handled by the protocol:
                   The returned data object has two variables 'msg' and 'data'
                   where msg should be output and 'data' is an arbitrary piece
                   of data the server and client understands (not used in default
-                  client).
+                  client). If the request also sets 'batch' to 1, a list of
+                  all such objects buffered on the server is returned.
  mode 'input' - the user has input data on some form. The POST request
                 should also contain variables 'msg' and 'data' where
                 the 'msg' is a string and 'data' is an arbitrary piece
@@ -91,12 +92,13 @@ function webclient_receive(){
         cache: false,            // Forces browser reload independent of cache
         timeout:30000,           // Timeout in ms. After this time a new long-poll will be started.
         dataType:"json",
-        data: {mode:'receive', 'suid':CLIENT_HASH},
+        data: {mode:'receive', 'suid':CLIENT_HASH, 'batch':1},
 
         // callback methods
 
         success: function(data){       // called when request to waitreceive completes
-            msg_display("out", data.msg);  // Add response to the message area
+            for (var ind = 0; ind < data.length; ind++) {
+                msg_display("out", data[ind].msg); } // Add response to the message area
             webclient_receive();              // immediately start a new request
         },
         error: function(XMLHttpRequest, textStatus, errorThrown){
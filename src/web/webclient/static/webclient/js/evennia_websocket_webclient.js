@@ -6,11 +6,13 @@ The client is composed of two parts:
  src/server/portal/websocket_client.py - the portal-side component
  this file - the javascript component handling dynamic content
 
-messages sent to the client is one of two modes:
-  OOB("func1",args, "func2",args, ...)  - OOB command executions, this will
-                                        call unique javascript functions
-                                        func1(args), func2(args) etc.
-  text - any other text is considered a normal text output in the main output window.
+messages sent to the client are JSON encoded objects on the form
+  {"text": text, "prompt": prompt, "oob": [["func1", args, kwargs], ...]}
+where text is shown in the main output window, prompt is shown as the
+prompt and the oob functions func1(args, kwargs) etc are called. Messages
+sent close together arrive as a list of such objects in one frame.
+For backwards compatibility, messages starting with "OOB" or "PROMPT"
+are also understood, and any other text is shown as normal output.
 
 */
 
@@ -88,7 +90,19 @@ function onClose(evt) {
 function onMessage(evt) {
     // called when the Evennia is sending data to client
     var inmsg = evt.data
-    if (inmsg.length > 3 && inmsg.substr(0, 3) == "OOB") {
+    var data;
+    try {
+        data = JSON.parse(inmsg); }
+    catch(err) {
+        data = null; }
+    if (data !== null && typeof data == "object") {
+        // one message or a batch of them
+        if (!$.isArray(data)) {
+            data = [data]; }
+        for (var ind = 0; ind < data.length; ind++) {
+            doMessage(data[ind]); }
+    }
+    else if (inmsg.length > 3 && inmsg.substr(0, 3) == "OOB") {
         // dynamically call oob methods, if available
         try {
             var oobarray = JSON.parse(inmsg.slice(3));} // everything after OOB }
@@ -98,13 +112,7 @@ function onMessage(evt) {
             return;
         }
         if (typeof oobarray != "undefined") {
-            for (var ind in oobarray) {
-                try {
-                    window[oobarray[ind][0]](oobarray[ind][1], oobarray[ind][2]) }
-                catch(err) {
-                    doShow("err", "Could not execute js OOB function '" + oobarray[ind][0] + "(" + oobarray[ind][1] + oobarray[ind][2] + ")'") }
-            }
-        }
+            doOOBCalls(oobarray); }
     }
     else if (inmsg.length >= 6 && inmsg.substr(0, 6) == "PROMPT") {
         // handle prompt
@@ -116,6 +124,26 @@ function onMessage(evt) {
         doShow('out', inmsg); }
 }
 
+function doMessage(msg) {
+    // handle one JSON message from the server
+    if (msg.oob) {
+        doOOBCalls(msg.oob); }
+    if (msg.prompt) {
+        doPrompt("prompt", msg.prompt); }
+    if (msg.text) {
+        doShow("out", msg.text); }
+}
+
+function doOOBCalls(oobarray) {
+    // dynamically call oob methods, if available
+    for (var ind in oobarray) {
+        try {
+            window[oobarray[ind][0]](oobarray[ind][1], oobarray[ind][2]) }
+        catch(err) {
+            doShow("err", "Could not execute js OOB function '" + oobarray[ind][0] + "(" + oobarray[ind][1] + oobarray[ind][2] + ")'") }
+    }
+}
+
 function onError(evt) {
     // called on a server error
     doShow('err', "Connection error trying to access websocket on " + wsurl + ". " + "Contact the admin and/or check settings.WEBSOCKET_CLIENT_URL.");